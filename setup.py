@@ -6,7 +6,6 @@ setup(
     packages=find_packages(),
     install_requires=[
         "flask>=3.1.0",
-        "matplotlib>=3.10.1",
         "pillow>=11.1.0",
         "pysubs2>=1.8.0",
         "python-ffmpeg>=2.0.12",
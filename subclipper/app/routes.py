@@ -1,12 +1,28 @@
+import cProfile
+import functools
+import hashlib
 import json
+import math
+import os
+import re
+import socket
+import time
+import uuid
 from flask import Response, Blueprint, render_template, request, send_file, send_from_directory, make_response, jsonify, current_app
 from pathlib import Path
 import logging
-from typing import Optional
+from typing import List, Optional
+from urllib.parse import urlencode
+from werkzeug.datastructures import CombinedMultiDict, MultiDict
 
 import flask
 
+from ..core import timing
+from ..core.export import export_name, stream_zip
+from ..core.metrics import metrics
 from ..core.models import ClipSettings
+from ..core.render import Cancellation
+from ..core.render_jobs import QueueFullError, DONE, FAILED
 from ..utils.config import Config
 from ..core.video_processor import VideoProcessor
 
@@ -14,78 +30,293 @@ logger = logging.getLogger(__name__)
 bp = Blueprint('main', __name__)
 config = Config()
 
+CLIP_CACHE_CONTROL = 'public, max-age=86400'
+# Identifies a browser, so a render it starts replaces the render it started before
+SESSION_COOKIE = 'subclipper_session'
+
+# Identifies the templates, so pages are not revalidated against pages of an older release
+_template_version: Optional[str] = None
+
+def template_version() -> str:
+    global _template_version
+    if _template_version is None:
+        digest = hashlib.sha256()
+        for path in sorted((Path(__file__).parent / 'templates').glob('*.html')):
+            digest.update(path.name.encode())
+            digest.update(path.read_bytes())
+        _template_version = digest.hexdigest()[:16]
+    return _template_version
+
+def page_etag(version: str) -> str:
+    """Get the ETag of the page of the current request, which changes with the library, the templates and the request."""
+    identity = [version, template_version(), request.full_path, request.headers.get("HX-Request") is not None]
+    thumbnail_dir = config.video_processor.thumbnail_dir()
+    if thumbnail_dir is not None:
+        # Pages show the thumbnails that exist when they are rendered, new sprite sheets change the directory
+        try:
+            identity.append(thumbnail_dir.stat().st_mtime_ns)
+        except OSError:
+            pass
+    return hashlib.sha256(json.dumps(identity).encode()).hexdigest()[:32]
+
+def not_modified(etag: str, cache_control: str) -> Response:
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+def conditional_page(view):
+    """Answer a request with 304 Not Modified when the client has the page already, or from the page cache.
+
+    The ETag of a page identifies everything it is rendered from, so it is also its key in the page cache.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        version = config.video_processor.library_version
+        if version is None:
+            return view(*args, **kwargs)
+        etag = page_etag(version)
+        if request.if_none_match.contains_weak(etag):
+            response = not_modified(etag, 'no-cache')
+            response.vary.add('HX-Request')
+            return response
+
+        page_cache = config.page_cache
+        cached = None if page_cache is None else page_cache.get(version, etag)
+        if cached is not None:
+            metrics.inc('subclipper_page_cache_requests_total', {'result': 'hit'})
+            body, mimetype = cached
+            response = Response(body, mimetype=mimetype)
+        else:
+            if page_cache is not None:
+                metrics.inc('subclipper_page_cache_requests_total', {'result': 'miss'})
+            response = make_response(view(*args, **kwargs))
+            if page_cache is not None and response.status_code == 200:
+                page_cache.put(version, etag, response.get_data(), response.mimetype)
+        if response.status_code == 200:
+            response.set_etag(etag)
+            # Always revalidate, a page changes whenever the library does
+            response.headers['Cache-Control'] = 'no-cache'
+            response.vary.add('HX-Request')
+        return response
+    return wrapper
+
 def cached_render_template(template, **context):
     """Render a template with caching headers."""
-    rendered_template = render_template(template, show_name=config.show_name, **context)
+    rendered_template = render_template(template, show_name=config.show_name, get_video=config.video_processor.get_video, **context)
     response = make_response(rendered_template)
     return response
 
 def create_clip_settings_from_request() -> ClipSettings:
-    """Create ClipSettings from the current request's query parameters."""
+    """Create ClipSettings from the current request's query parameters or form data."""
+    return clip_settings_from_values(request.values)
+
+def clip_settings_from_values(values) -> ClipSettings:
+    """Create ClipSettings from query parameters, form data or anything else with the same `get` method."""
     return ClipSettings(
-        start_time=request.args.get('start', 0, type=float),
-        end_time=request.args.get('end', 0, type=float),
-        original_start_time=request.args.get('original_start', 0, type=float),
-        original_end_time=request.args.get('original_end', 0, type=float),
-        text=request.args.get('text', '', type=str),
-        crop=request.args.get('crop', False, type=bool),
-        resolution=request.args.get('resolution', 500, type=int),
-        id=request.args.get('sub_id', -1, type=int),
-        episode=request.args.get('episode', -1, type=int),
-        font_size=request.args.get('font_size', 20, type=int),
-        caption=request.args.get('caption', '', type=str),
-        boomerang=request.args.get('boomerang', False, type=bool),
-        colour=request.args.get('colour', False, type=bool),
-        format=request.args.get('format', 'webp', type=str),
-        font_path=config.font_path
+        start_time=values.get('start', 0, type=float),
+        end_time=values.get('end', 0, type=float),
+        original_start_time=values.get('original_start', 0, type=float),
+        original_end_time=values.get('original_end', 0, type=float),
+        text=values.get('text', '', type=str),
+        crop=values.get('crop', False, type=bool),
+        resolution=values.get('resolution', 500, type=int),
+        id=values.get('sub_id', -1, type=int),
+        episode=values.get('episode', -1, type=int),
+        font_size=values.get('font_size', 20, type=int),
+        caption=values.get('caption', '', type=str),
+        boomerang=values.get('boomerang', False, type=bool),
+        colour=values.get('colour', False, type=bool),
+        format=values.get('format', 'webp', type=str),
+        font_path=config.font_path,
+        preview=values.get('preview', False, type=bool)
     )
 
+def export_clip_settings(values, clips: Optional[list] = None) -> List[ClipSettings]:
+    """Create the settings of the clips of an export: the listed `clips`, or a clip of every search result.
+
+    Clips of search results take their other settings from `values`.
+    """
+    if clips is not None:
+        if not isinstance(clips, list) or not all(isinstance(clip, dict) for clip in clips):
+            raise ValueError("clips must be a list of clip settings")
+        return [clip_settings_from_values(MultiDict(clip)) for clip in clips]
+
+    query = values.get('q')
+    if not query:
+        raise ValueError("an export needs either clips or a search query")
+    subs = config.video_processor.search_subtitles(query, values.get('video', None, type=int))
+    if len(subs) > config.export_max_clips:
+        # Refuse instead of exporting an arbitrary part of the results
+        raise ValueError(f"the search has {len(subs)} results, at most {config.export_max_clips} clips can be exported at once")
+    return [
+        clip_settings_from_values(CombinedMultiDict([
+            MultiDict({
+                'start': sub.start, 'end': sub.end, 'original_start': sub.start, 'original_end': sub.end,
+                'text': sub.text, 'sub_id': sub.id, 'episode': sub.video_id,
+            }),
+            values,
+        ]))
+        for sub in subs
+    ]
+
+def full_quality_query() -> str:
+    """Get the query string of the current request without the preview flag."""
+    return urlencode([(key, value) for key, value in request.args.items(multi=True) if key != 'preview'])
+
+def render_session() -> str:
+    """Get the render session of the browser, starting one if it has none yet."""
+    session = request.cookies.get(SESSION_COOKIE)
+    if session is None or not re.fullmatch(r'[0-9a-f]{32}', session):
+        session = flask.g.get('new_session')
+        if session is None:
+            session = flask.g.new_session = uuid.uuid4().hex
+    return session
+
+def client_disconnected(environ) -> Cancellation:
+    """Cancel a render when the client of the request hangs up, if the server exposes its socket."""
+    connection = environ.get('gunicorn.socket') or environ.get('werkzeug.socket')
+    if connection is None or not hasattr(socket, 'MSG_DONTWAIT'):  # Windows has no non-blocking peek
+        return Cancellation()
+
+    def check() -> Optional[str]:
+        try:
+            # A closed connection reads as empty, an open one has nothing to read
+            data = connection.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except (BlockingIOError, InterruptedError):
+            return None
+        except OSError:
+            return 'disconnected'
+        return 'disconnected' if data == b'' else None
+
+    return Cancellation(check)
+
+def render_gif_view(job):
+    """Render the clip view of a render job, which polls the job until it is finished."""
+    return cached_render_template(
+        "gif_view.html",
+        job=job,
+        query=request.query_string.decode(),
+        preview=request.args.get('preview', False, type=bool),
+        full_quality_query=full_quality_query()
+    )
+
+@bp.before_app_request
+def start_request_timing():
+    """Collect the stage timings of every request, and profile it if that was asked for."""
+    timing.start()
+    flask.g.request_started = time.perf_counter()
+    if config.profile_dir is not None and request.headers.get('X-Profile'):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Another profiler is active already
+            logger.warning(f"Not profiling {request.path}: {e}")
+            return
+        flask.g.profiler = profiler
+
+@bp.after_app_request
+def add_server_timing(response):
+    """Report the stage timings of the request in a Server-Timing header, and save its profile."""
+    profiler = flask.g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        name = f"{time.time():.3f}-{os.getpid()}-{re.sub(r'[^A-Za-z0-9]+', '_', request.path).strip('_') or 'index'}.prof"
+        try:
+            config.profile_dir.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(config.profile_dir / name)
+            response.headers['X-Profile-File'] = name
+            logger.info(f"Saved the profile of {request.path} to {config.profile_dir / name}")
+        except OSError as e:
+            logger.warning(f"Failed to save the profile of {request.path}: {e}")
+
+    timings = timing.collected()
+    started = flask.g.get('request_started')
+    if started is not None:
+        timings.append(('total', time.perf_counter() - started))
+    response.headers['Server-Timing'] = timing.server_timing_header(timings)
+    return response
+
+@bp.teardown_app_request
+def stop_request_timing(exception):
+    timing.stop()
+
+@bp.after_app_request
+def set_session_cookie(response):
+    """Hand out the render session started by the request."""
+    session = flask.g.get('new_session')
+    if session is not None:
+        response.set_cookie(SESSION_COOKIE, session, httponly=True, samesite='Lax')
+    return response
+
 @bp.route("/public/<path:path>")
 def get_public(path):
     """Serve static files from the static directory."""
     return send_from_directory("static", path)
 
+@bp.route("/thumbs/<name>")
+def get_thumbnails(name: str):
+    """Serve a thumbnail sprite sheet, their names change whenever their content does."""
+    thumbnail_dir = config.video_processor.thumbnail_dir()
+    if thumbnail_dir is None or not name.endswith('.jpg'):
+        return "Thumbnails not found", 404
+    response = send_from_directory(thumbnail_dir, name, mimetype='image/jpeg')
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
 @bp.route("/")
+@conditional_page
 def index():
     search = request.args.get("q")
     video_id = request.args.get("video", None, type=int)
     page = request.args.get("page", 0, type=int)
     page_length = request.args.get("page_length", config.default_page_length, type=int)
     highlight = request.args.get("highlight", None, type=str)
+    ranked = request.args.get("mode") == "ranked"
+
+    page_length = max(page_length, 1)
 
     videos = config.video_processor.load_videos()
-    subs = config.video_processor.search_subtitles(search, video_id)
-    sub_pages = [subs[x:x+page_length] for x in range(0, len(subs), page_length)]
-    subs_from_page = sub_pages[page] if sub_pages else []
+    with timing.stage('search'):
+        subs_from_page, total = config.video_processor.search_subtitles_page(search, video_id, page, page_length, ranked)
+    page_count = math.ceil(total / page_length)
 
     hx_request = request.headers.get("HX-Request")
     template = "root.html" if hx_request is None else "subtitles.html"
 
-    return cached_render_template(
-        template,
-        videos=videos,
-        subs=subs_from_page,
-        page_length=page_length,
-        pages=sub_pages,
-        sub_data=None,
-        url=None,
-        oob=hx_request is not None
-    )
+    with metrics.time('subclipper_page_render_seconds'), timing.stage('template'):
+        return cached_render_template(
+            template,
+            videos=videos,
+            subs=subs_from_page,
+            page_length=page_length,
+            page=page,
+            page_count=page_count,
+            sub_data=None,
+            url=None,
+            oob=hx_request is not None,
+            thumbnail=config.video_processor.thumbnail
+        )
+
+@bp.route("/metrics")
+def get_metrics():
+    """Expose the metrics of all worker processes in the Prometheus text format."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @bp.route("/locate/<video_id>/<sub_id>")
 def locate(video_id: str, sub_id: str):
     video_id = int(video_id)
     sub_id = int(sub_id)
     page_length = request.args.get("page_length", config.default_page_length, type=int)
-    subs = config.video_processor.search_subtitles(None, None)
-    sub_pages = [subs[x:x+page_length] for x in range(0, len(subs), page_length)]
-    sub_page = [i for i, page in enumerate(sub_pages) if len([sub for sub in page if sub.id == sub_id and sub.video_id == video_id]) > 0] if sub_pages else []
+    page_length = max(page_length, 1)
+    position = config.video_processor.locate_subtitle(video_id, sub_id)
 
-    if len(sub_page) == 0:
+    if position is None:
         return f"no subtitle with id {sub_id} from video with id {video_id} found", 404
     
     resp = flask.Response("OK")
-    fragment_path = f"/?page={sub_page[0]}&page_length={page_length}#e{video_id}-s{sub_id}"
+    fragment_path = f"/?page={position // page_length}&page_length={page_length}#e{video_id}-s{sub_id}"
     resp.headers['HX-Location'] = json.dumps({"path": fragment_path, "target": "main"})
     resp.status_code = 200
 
@@ -94,11 +325,14 @@ def locate(video_id: str, sub_id: str):
 
 
 @bp.route("/sub_form/<video_id>/<sub_id>")
+@conditional_page
 def get_sub(video_id, sub_id):
     videos = config.video_processor.load_videos()
     try:
-        video = videos[int(video_id)]
-    except (IndexError, ValueError):
+        video = config.video_processor.get_video(int(video_id))
+    except ValueError:
+        video = None
+    if video is None:
         return "Video not found", 404
 
     try:
@@ -127,6 +361,38 @@ def get_sub(video_id, sub_id):
     else:
         return cached_render_template("tweak_modal.html", sub_data=sub_data)
 
+@bp.route("/context/<video_id>/<sub_id>")
+@conditional_page
+def get_context(video_id: str, sub_id: str):
+    """Show the subtitles around a subtitle, for the surrounding lines panel of the tweak modal."""
+    count = min(max(request.args.get("count", 3, type=int), 0), 20)
+    try:
+        subs = config.video_processor.neighbouring_subtitles(int(video_id), int(sub_id), count)
+    except ValueError:
+        subs = None
+    if subs is None:
+        return "Subtitle not found", 404
+
+    return cached_render_template("context.html", subs=subs, current_id=int(sub_id))
+
+@bp.route("/range/<video_id>")
+@conditional_page
+def get_range(video_id: str):
+    """Show the subtitles of a video overlapping the time range between the start and end query parameters."""
+    start = request.args.get("start", type=float)
+    end = request.args.get("end", type=float)
+    if start is None or end is None or end < start:
+        return "start and end times are required, with end not before start", 400
+    try:
+        video = config.video_processor.get_video(int(video_id))
+    except ValueError:
+        video = None
+    if video is None:
+        return "Video not found", 404
+
+    subs = config.video_processor.subtitles_between(video.id, start, end)
+    return cached_render_template("context.html", subs=subs, current_id=None)
+
 @bp.route("/gif_view")
 def get_gif_view():
     settings = create_clip_settings_from_request()
@@ -137,28 +403,127 @@ def get_gif_view():
         resp.headers['HX-Reswap'] = 'outerHTML'
         return resp, 400
 
-    return cached_render_template("gif_view.html", url=f"/gif?{request.query_string.decode()}")
+    try:
+        job = config.render_jobs.submit(settings, session=render_session())
+    except QueueFullError as e:
+        logger.warning(f"Refused render: {e}")
+        return "The server is busy rendering other clips, try again later", 503
+
+    return render_gif_view(job)
+
+@bp.route("/render", methods=["POST"])
+def submit_render():
+    settings = create_clip_settings_from_request()
+
+    errors = settings.validate()
+    if errors:
+        return jsonify({'errors': errors}), 400
+
+    try:
+        # API clients without a session cookie keep all of their renders
+        job = config.render_jobs.submit(settings, session=request.cookies.get(SESSION_COOKIE))
+    except QueueFullError as e:
+        return jsonify({'error': str(e)}), 503
+
+    response = jsonify(job.to_dict())
+    response.headers['Location'] = f"/render/{job.id}"
+    return response, 202
+
+@bp.route("/render/stats")
+def get_render_stats():
+    return jsonify(config.render_jobs.stats())
+
+@bp.route("/render/<job_id>")
+def get_render_job(job_id: str):
+    job = config.render_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': f"no render job with id {job_id} found"}), 404
+    return jsonify(job.to_dict())
+
+@bp.route("/render/<job_id>/result")
+def get_render_result(job_id: str):
+    job = config.render_jobs.get(job_id)
+    if job is None:
+        return f"no render job with id {job_id} found", 404
+    if job.status == FAILED:
+        return job.error, 500
+    if job.status != DONE:
+        return f"render job {job_id} is {job.status}", 409
+
+    response = send_file(job.output_path, mimetype=f'image/{job.output_path.suffix[1:]}', conditional=True, etag=job.id)
+    response.headers['Cache-Control'] = CLIP_CACHE_CONTROL
+    return response
+
+@bp.route("/render/<job_id>/view")
+def get_render_view(job_id: str):
+    job = config.render_jobs.get(job_id)
+    if job is None:
+        # The job is unknown to this worker process and its clip is not cached, so render it here
+        settings = create_clip_settings_from_request()
+        if settings.validate():
+            return f"no render job with id {job_id} found", 404
+        try:
+            job = config.render_jobs.submit(settings, session=render_session())
+        except QueueFullError:
+            return "The server is busy rendering other clips, try again later", 503
+
+    return render_gif_view(job)
+
+@bp.route("/export", methods=["GET", "POST"])
+def export_clips():
+    """Export many clips at once as a zip archive, streamed while the clips are being rendered.
+
+    A JSON body lists the settings of every clip under `clips`, with the same names as the query parameters
+    of /gif. Otherwise a clip is exported for every result of the search `q`.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        body = {}
+    values = CombinedMultiDict([MultiDict({key: value for key, value in body.items() if key != 'clips'}), request.values])
+    try:
+        clips = export_clip_settings(values, body.get('clips'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not clips:
+        return jsonify({'error': "nothing to export"}), 400
+    if len(clips) > config.export_max_clips:
+        return jsonify({'error': f"at most {config.export_max_clips} clips can be exported at once"}), 400
+
+    results = config.video_processor.export_clips(clips, workers=config.export_workers)
+
+    def generate():
+        try:
+            files = ((export_name(position, clips[position]), output_path, error) for position, output_path, error in results)
+            yield from stream_zip(files, config.video_processor.release_clip)
+        finally:
+            # Stops the renders when the client goes away before the archive is complete
+            results.close()
+
+    response = Response(generate(), mimetype='application/zip')
+    response.headers['Content-Disposition'] = 'attachment; filename="clips.zip"'
+    return response
 
 @bp.route("/gif")
 def get_gif():
     settings = create_clip_settings_from_request()
 
-    output_path, error = config.video_processor.generate_clip(settings)
+    # The clip key covers the settings, the video and the font, so an unchanged key means an unchanged clip
+    with timing.stage('etag'):
+        etag = config.video_processor.clip_key(settings)
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        return not_modified(etag, CLIP_CACHE_CONTROL)
+
+    output_path, error = config.video_processor.generate_clip(settings, cancellation=client_disconnected(request.environ))
     if error:
         logger.warning(f"Failed to generate clip: {error}")
         return error, 500
 
     try:
-        response = send_file(output_path, mimetype=f'image/{settings.format}')
-        response.headers['Cache-Control'] = 'public, max-age=86400'
+        with timing.stage('send_file'):
+            # Conditional responses also answer range requests, so large clips can be resumed
+            response = send_file(output_path, mimetype=f'image/{settings.format}', conditional=True, etag=etag if etag is not None else True)
+        response.headers['Cache-Control'] = CLIP_CACHE_CONTROL
         return response
     finally:
-        # Clean up the temporary directory and its contents
-        if output_path and output_path.exists():
-            tmp_dir = output_path.parent
-            try:
-                output_path.unlink()
-                (tmp_dir / 'clip.mp4').unlink(missing_ok=True)
-                tmp_dir.rmdir()
-            except Exception as e:
-                logger.warning(f"Failed to clean up temporary files: {e}")
+        # Clean up the temporary files, cached clips are kept for the next request
+        config.video_processor.release_clip(output_path)
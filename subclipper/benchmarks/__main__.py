@@ -0,0 +1,240 @@
+"""Benchmarks of the hot paths of subclipper on synthetic libraries.
+
+Every library size runs in its own process, so peak memory is measured per size. For example:
+
+    python -m subclipper.benchmarks --sizes 10000 100000 --output results.json --baseline baseline.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from .library import generate_library
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+# Differences below this are noise, however large they are relatively
+MIN_REGRESSION_SECONDS = 0.002
+# Starts a worker process like gunicorn does, and reports how long it took until it could serve requests
+STARTUP_SCRIPT = """
+import json, time, tracemalloc
+start = time.perf_counter()
+from subclipper.app import create_app
+from subclipper.app.routes import config
+create_app()
+config.video_processor
+print(json.dumps({'seconds': time.perf_counter() - start, 'peak_bytes': tracemalloc.get_traced_memory()[1]}))
+"""
+
+def measure(fn: Callable[[], object], repeat: int) -> dict:
+    """Time `fn`, then run it once more under tracemalloc for its peak memory, which would skew the timings."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'seconds': statistics.median(timings),
+        'min_seconds': min(timings),
+        'runs': repeat,
+        'peak_bytes': peak,
+    }
+
+def measure_startup(repeat: int) -> dict:
+    """Time starting a fresh process up to serving requests, from importing the app to loading the library."""
+    def start(*options: str) -> dict:
+        process = subprocess.run([sys.executable, *options, '-c', STARTUP_SCRIPT], stdout=subprocess.PIPE, check=True)
+        return json.loads(process.stdout.decode().splitlines()[-1])
+
+    # The first start writes the subtitle store, like the first worker process of a deployment does
+    start()
+    timings = [start()['seconds'] for _ in range(repeat)]
+    return {
+        'seconds': statistics.median(timings),
+        'min_seconds': min(timings),
+        'runs': repeat,
+        'peak_bytes': start('-X', 'tracemalloc')['peak_bytes'],
+    }
+
+def run_size(size: int, repeat: int, seed: int) -> dict:
+    """Benchmark a single library size, in a fresh process."""
+    work_dir = Path(tempfile.mkdtemp(prefix='subclipper-bench-'))
+    try:
+        search_path = work_dir / 'library'
+        cache_dir = work_dir / 'cache'
+        video_count = generate_library(search_path, cache_dir, size, seed)
+
+        os.environ.update({
+            'SEARCH_PATH': str(search_path),
+            'SHOW_NAME': 'Benchmark',
+            'CACHE_DIR': str(cache_dir),
+            'THUMBNAILS': 'false',
+            'RESCAN_INTERVAL': '0',
+            # The synthetic videos are not real videos, there are no keyframes to probe
+            'SEGMENT_CACHE_SIZE_MB': '0',
+            # Page renders are timed without the page cache, and with it by the cached variants
+            'PAGE_CACHE_SIZE_MB': '0',
+        })
+        from ..app import create_app
+        from ..app.routes import config
+        from ..core.fragment_cache import FragmentCache
+        from ..core.video_processor import VideoProcessor
+        app = create_app()
+        logging.getLogger().setLevel(logging.WARNING)
+        client = app.test_client()
+
+        def new_processor() -> VideoProcessor:
+            return VideoProcessor(search_path, config.font_path, cache_dir)
+
+        def load_cold():
+            shutil.rmtree(cache_dir / 'store', ignore_errors=True)
+            new_processor().load_videos()
+
+        results = {
+            'startup': measure_startup(repeat),
+            'load_cold': measure(load_cold, repeat),
+            'load_warm': measure(lambda: new_processor().load_videos(), repeat),
+        }
+
+        processor = config.video_processor
+        page_length = config.default_page_length
+        _, total = processor.search_subtitles_page(None, None, 0, page_length)
+        last_page = (total - 1) // page_length
+        rng = random.Random(seed)
+        videos = processor.load_videos()
+        sample = [(video.id, rng.randrange(len(video.subs))) for video in rng.choices(videos, k=1000)]
+        windows = [(video.id, rng.uniform(0, 1500)) for video in rng.choices(videos, k=1000)]
+
+        def hx_get(path: str):
+            response = client.get(path, headers={'HX-Request': 'true'})
+            assert response.status_code == 200, response.status_code
+
+        page_cache = FragmentCache(32 * 1024 * 1024)
+
+        def cached_hx_get(path: str):
+            config._page_cache = page_cache
+            try:
+                hx_get(path)
+            finally:
+                config._page_cache = None
+
+        benchmarks: Dict[str, Callable[[], object]] = {
+            'search_common_word': lambda: processor.search_subtitles_page("you", None, 0, page_length),
+            'search_rare_word': lambda: processor.search_subtitles_page("wormhole", None, 0, page_length),
+            'search_no_match': lambda: processor.search_subtitles_page("qqqzz", None, 0, page_length),
+            'search_short_query': lambda: processor.search_subtitles_page("oh", None, 0, page_length),
+            'search_ranked_common_word': lambda: processor.search_subtitles_page("you", None, 0, page_length, ranked=True),
+            'search_ranked_phrase': lambda: processor.search_subtitles_page('"the captain"', None, 0, page_length, ranked=True),
+            'search_ranked_typo': lambda: processor.search_subtitles_page("wormhoel", None, 0, page_length, ranked=True),
+            'search_last_page': lambda: processor.search_subtitles_page(None, None, last_page, page_length),
+            'locate_1000': lambda: [processor.locate_subtitle(video_id, sub_id) for video_id, sub_id in sample],
+            'time_range_1000': lambda: [processor.subtitles_between(video_id, t, t + 10) for video_id, t in windows],
+            'render_first_page': lambda: hx_get('/'),
+            'render_last_page': lambda: hx_get(f'/?page={last_page}'),
+            'render_search': lambda: hx_get('/?q=captain'),
+            'render_first_page_cached': lambda: cached_hx_get('/'),
+            'render_search_cached': lambda: cached_hx_get('/?q=captain'),
+        }
+        for name, fn in benchmarks.items():
+            results[name] = measure(fn, repeat)
+
+        max_rss = None
+        if resource is not None:
+            # Kilobytes on Linux, bytes on macOS
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        return {'size': size, 'videos': video_count, 'max_rss_bytes': max_rss, 'benchmarks': results}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """List the benchmarks that got slower or use more memory than in the baseline, beyond the tolerance."""
+    regressions = []
+    baseline_sizes = {entry['size']: entry['benchmarks'] for entry in baseline.get('results', [])}
+    for entry in results['results']:
+        previous = baseline_sizes.get(entry['size'])
+        if previous is None:
+            continue
+        for name, result in entry['benchmarks'].items():
+            before = previous.get(name)
+            if before is None:
+                continue
+            # The fastest run is the least affected by whatever else the machine is doing
+            slower = result['min_seconds'] - before['min_seconds']
+            if result['min_seconds'] > before['min_seconds'] * (1 + tolerance) and slower > MIN_REGRESSION_SECONDS:
+                regressions.append(f"{name} at {entry['size']} subtitles: {before['min_seconds'] * 1000:.1f} ms -> {result['min_seconds'] * 1000:.1f} ms")
+            if result['peak_bytes'] > before['peak_bytes'] * (1 + tolerance):
+                regressions.append(f"{name} at {entry['size']} subtitles: peak memory {before['peak_bytes']} -> {result['peak_bytes']} bytes")
+    return regressions
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m subclipper.benchmarks', description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='library sizes in subtitles')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=Path, help='write the results to this JSON file')
+    parser.add_argument('--baseline', type=Path, help='fail if the results regress past this earlier results file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown relative to the baseline')
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker is not None:
+        json.dump(run_size(args.worker, args.repeat, args.seed), sys.stdout)
+        return 0
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': [],
+    }
+    for size in args.sizes:
+        logger.info(f"Benchmarking a library of {size} subtitles")
+        worker = subprocess.run(
+            [sys.executable, '-m', 'subclipper.benchmarks', '--worker', str(size), '--repeat', str(args.repeat), '--seed', str(args.seed)],
+            stdout=subprocess.PIPE,
+            check=True,
+        )
+        entry = json.loads(worker.stdout)
+        results['results'].append(entry)
+        for name, result in entry['benchmarks'].items():
+            logger.info(f"  {name:<20} {result['seconds'] * 1000:10.2f} ms {result['peak_bytes'] / 1024 / 1024:10.2f} MiB peak")
+
+    if args.output is not None:
+        args.output.write_text(json.dumps(results, indent=2))
+        logger.info(f"Wrote results to {args.output}")
+
+    if args.baseline is not None:
+        regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance)
+        for regression in regressions:
+            logger.error(f"Regression: {regression}")
+        if regressions:
+            return 1
+        logger.info(f"No regressions compared to {args.baseline}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,73 @@
+import logging
+import random
+from pathlib import Path
+from typing import List
+
+from ..core.catalog import SubtitleCatalog, SubtitleEvent
+
+logger = logging.getLogger(__name__)
+
+# Lines of a typical episode, and so roughly the amount of subtitles per video file
+EVENTS_PER_VIDEO = 400
+
+_COMMON_WORDS = (
+    "the you i to a and it is that what of in me this we he no do not my your be have on know for was just "
+    "are with all can get here don't so there right yeah oh out up go now come like okay well think about him "
+    "how they one her she want at from see if got who let's good time back why did going then look tell"
+).split()
+_RARE_WORDS = (
+    "captain ship planet engine reactor treaty signal wormhole hyperdrive colony admiral sensor shield "
+    "nebula asteroid docking bay transmission protocol ambassador council station anomaly cargo freighter "
+    "starboard quantum distress beacon shuttle hull breach coordinates orbit telemetry mutiny smuggler "
+    "Straße über café naïve déjà résumé"
+).split()
+_PUNCTUATION = ['.', '.', '.', '?', '!', '...', ',']
+
+def _line(rng: random.Random) -> str:
+    words = []
+    for _ in range(rng.randint(2, 12)):
+        # Dialogue is mostly common words, with a Zipf-like tail of rarer ones
+        if rng.random() < 0.85:
+            words.append(_COMMON_WORDS[min(int(rng.paretovariate(1.2)) - 1, len(_COMMON_WORDS) - 1)])
+        else:
+            words.append(rng.choice(_RARE_WORDS))
+    text = ' '.join(words)
+    text = text[0].upper() + text[1:] + rng.choice(_PUNCTUATION)
+    if len(words) > 7 and rng.random() < 0.5:
+        # Long lines are split over two lines like real subtitles
+        middle = text.index(' ', len(text) // 2)
+        text = text[:middle] + '\\N' + text[middle + 1:]
+    if rng.random() < 0.05:
+        text = '{\\i1}' + text + '{\\i0}'
+    return text
+
+def synthetic_events(rng: random.Random, count: int) -> List[SubtitleEvent]:
+    """Generate the subtitle events of one video, mostly in order with the occasional overlap."""
+    events = []
+    time = rng.uniform(0, 5)
+    for _ in range(count):
+        duration = rng.uniform(0.8, 5.0)
+        events.append((round(time, 3), round(time + duration, 3), _line(rng)))
+        time += duration + rng.expovariate(1 / 1.5) - (1.0 if rng.random() < 0.05 else 0.0)
+        time = max(time, 0.0)
+    return events
+
+def generate_library(search_path: Path, cache_dir: Path, event_count: int, seed: int = 0) -> int:
+    """Create a synthetic library of placeholder video files, with their subtitles already in the catalog.
+
+    Returns the amount of videos. Loading the library only reads the catalog, subtitles are never extracted.
+    """
+    rng = random.Random(seed)
+    search_path.mkdir(parents=True, exist_ok=True)
+    catalog = SubtitleCatalog(cache_dir / 'catalog.sqlite3')
+    video_count = max(event_count // EVENTS_PER_VIDEO, 1)
+    try:
+        for idx in range(video_count):
+            video_path = search_path / f'Synthetic Show S{idx // 20 + 1:02d}E{idx % 20 + 1:02d}.mkv'
+            video_path.write_bytes(idx.to_bytes(4, 'little'))
+            count = event_count // video_count + (1 if idx < event_count % video_count else 0)
+            catalog.put(video_path, video_path.stat(), synthetic_events(rng, count))
+    finally:
+        catalog.close()
+    logger.info(f"Generated a synthetic library of {event_count} subtitles in {video_count} videos")
+    return video_count
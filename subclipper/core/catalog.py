@@ -0,0 +1,204 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# (start, end, text) with start and end in seconds
+SubtitleEvent = Tuple[float, float, str]
+
+class SubtitleCatalog:
+    """On-disk catalog of extracted subtitles and keyframe times, keyed by video path, size and mtime."""
+
+    SCHEMA_VERSION = 3
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = self._open()
+        logger.info(f"Opened subtitle catalog at {path}")
+
+    def _open(self) -> sqlite3.Connection:
+        """Open the catalog database, rebuilding it if it is corrupt or has an outdated schema."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            return self._connect()
+        except sqlite3.DatabaseError as e:
+            logger.warning(f"Subtitle catalog {self.path} is unreadable, rebuilding it: {e}")
+            self.path.unlink(missing_ok=True)
+            return self._connect()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version in (1, 2):
+                # Older versions only lacked the video ids and keyframes, the extracted subtitles are still valid
+                logger.info(f"Upgrading subtitle catalog schema ({version} -> {self.SCHEMA_VERSION})")
+                with conn:
+                    if version == 1:
+                        self._create_video_ids(conn)
+                    self._create_keyframes(conn)
+                    conn.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+            elif version != self.SCHEMA_VERSION:
+                if version != 0:
+                    logger.info(f"Subtitle catalog schema changed ({version} -> {self.SCHEMA_VERSION}), rebuilding")
+                with conn:
+                    conn.execute('DROP TABLE IF EXISTS videos')
+                    conn.execute('DROP TABLE IF EXISTS video_ids')
+                    conn.execute('DROP TABLE IF EXISTS keyframes')
+                    conn.execute(
+                        'CREATE TABLE videos ('
+                        ' path TEXT PRIMARY KEY,'
+                        ' size INTEGER NOT NULL,'
+                        ' mtime_ns INTEGER NOT NULL,'
+                        ' events TEXT NOT NULL'
+                        ')'
+                    )
+                    self._create_video_ids(conn)
+                    self._create_keyframes(conn)
+                    conn.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+        except sqlite3.DatabaseError:
+            conn.close()
+            raise
+        return conn
+
+    def _create_video_ids(self, conn: sqlite3.Connection):
+        # Ids are never pruned, so a removed video gets its old id back when it returns and ids are never reused
+        conn.execute(
+            'CREATE TABLE video_ids ('
+            ' path TEXT PRIMARY KEY,'
+            ' id INTEGER NOT NULL UNIQUE'
+            ')'
+        )
+
+    def _create_keyframes(self, conn: sqlite3.Connection):
+        conn.execute(
+            'CREATE TABLE keyframes ('
+            ' path TEXT PRIMARY KEY,'
+            ' size INTEGER NOT NULL,'
+            ' mtime_ns INTEGER NOT NULL,'
+            ' times TEXT NOT NULL'
+            ')'
+        )
+
+    def _reset(self):
+        """Throw away the catalog after it turned out to be corrupt."""
+        logger.warning(f"Subtitle catalog {self.path} is corrupt, rebuilding it")
+        self._conn.close()
+        self.path.unlink(missing_ok=True)
+        self._conn = self._connect()
+
+    def get(self, video_path: Path, stat: os.stat_result) -> Optional[List[SubtitleEvent]]:
+        """Get the cached subtitles of a video, or None if it is unknown or has changed since."""
+        with self._lock:
+            try:
+                row = self._conn.execute(
+                    'SELECT size, mtime_ns, events FROM videos WHERE path = ?',
+                    (str(video_path),)
+                ).fetchone()
+                if row is None:
+                    return None
+                size, mtime_ns, events = row
+                if size != stat.st_size or mtime_ns != stat.st_mtime_ns:
+                    logger.debug(f"Catalog entry for {video_path} is stale")
+                    return None
+                return [(start, end, text) for start, end, text in json.loads(events)]
+            except (sqlite3.DatabaseError, ValueError, TypeError):
+                self._reset()
+                return None
+
+    def put(self, video_path: Path, stat: os.stat_result, events: List[SubtitleEvent]):
+        """Store the subtitles of a video, replacing any previous entry."""
+        with self._lock:
+            try:
+                with self._conn:
+                    self._conn.execute(
+                        'INSERT OR REPLACE INTO videos (path, size, mtime_ns, events) VALUES (?, ?, ?, ?)',
+                        (str(video_path), stat.st_size, stat.st_mtime_ns, json.dumps(events, separators=(',', ':')))
+                    )
+            except sqlite3.DatabaseError:
+                self._reset()
+
+    def get_keyframes(self, video_path: Path, stat: os.stat_result) -> Optional[List[float]]:
+        """Get the keyframe times of a video, or None if they are unknown or the video has changed since."""
+        with self._lock:
+            try:
+                row = self._conn.execute(
+                    'SELECT size, mtime_ns, times FROM keyframes WHERE path = ?',
+                    (str(video_path),)
+                ).fetchone()
+                if row is None:
+                    return None
+                size, mtime_ns, times = row
+                if size != stat.st_size or mtime_ns != stat.st_mtime_ns:
+                    return None
+                return [float(time) for time in json.loads(times)]
+            except (sqlite3.DatabaseError, ValueError, TypeError):
+                self._reset()
+                return None
+
+    def put_keyframes(self, video_path: Path, stat: os.stat_result, times: List[float]):
+        """Store the keyframe times of a video, replacing any previous entry."""
+        with self._lock:
+            try:
+                with self._conn:
+                    self._conn.execute(
+                        'INSERT OR REPLACE INTO keyframes (path, size, mtime_ns, times) VALUES (?, ?, ?, ?)',
+                        (str(video_path), stat.st_size, stat.st_mtime_ns, json.dumps(times, separators=(',', ':')))
+                    )
+            except sqlite3.DatabaseError:
+                self._reset()
+
+    def video_ids(self, video_paths: List[Path]) -> Dict[Path, int]:
+        """Get the persistent ids of videos, assigning new ids to videos that do not have one yet.
+
+        A new catalog numbers the videos in the given order, later videos get ids after the highest id so far.
+        """
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    with self._conn:
+                        # Take the write lock before reading, so worker processes never hand out the same id twice
+                        self._conn.execute('BEGIN IMMEDIATE')
+                        ids = {Path(path): video_id for path, video_id in self._conn.execute('SELECT path, id FROM video_ids')}
+                        next_id = max(ids.values(), default=-1) + 1
+                        new = []
+                        for video_path in video_paths:
+                            if video_path not in ids:
+                                ids[video_path] = next_id
+                                new.append((str(video_path), next_id))
+                                next_id += 1
+                        if new:
+                            self._conn.executemany('INSERT INTO video_ids (path, id) VALUES (?, ?)', new)
+                            logger.info(f"Assigned ids to {len(new)} new videos")
+                    return {video_path: ids[video_path] for video_path in video_paths}
+                except sqlite3.DatabaseError:
+                    if attempt:
+                        raise
+                    self._reset()
+
+    def prune(self, video_paths: Iterable[Path]):
+        """Remove the entries of all videos that are not in `video_paths`."""
+        keep = {str(p) for p in video_paths}
+        with self._lock:
+            try:
+                stored = [row[0] for row in self._conn.execute('SELECT path FROM videos')]
+                removed = [(p,) for p in stored if p not in keep]
+                stored_keyframes = [row[0] for row in self._conn.execute('SELECT path FROM keyframes')]
+                removed_keyframes = [(p,) for p in stored_keyframes if p not in keep]
+                if removed or removed_keyframes:
+                    with self._conn:
+                        self._conn.executemany('DELETE FROM videos WHERE path = ?', removed)
+                        self._conn.executemany('DELETE FROM keyframes WHERE path = ?', removed_keyframes)
+                    logger.info(f"Removed {len(removed)} stale entries from the subtitle catalog")
+            except sqlite3.DatabaseError:
+                self._reset()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
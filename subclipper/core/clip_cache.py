@@ -0,0 +1,145 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+
+from .metrics import metrics
+from .models import ClipSettings
+
+logger = logging.getLogger(__name__)
+
+TMP_SUFFIX = '.tmp'
+CLIP_NAME = re.compile(r'^([0-9a-f]{32})\.(gif|webp)$')
+# Temporary files older than this were left behind by a crashed render
+STALE_TMP_SECONDS = 3600
+
+def file_identity(path: Path) -> dict:
+    """Describe a file by its path, size and mtime, so a changed file gets a different cache key."""
+    stat = path.stat()
+    return {'path': str(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def clip_cache_key(settings: ClipSettings, video_path: Path, font_path: Path) -> str:
+    """Get the cache key of a clip, derived from everything that affects the rendered output."""
+    identity = {
+        'settings': settings.normalized(),
+        'video': file_identity(video_path),
+        'font': file_identity(font_path),
+    }
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()[:32]
+
+def clip_name(key: str, format: str) -> str:
+    """Get the file name of a cached clip, which also identifies the clip across worker processes."""
+    return f'{key}.{format}'
+
+class ClipCache:
+    """Disk cache of rendered clips, bounded in size by evicting the least recently used clips.
+
+    The caches of segments and masters are ClipCaches too, `name` tells them apart in the metrics.
+    """
+
+    def __init__(self, root: Path, max_bytes: int, name: str = 'clips'):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self.root.mkdir(parents=True, exist_ok=True)
+        logger.info(f"Initialized ClipCache at {root} with a budget of {max_bytes} bytes")
+
+    def path(self, key: str, format: str) -> Path:
+        return self.root / clip_name(key, format)
+
+    def get(self, key: str, format: str) -> Optional[Path]:
+        """Get a cached clip, marking it as recently used, or None if it is not cached."""
+        path = self.path(key, format)
+        try:
+            # The mtime doubles as the last access time for the LRU eviction, which is shared by all processes
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            metrics.inc('subclipper_clip_cache_requests_total', {'cache': self.name, 'result': 'miss'})
+            logger.debug(f"Clip cache miss for {key}.{format}")
+            return None
+        with self._lock:
+            self.hits += 1
+        metrics.inc('subclipper_clip_cache_requests_total', {'cache': self.name, 'result': 'hit'})
+        logger.debug(f"Clip cache hit for {key}.{format}")
+        return path
+
+    def find(self, name: str) -> Optional[Path]:
+        """Get a cached clip by its file name, as returned by `clip_name`."""
+        match = CLIP_NAME.match(name)
+        if match is None:
+            return None
+        return self.get(match.group(1), match.group(2))
+
+    def temporary_path(self, key: str, format: str) -> Path:
+        """Get a unique path inside the cache to write a clip to before it is committed."""
+        return self.root / f'{key}.{format}.{uuid.uuid4().hex}{TMP_SUFFIX}'
+
+    def put(self, key: str, format: str, source: Path) -> Path:
+        """Move a rendered clip into the cache, atomically replacing any previous version."""
+        path = self.path(key, format)
+        if source.parent != self.root:
+            tmp_path = self.temporary_path(key, format)
+            shutil.move(source, tmp_path)
+            source = tmp_path
+        # Readers only ever see complete files, since the rename is atomic within the cache directory
+        os.replace(source, path)
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep: Optional[Path] = None):
+        """Remove the least recently used clips until the cache fits in its budget."""
+        entries = []
+        total = 0
+        now = time.time()
+        for entry in os.scandir(self.root):
+            if not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+                if entry.name.endswith(TMP_SUFFIX):
+                    if now - stat.st_mtime > STALE_TMP_SECONDS:
+                        os.unlink(entry.path)
+                    continue
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, Path(entry.path)))
+            total += stat.st_size
+
+        if total <= self.max_bytes:
+            return
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            with self._lock:
+                self.evictions += 1
+            metrics.inc('subclipper_clip_cache_evictions_total', {'cache': self.name})
+            logger.debug(f"Evicted {path.name} from the clip cache")
+
+    def contains(self, path: Path) -> bool:
+        return path.parent == self.root
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
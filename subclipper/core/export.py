@@ -0,0 +1,81 @@
+import io
+import logging
+import zipfile
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .models import ClipSettings
+
+logger = logging.getLogger(__name__)
+
+# Clips further apart than this are rendered separately, decoding the gap between them would cost more than seeking
+MAX_BATCH_GAP_SECONDS = 30.0
+# Every clip of a batch holds its own filter chain and output in the same ffmpeg process
+MAX_BATCH_CLIPS = 16
+
+def plan_batches(clips: Iterable[Tuple[int, ClipSettings]]) -> List[List[Tuple[int, ClipSettings]]]:
+    """Group numbered clips into batches of clips of the same video that are close together, in time order."""
+    by_video: Dict[int, List[Tuple[int, ClipSettings]]] = {}
+    for position, settings in clips:
+        by_video.setdefault(settings.episode, []).append((position, settings))
+
+    batches = []
+    for video_clips in by_video.values():
+        video_clips.sort(key=lambda clip: (clip[1].start_time, clip[1].end_time))
+        batch: List[Tuple[int, ClipSettings]] = []
+        batch_end = 0.0
+        for position, settings in video_clips:
+            if batch and (settings.start_time - batch_end > MAX_BATCH_GAP_SECONDS or len(batch) >= MAX_BATCH_CLIPS):
+                batches.append(batch)
+                batch = []
+            if not batch:
+                batch_end = settings.end_time
+            batch.append((position, settings))
+            batch_end = max(batch_end, settings.end_time)
+        batches.append(batch)
+    return batches
+
+def export_name(position: int, settings: ClipSettings) -> str:
+    """Name the file of an exported clip, so the clips of an export sort in the order they were asked for."""
+    return f"{position + 1:04d}-{settings.episode}-{settings.start_time:.2f}.{settings.format}"
+
+class ZipStream(io.RawIOBase):
+    """A write-only stream that collects what is written to it until it is drained."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def stream_zip(files: Iterable[Tuple[str, Optional[Path], Optional[str]]], release: Callable[[Path], None]) -> Iterator[bytes]:
+    """Stream a zip archive of files as they become available, releasing every file once it is archived.
+
+    `files` yields the name of every file with either its path or the error that kept it from being made, the
+    errors are listed in `errors.txt`. Only one file is held in memory at a time.
+    """
+    stream = ZipStream()
+    errors = []
+    # The files are gifs and webps, which are compressed already
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for name, path, error in files:
+            if path is None:
+                errors.append(f"{name}: {error}")
+                continue
+            try:
+                archive.write(path, name)
+            finally:
+                release(path)
+            yield stream.drain()
+        if errors:
+            archive.writestr('errors.txt', '\n'.join(errors) + '\n')
+    yield stream.drain()
@@ -0,0 +1,56 @@
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class FragmentCache:
+    """In-memory LRU cache of rendered pages and fragments, capped at `max_bytes` of content.
+
+    Entries belong to a library version. Looking up or storing an entry for another version drops all entries
+    of the previous one, so pages are never served from a library that changed.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: 'OrderedDict[str, Tuple[bytes, str]]' = OrderedDict()
+        self._bytes = 0
+        self._version: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def _use_version(self, version: str):
+        if version != self._version:
+            if self._entries:
+                logger.info(f"Dropping {len(self._entries)} cached pages of library version {self._version}")
+            self._entries.clear()
+            self._bytes = 0
+            self._version = version
+
+    def get(self, version: str, key: str) -> Optional[Tuple[bytes, str]]:
+        """Get the body and mimetype of a cached page."""
+        with self._lock:
+            self._use_version(version)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, version: str, key: str, body: bytes, mimetype: str):
+        """Cache a page, evicting the least recently used pages when the cache is full."""
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            self._use_version(version)
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous[0])
+            self._entries[key] = (body, mimetype)
+            self._bytes += len(body)
+            while self._bytes > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes, 'max_bytes': self.max_bytes}
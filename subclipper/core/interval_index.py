@@ -0,0 +1,51 @@
+import logging
+from array import array
+from bisect import bisect_right
+from typing import List, Sequence
+
+logger = logging.getLogger(__name__)
+
+class IntervalIndex:
+    """Time-range queries over the subtitles of a single video.
+
+    Subtitles are ordered by start time. Alongside the sorted start times a running maximum of the end
+    times is kept, so the scan for overlapping subtitles stops as soon as no earlier subtitle can reach
+    the queried range, even if some subtitles are much longer than others.
+    """
+
+    def __init__(self, starts: Sequence[float], ends: Sequence[float]):
+        # Positions of the subtitles sorted by start time, ties keep their original order
+        self.order = array('I', sorted(range(len(starts)), key=starts.__getitem__))
+        self.starts = array('d', (starts[pos] for pos in self.order))
+        self.max_ends = array('d')
+        max_end = float('-inf')
+        for pos in self.order:
+            max_end = max(max_end, ends[pos])
+            self.max_ends.append(max_end)
+        self._ends = ends
+        # Where every subtitle ended up in the sorted order
+        self.ranks = array('I', bytes(4 * len(self.order)))
+        for rank, pos in enumerate(self.order):
+            self.ranks[pos] = rank
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def overlapping(self, start: float, end: float) -> List[int]:
+        """Get the positions of all subtitles overlapping [start, end], ordered by start time."""
+        if end < start:
+            return []
+        positions = []
+        rank = bisect_right(self.starts, end) - 1
+        while rank >= 0 and self.max_ends[rank] >= start:
+            pos = self.order[rank]
+            if self._ends[pos] >= start:
+                positions.append(pos)
+            rank -= 1
+        positions.reverse()
+        return positions
+
+    def neighbours(self, pos: int, count: int) -> List[int]:
+        """Get the positions of up to `count` subtitles before and after the one at `pos`, including it."""
+        rank = self.ranks[pos]
+        return list(self.order[max(rank - count, 0):rank + count + 1])
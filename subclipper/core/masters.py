@@ -0,0 +1,68 @@
+import hashlib
+import json
+import logging
+from pathlib import Path
+from typing import Optional, Tuple
+
+from .clip_cache import ClipCache, file_identity
+from .models import ClipSettings
+
+logger = logging.getLogger(__name__)
+
+MASTER_FORMAT = 'mkv'
+
+def master_key(settings: ClipSettings, video_path: Path) -> str:
+    """Get the key of the master rendition of a clip, which only depends on the part of the video it shows."""
+    identity = {
+        'video': file_identity(video_path),
+        'start_time': round(settings.start_time, 3),
+        'end_time': round(settings.end_time, 3),
+    }
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()[:32]
+
+def master_resolution(resolution: int) -> int:
+    """The resolution of a master that clips of `resolution` can be derived from, which has to be even for x264."""
+    return resolution + resolution % 2
+
+class MasterCache:
+    """Disk cache of master renditions: the frames of a clip without text, at the largest resolution asked for so far.
+
+    A master is named after its key and resolution. Storing a larger master removes the smaller ones of the
+    same key, and the least recently used masters are evicted like clips are.
+    """
+
+    def __init__(self, root: Path, max_bytes: int):
+        self._cache = ClipCache(root, max_bytes, name='masters')
+        self.root = root
+
+    @staticmethod
+    def _format(resolution: int) -> str:
+        return f'{resolution}.{MASTER_FORMAT}'
+
+    def _masters(self, key: str):
+        for path in self.root.glob(f'{key}.*.{MASTER_FORMAT}'):
+            try:
+                yield int(path.name.split('.')[1]), path
+            except ValueError:
+                continue
+
+    def find(self, key: str, resolution: int) -> Optional[Tuple[Path, int]]:
+        """Get the master of `key` with its resolution, if there is one of at least `resolution`."""
+        resolutions = sorted(master for master, _ in self._masters(key) if master >= resolution)
+        for master in resolutions:
+            path = self._cache.get(key, self._format(master))
+            if path is not None:
+                return path, master
+        return None
+
+    def temporary_path(self, key: str, resolution: int) -> Path:
+        return self._cache.temporary_path(key, self._format(resolution))
+
+    def put(self, key: str, resolution: int, source: Path) -> Path:
+        """Store a master, replacing the smaller masters of the same key."""
+        path = self._cache.put(key, self._format(resolution), source)
+        for master, old_path in list(self._masters(key)):
+            if master < resolution:
+                old_path.unlink(missing_ok=True)
+                logger.debug(f"Replaced master {old_path.name} with {path.name}")
+        return path
@@ -0,0 +1,335 @@
+import atexit
+import json
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows, where exited processes are never detected
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+# Holds the counters and histograms of processes that exited, so their files can be removed
+TOTALS_FILE = 'exited.json'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Name, help text and, for gauges, how the values of worker processes are combined
+HISTOGRAMS = {
+    'subclipper_subtitle_extraction_seconds': 'Time spent extracting the subtitles of a video.',
+    'subclipper_search_seconds': 'Time spent searching subtitles.',
+    'subclipper_page_render_seconds': 'Time spent rendering the subtitle list.',
+    'subclipper_clip_render_seconds': 'Time spent rendering a clip, by format and resolution.',
+    'subclipper_batch_render_seconds': 'Time spent rendering a batch of exported clips in a single pass.',
+}
+COUNTERS = {
+    'subclipper_render_errors_total': 'Clip renders that failed, by format.',
+    'subclipper_renders_cancelled_total': 'Clip renders whose ffmpeg process was terminated, by reason.',
+    'subclipper_page_cache_requests_total': 'Page renders looked up in the page cache, by result.',
+    'subclipper_clip_cache_requests_total': 'Lookups in the clip, segment and master caches, by cache and result.',
+    'subclipper_clip_cache_evictions_total': 'Files evicted from the clip, segment and master caches, by cache.',
+    'subclipper_clip_renders_total': 'Clip renders that succeeded, by the source they were rendered from.',
+}
+GAUGES = {
+    # Every worker process loads the same library
+    'subclipper_subtitles_loaded': ('Subtitles in the loaded library.', 'max'),
+    'subclipper_renders_in_flight': ('Clips being rendered right now.', 'sum'),
+}
+
+def _label_key(labels: Optional[Dict[str, object]]) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in (labels or {}).items()))
+
+def _format_labels(key: LabelKey, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+def _process_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+    if os.name == 'nt':
+        # os.kill would terminate the process on Windows
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _combine(snapshots: List[dict]) -> Tuple[Dict[str, Dict[LabelKey, float]], Dict[str, Dict[LabelKey, float]], Dict[str, Dict[LabelKey, List[float]]]]:
+    """Add up the counters and histograms of snapshots, and combine the gauges of the live processes."""
+    counters: Dict[str, Dict[LabelKey, float]] = {}
+    gauges: Dict[str, Dict[LabelKey, float]] = {}
+    histograms: Dict[str, Dict[LabelKey, List[float]]] = {}
+    for snapshot in snapshots:
+        for name, series in snapshot['counters'].items():
+            values = counters.setdefault(name, {})
+            for key, value in series:
+                key = tuple(tuple(pair) for pair in key)
+                values[key] = values.get(key, 0) + value
+        if snapshot['pid'] is not None and _process_alive(snapshot['pid']):
+            for name, series in snapshot['gauges'].items():
+                combine = max if GAUGES.get(name, ('', 'sum'))[1] == 'max' else (lambda a, b: a + b)
+                values = gauges.setdefault(name, {})
+                for key, value in series:
+                    key = tuple(tuple(pair) for pair in key)
+                    values[key] = combine(values[key], value) if key in values else value
+        for name, series in snapshot['histograms'].items():
+            merged = histograms.setdefault(name, {})
+            for key, counts in series:
+                key = tuple(tuple(pair) for pair in key)
+                if key in merged:
+                    merged[key] = [a + b for a, b in zip(merged[key], counts)]
+                else:
+                    merged[key] = list(counts)
+    return counters, gauges, histograms
+
+class Metrics:
+    """Counters, gauges and histograms, aggregated over all worker processes.
+
+    Each process keeps its own values and writes them to `<directory>/<pid>-<start>.json` every
+    `flush_interval` seconds, a file per process start so a reused pid does not overwrite the values of an
+    exited process. Rendering the metrics combines the files of all processes, so values of other processes
+    can be up to `flush_interval` seconds old. The counters and histograms of processes that have exited are
+    folded into `exited.json` and their files removed, their gauges are dropped. Without a directory only the
+    metrics of the current process are reported.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, flush_interval: float = 5.0):
+        self.buckets = buckets
+        self.flush_interval = flush_interval
+        self.directory: Optional[Path] = None
+        self._lock = threading.Lock()
+        self._flusher_pid: Optional[int] = None
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            # A forked worker starts counting from zero instead of reporting the parent's values twice
+            os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.flush)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._gauges: Dict[str, Dict[LabelKey, float]] = {}
+        # Per bucket counts (not cumulative) with the +Inf bucket last, then the sum of all observations
+        self._histograms: Dict[str, Dict[LabelKey, List[float]]] = {}
+        self._flusher_pid = None
+        self._process_id = f'{os.getpid()}-{uuid.uuid4().hex[:12]}'
+
+    def configure(self, directory: Optional[Path]):
+        """Share the metrics of this process with other processes through `directory`."""
+        if directory is not None:
+            try:
+                directory.mkdir(parents=True, exist_ok=True)
+            except OSError as e:
+                logger.warning(f"Metrics directory {directory} unavailable, only reporting this process: {e}")
+                directory = None
+        self.directory = directory
+
+    def inc(self, name: str, labels: Optional[Dict[str, object]] = None, amount: float = 1):
+        key = _label_key(labels)
+        with self._lock:
+            values = self._counters.setdefault(name, {})
+            values[key] = values.get(key, 0) + amount
+        self._ensure_flusher()
+
+    def set_gauge(self, name: str, value: float, labels: Optional[Dict[str, object]] = None):
+        with self._lock:
+            self._gauges.setdefault(name, {})[_label_key(labels)] = value
+        self._ensure_flusher()
+
+    def add_gauge(self, name: str, amount: float, labels: Optional[Dict[str, object]] = None):
+        key = _label_key(labels)
+        with self._lock:
+            values = self._gauges.setdefault(name, {})
+            values[key] = values.get(key, 0) + amount
+        self._ensure_flusher()
+
+    def observe(self, name: str, value: float, labels: Optional[Dict[str, object]] = None):
+        key = _label_key(labels)
+        with self._lock:
+            histogram = self._histograms.setdefault(name, {}).get(key)
+            if histogram is None:
+                histogram = self._histograms[name][key] = [0] * (len(self.buckets) + 2)
+            bucket = next((idx for idx, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+            histogram[bucket] += 1
+            histogram[-1] += value
+        self._ensure_flusher()
+
+    @contextmanager
+    def time(self, name: str, labels: Optional[Dict[str, object]] = None) -> Iterator[None]:
+        """Observe how long the block takes in the histogram `name`, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, labels)
+
+    def _snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'buckets': list(self.buckets),
+                'counters': {name: [[list(key), value] for key, value in values.items()] for name, values in self._counters.items()},
+                'gauges': {name: [[list(key), value] for key, value in values.items()] for name, values in self._gauges.items()},
+                'histograms': {name: [[list(key), values] for key, values in series.items()] for name, series in self._histograms.items()},
+            }
+
+    def flush(self):
+        """Write the metrics of this process for the other processes."""
+        if self.directory is None:
+            return
+        path = self.directory / f'{self._process_id}.json'
+        tmp_path = self.directory / f'{self._process_id}.json.tmp'
+        try:
+            tmp_path.write_text(json.dumps(self._snapshot(), separators=(',', ':')))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to write metrics to {path}: {e}")
+
+    def _ensure_flusher(self):
+        if self.directory is None or self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+
+        def flush_periodically():
+            while True:
+                time.sleep(self.flush_interval)
+                self.flush()
+
+        threading.Thread(target=flush_periodically, name='metrics', daemon=True).start()
+
+    def _read_snapshot(self, path: Path) -> Optional[dict]:
+        try:
+            snapshot = json.loads(path.read_text())
+        except (OSError, ValueError) as e:
+            logger.debug(f"Skipping unreadable metrics file {path}: {e}")
+            return None
+        if not isinstance(snapshot, dict) or tuple(snapshot.get('buckets', ())) != self.buckets:
+            return None
+        return snapshot
+
+    @contextmanager
+    def _totals_lock(self) -> Iterator[None]:
+        """Keep other processes from folding exited processes into the totals, while folding or reading them."""
+        if fcntl is None:
+            yield
+            return
+        lock_fd = os.open(self.directory / f'{TOTALS_FILE}.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(lock_fd)
+
+    def _fold_exited(self):
+        """Fold the counters and histograms of exited processes into the totals file and remove their files.
+
+        The totals remember which processes they hold until their files are gone, so a process is never
+        counted twice. Has to be called holding the totals lock.
+        """
+        try:
+            totals_path = self.directory / TOTALS_FILE
+            totals = self._read_snapshot(totals_path) if totals_path.exists() else None
+            if totals is None:
+                totals = {'pid': None, 'buckets': list(self.buckets), 'counters': {}, 'gauges': {}, 'histograms': {}, 'folded': []}
+            exited = {}
+            for path in self.directory.glob('*.json'):
+                if path.name == TOTALS_FILE:
+                    continue
+                snapshot = self._read_snapshot(path)
+                if snapshot is not None and not _process_alive(snapshot['pid']):
+                    exited[path.stem] = (path, snapshot)
+
+            folded = set(totals.get('folded', []))
+            new = [snapshot for process, (_, snapshot) in exited.items() if process not in folded]
+            if new:
+                counters, _, histograms = _combine([totals] + new)
+                totals['counters'] = {name: [[list(key), value] for key, value in series.items()] for name, series in counters.items()}
+                totals['histograms'] = {name: [[list(key), counts] for key, counts in series.items()] for name, series in histograms.items()}
+            # Only the processes whose files still exist have to be remembered
+            totals['folded'] = sorted(exited)
+            if new or folded != set(exited):
+                tmp_path = self.directory / f'{TOTALS_FILE}.{self._process_id}.tmp'
+                tmp_path.write_text(json.dumps(totals, separators=(',', ':')))
+                os.replace(tmp_path, totals_path)
+            for path, _ in exited.values():
+                path.unlink(missing_ok=True)
+            if new:
+                logger.debug(f"Folded the metrics of {len(new)} exited processes into {totals_path}")
+        except OSError as e:
+            logger.warning(f"Failed to fold the metrics of exited processes: {e}")
+
+    def _snapshots(self) -> List[dict]:
+        if self.directory is None:
+            return [self._snapshot()]
+
+        self.flush()
+        snapshots = []
+        try:
+            with self._totals_lock():
+                if fcntl is not None:
+                    self._fold_exited()
+                for path in self.directory.glob('*.json'):
+                    snapshot = self._read_snapshot(path)
+                    if snapshot is not None:
+                        snapshots.append(snapshot)
+        except OSError as e:
+            logger.warning(f"Failed to read the metrics of other processes: {e}")
+            return [self._snapshot()]
+        return snapshots
+
+    def render(self) -> str:
+        """Render the metrics of all processes in the Prometheus text format."""
+        counters: Dict[str, Dict[LabelKey, float]] = {name: {} for name in COUNTERS}
+        gauges: Dict[str, Dict[LabelKey, float]] = {name: {} for name in GAUGES}
+        histograms: Dict[str, Dict[LabelKey, List[float]]] = {name: {} for name in HISTOGRAMS}
+        for combined, merged in zip(_combine(self._snapshots()), (counters, gauges, histograms)):
+            for name, series in combined.items():
+                merged.setdefault(name, {}).update(series)
+
+        lines = []
+        for name, series in counters.items():
+            lines.append(f'# HELP {name} {COUNTERS.get(name, name)}')
+            lines.append(f'# TYPE {name} counter')
+            for key, value in sorted(series.items()):
+                lines.append(f'{name}{_format_labels(key)} {_format_value(value)}')
+        for name, series in gauges.items():
+            lines.append(f'# HELP {name} {GAUGES.get(name, (name,))[0]}')
+            lines.append(f'# TYPE {name} gauge')
+            for key, value in sorted(series.items()):
+                lines.append(f'{name}{_format_labels(key)} {_format_value(value)}')
+        for name, series in histograms.items():
+            lines.append(f'# HELP {name} {HISTOGRAMS.get(name, name)}')
+            lines.append(f'# TYPE {name} histogram')
+            for key, counts in sorted(series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (math.inf,), counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(key, (("le", _format_value(bound)),))} {_format_value(cumulative)}')
+                lines.append(f'{name}_sum{_format_labels(key)} {_format_value(counts[-1])}')
+                lines.append(f'{name}_count{_format_labels(key)} {_format_value(cumulative)}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
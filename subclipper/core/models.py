@@ -1,13 +1,15 @@
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Optional
+from typing import Optional, Sequence, Tuple
 
 @dataclass
 class Video:
     id: int
     title: str
     path: Path
-    subs: List['Subtitle']
+    subs: Sequence['Subtitle']
+    # (size, mtime_ns) of the video file when its subtitles were extracted
+    identity: Optional[Tuple[int, int]] = None
 
 @dataclass
 class Subtitle:
@@ -34,6 +36,8 @@ class ClipSettings:
     colour: bool
     format: str
     font_path: Path
+    # Quick low-fidelity render for tweaking the settings, the final download uses full quality
+    preview: bool = False
 
     def validate(self) -> dict:
         """Validate the clip settings and return any errors."""
@@ -56,4 +60,21 @@ class ClipSettings:
         if self.format not in {'gif', 'webp'}:
             errs['format'] = 'invalid output format, only gif and webp are allowed'
             
-        return errs 
\ No newline at end of file
+        return errs
+
+    def normalized(self) -> dict:
+        """Get the settings that affect the rendered clip, in a canonical form."""
+        return {
+            'start_time': round(self.start_time, 3),
+            'end_time': round(self.end_time, 3),
+            'text': self.text,
+            'caption': self.caption,
+            'crop': self.crop,
+            'resolution': self.resolution,
+            'font_size': self.font_size,
+            'boomerang': self.boomerang,
+            # Better colours only change how full quality gifs are encoded
+            'colour': self.colour and self.format == 'gif' and not self.preview,
+            'format': self.format,
+            'preview': self.preview,
+        }
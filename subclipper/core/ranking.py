@@ -0,0 +1,151 @@
+import math
+import re
+from array import array
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+WORD = re.compile(r'\w+')
+
+# BM25 parameters, the usual defaults
+K1 = 1.2
+B = 0.75
+# Words matched with a typo count for less than the word itself
+FUZZY_WEIGHT = 0.5
+# Shorter words are not matched with a typo, too many other words are a typo away from them
+MIN_FUZZY_LENGTH = 4
+
+def words(text: str) -> List[str]:
+    """Split normalized text into words, leaving out punctuation."""
+    return WORD.findall(text)
+
+@dataclass
+class Query:
+    """A ranked search query: words that should occur and phrases that have to occur."""
+    terms: List[str] = field(default_factory=list)
+    phrases: List[List[str]] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(self.terms or self.phrases)
+
+def parse_query(query: str) -> Query:
+    """Parse a normalized query, where quoted parts are phrases. An unclosed quote runs until the end."""
+    parsed = Query()
+
+    def take_phrase(match: re.Match) -> str:
+        phrase = words(match.group(1))
+        if phrase:
+            parsed.phrases.append(phrase)
+        return ' '
+
+    rest = re.sub(r'"([^"]*)"?', take_phrase, query)
+    for term in words(rest):
+        if term not in parsed.terms:
+            parsed.terms.append(term)
+    return parsed
+
+def contains_phrase(text_words: List[str], phrase: List[str]) -> bool:
+    """Check whether the words of `phrase` occur consecutively in `text_words`."""
+    length = len(phrase)
+    return any(text_words[i:i + length] == phrase for i in range(len(text_words) - length + 1))
+
+def within_one_typo(a: str, b: str) -> bool:
+    """Check whether `a` turns into `b` by inserting, deleting or replacing a character, or swapping two adjacent ones."""
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) == len(b):
+        differences = [i for i in range(len(a)) if a[i] != b[i]]
+        if len(differences) == 1:
+            return True
+        return (
+            len(differences) == 2
+            and differences[1] == differences[0] + 1
+            and a[differences[0]] == b[differences[1]]
+            and a[differences[1]] == b[differences[0]]
+        )
+    short, long = (a, b) if len(a) < len(b) else (b, a)
+    i = next((i for i in range(len(short)) if short[i] != long[i]), len(short))
+    return short[i:] == long[i + 1:]
+
+def _deletions(word: str) -> Set[str]:
+    return {word[:i] + word[i + 1:] for i in range(len(word))}
+
+class WordIndex:
+    """Inverted index of the words of the subtitles of a single video, for ranking."""
+
+    def __init__(self, texts: Iterable[str]):
+        self.postings: Dict[str, array] = {}
+        self.lengths = array('I')
+        # Words occurring more than once in a subtitle, which is rare for subtitles
+        self._repeats: Dict[Tuple[str, int], int] = {}
+        for pos, text in enumerate(texts):
+            text_words = words(text)
+            self.lengths.append(len(text_words))
+            for word in text_words:
+                postings = self.postings.get(word)
+                if postings is None:
+                    postings = self.postings[word] = array('I')
+                if postings and postings[-1] == pos:
+                    self._repeats[word, pos] = self._repeats.get((word, pos), 1) + 1
+                else:
+                    postings.append(pos)
+
+    def frequency(self, word: str, pos: int) -> int:
+        """How often `word` occurs in the subtitle at `pos`, given that it does."""
+        return self._repeats.get((word, pos), 1)
+
+class Vocabulary:
+    """Statistics of the words of all videos, and the words that are a typo away from a word."""
+
+    def __init__(self, indexes: Iterable[WordIndex]):
+        self.document_frequencies: Dict[str, int] = {}
+        self.document_count = 0
+        total_length = 0
+        max_length = 0
+        for index in indexes:
+            self.document_count += len(index.lengths)
+            total_length += sum(index.lengths)
+            max_length = max(max_length, max(index.lengths, default=0))
+            for word, postings in index.postings.items():
+                self.document_frequencies[word] = self.document_frequencies.get(word, 0) + len(postings)
+        self.average_length = total_length / self.document_count if self.document_count else 1.0
+        # The length normalization of BM25 for every subtitle length
+        self._norms = [K1 * (1 - B + B * length / (self.average_length or 1.0)) for length in range(max_length + 1)]
+        self._deletions: Optional[Dict[str, List[str]]] = None
+
+    def idf(self, word: str) -> float:
+        frequency = self.document_frequencies.get(word, 0)
+        return math.log(1 + (self.document_count - frequency + 0.5) / (frequency + 0.5))
+
+    def score(self, idf: float, frequency: int, length: int) -> float:
+        """The BM25 score of a word occurring `frequency` times in a subtitle of `length` words."""
+        return idf * frequency * (K1 + 1) / (frequency + self._norms[length])
+
+    def scores(self, word: str, index: 'WordIndex', weight: float = 1.0) -> Iterator[Tuple[int, float]]:
+        """Yield the positions of the subtitles of `index` containing `word`, with their weighted BM25 score."""
+        idf = weight * self.idf(word) * (K1 + 1)
+        norms = self._norms
+        lengths = index.lengths
+        repeats = index._repeats
+        for pos in index.postings.get(word, ()):
+            frequency = repeats.get((word, pos), 1) if repeats else 1
+            yield pos, idf * frequency / (frequency + norms[lengths[pos]])
+
+    def similar(self, word: str) -> List[str]:
+        """Find the words of the library that are a typo away from `word`, other than `word` itself."""
+        if len(word) < MIN_FUZZY_LENGTH:
+            return []
+        if self._deletions is None:
+            # Two words are a typo apart only if they share a deletion, or one is a deletion of the other
+            deletions: Dict[str, List[str]] = {}
+            for known in self.document_frequencies:
+                if len(known) >= MIN_FUZZY_LENGTH:
+                    for variant in _deletions(known) | {known}:
+                        deletions.setdefault(variant, []).append(known)
+            self._deletions = deletions
+
+        candidates = set()
+        for variant in _deletions(word) | {word}:
+            candidates.update(self._deletions.get(variant, ()))
+        return sorted(candidate for candidate in candidates if candidate != word and within_one_typo(word, candidate))
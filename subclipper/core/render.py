@@ -0,0 +1,344 @@
+import logging
+import re
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, List, Optional, Tuple
+
+from . import timing
+from .models import ClipSettings
+
+if TYPE_CHECKING:
+    from ffmpeg import FFmpeg, Progress
+
+logger = logging.getLogger(__name__)
+
+FPS = 20
+# Previews trade quality for speed while the settings are being tweaked
+PREVIEW_FPS = 10
+PREVIEW_MAX_RESOLUTION = 240
+# Distance between the text and the top or bottom edge of the clip, in pixels
+TEXT_MARGIN = 10
+# How often a running render checks whether it was cancelled
+CANCEL_CHECK_SECONDS = 0.25
+# Masters are re-encoded into every clip derived from them, so they are encoded at nearly lossless quality
+MASTER_OUTPUT_OPTIONS = {'c:v': 'libx264', 'preset': 'veryfast', 'crf': 12, 'pix_fmt': 'yuv420p', 'f': 'matroska'}
+
+class RenderError(Exception):
+    """Rendering a clip failed."""
+
+class RenderCancelled(RenderError):
+    """A render was cancelled before it finished, its ffmpeg process was terminated."""
+
+    def __init__(self, reason: str):
+        super().__init__(f"Render cancelled: {reason}")
+        self.reason = reason
+
+class Cancellation:
+    """Cancels a render when `cancel` is called, or when `check` returns the reason to cancel it.
+
+    `check` is called from the thread supervising the render, every CANCEL_CHECK_SECONDS.
+    """
+
+    def __init__(self, check: Optional[Callable[[], Optional[str]]] = None):
+        self.check = check
+        self.reason: Optional[str] = None
+
+    def cancel(self, reason: str):
+        if self.reason is None:
+            self.reason = reason
+
+    @property
+    def cancelled(self) -> bool:
+        if self.reason is None and self.check is not None:
+            reason = self.check()
+            if reason is not None:
+                self.cancel(reason)
+        return self.reason is not None
+
+def escape_filter_value(value: str) -> str:
+    """Escape a filter option value for use inside an ffmpeg filtergraph."""
+    # Once for the filter's option parser, and once more for the filtergraph parser
+    for special in ("\\'", "\\'[],;"):
+        for char in special:
+            value = value.replace(char, '\\' + char)
+    return value.replace(':', '\\\\:')
+
+def plain_text(text: str) -> str:
+    """Turn SSA subtitle text into plain text, dropping override tags and converting line breaks."""
+    text = re.sub(r'\{[^}]*\}', '', text)
+    return text.replace('\\N', '\n').replace('\\n', '\n').replace('\\h', ' ').strip()
+
+def _drawtext(font_path: Path, text_file: Path, font_size: int, y: str) -> str:
+    return (
+        f"drawtext=fontfile={escape_filter_value(str(font_path))}"
+        f":textfile={escape_filter_value(str(text_file))}"
+        f":expansion=none:fontsize={font_size}:fontcolor=white"
+        f":borderw={max(font_size // 10, 1)}:bordercolor=black"
+        f":x=(w-text_w)/2:y={y}"
+    )
+
+def output_resolution(settings: ClipSettings) -> int:
+    if settings.preview:
+        return min(settings.resolution, PREVIEW_MAX_RESOLUTION)
+    return settings.resolution
+
+def build_filtergraph(
+    settings: ClipSettings,
+    font_path: Path,
+    text_file: Optional[Path],
+    caption_file: Optional[Path],
+    fps: int,
+    source: str = '[0:v]',
+    label: str = '',
+    trim: Optional[Tuple[float, float]] = None
+) -> str:
+    """Build the filtergraph that turns the `source` video into the finished clip, labelled [<label>out].
+
+    With `trim` only the part of the source between its start and end is used, so several clips can be cut
+    from the same source. All labels of the graph start with `label` to keep them apart.
+    """
+    resolution = output_resolution(settings)
+    # Keep the text in proportion when a preview is rendered smaller than requested
+    font_size = max(settings.font_size * resolution // settings.resolution, 1)
+    # Previews use the cheaper bilinear scaler
+    scale_flags = 'bilinear' if settings.preview else 'lanczos'
+    filters: List[str] = []
+    if trim is not None:
+        filters.append(f"trim=start={trim[0]:.3f}:end={trim[1]:.3f},setpts=PTS-STARTPTS")
+    filters.append(f"fps={fps}")
+    if settings.crop:
+        filters.append("crop='min(iw,ih)':'min(iw,ih)'")
+        filters.append(f"scale={resolution}:{resolution}:flags={scale_flags}")
+    else:
+        filters.append(f"scale={resolution}:-2:flags={scale_flags}")
+    if text_file is not None:
+        filters.append(_drawtext(font_path, text_file, font_size, f"h-text_h-{TEXT_MARGIN}"))
+    if caption_file is not None:
+        filters.append(_drawtext(font_path, caption_file, font_size, str(TEXT_MARGIN)))
+
+    chains = [f"{source}{','.join(filters)}[{label}clip]"]
+    if settings.boomerang:
+        chains.append(f"[{label}clip]split[{label}forward][{label}backward]")
+        chains.append(f"[{label}backward]reverse[{label}reversed]")
+        chains.append(f"[{label}forward][{label}reversed]concat=n=2:v=1:a=0[{label}looped]")
+        clip = f"[{label}looped]"
+    else:
+        clip = f"[{label}clip]"
+
+    if settings.format == 'gif' and settings.colour and not settings.preview:
+        # A palette generated from the clip itself instead of the default 256 colour palette
+        chains.append(f"{clip}split[{label}frames][{label}palette_frames]")
+        chains.append(f"[{label}palette_frames]palettegen=stats_mode=diff[{label}palette]")
+        chains.append(f"[{label}frames][{label}palette]paletteuse=dither=bayer:bayer_scale=5:diff_mode=rectangle[{label}out]")
+    else:
+        chains.append(f"{clip}null[{label}out]")
+    return ';'.join(chains)
+
+def _text_files(settings: ClipSettings, text_dir: Path, name: str = '') -> Tuple[Optional[Path], Optional[Path]]:
+    """Write the subtitle and caption text of a clip to files for drawtext, which avoids escaping them."""
+    text_file = caption_file = None
+    if plain_text(settings.text):
+        text_file = text_dir / f'text{name}.txt'
+        text_file.write_text(plain_text(settings.text), encoding='utf-8')
+    if plain_text(settings.caption):
+        caption_file = text_dir / f'caption{name}.txt'
+        caption_file.write_text(plain_text(settings.caption), encoding='utf-8')
+    return text_file, caption_file
+
+def _output_options(settings: ClipSettings) -> dict:
+    if settings.format == 'gif':
+        return {'f': 'gif'}
+    if settings.preview:
+        return {'c:v': 'libwebp_anim', 'quality': 50, 'compression_level': 0, 'f': 'webp'}
+    return {'c:v': 'libwebp_anim', 'quality': 75, 'compression_level': 4, 'f': 'webp'}
+
+def _ffmpeg() -> 'FFmpeg':
+    # python-ffmpeg pulls in asyncio, which processes that never render do not need to import
+    from ffmpeg import FFmpeg
+
+    return (
+        FFmpeg()
+        .option('y')
+        .option('hide_banner')
+        .option('nostdin')
+        .option('loglevel', 'error')
+        # Progress is parsed from the statistics lines, which the error log level would hide
+        .option('stats')
+    )
+
+def master_scale(resolution: int) -> str:
+    """Scale the shorter side of a video to `resolution`, unless it is shorter already.
+
+    Clips of up to `resolution` can be derived from the result, whether they are cropped to a square or not.
+    """
+    shorter = f"trunc(min({resolution},{{side}})/2)*2"
+    return (
+        f"scale='if(gte(iw,ih),-2,{shorter.format(side='iw')})'"
+        f":'if(gte(iw,ih),{shorter.format(side='ih')},-2)':flags=lanczos"
+    )
+
+def build_command(
+    settings: ClipSettings,
+    video_path: Path,
+    font_path: Path,
+    output_path: Path,
+    text_dir: Path,
+    master: Optional[Tuple[Path, int]] = None
+) -> 'FFmpeg':
+    """Build the ffmpeg invocation that renders a clip straight from the source video in a single pass.
+
+    With a `master` path and resolution the same pass also writes the master rendition of the clip, and the clip
+    is rendered from the master's frames, just like clips derived from the master later on are.
+    """
+    fps = PREVIEW_FPS if settings.preview else FPS
+    text_file, caption_file = _text_files(settings, text_dir)
+    if master is None:
+        graph = build_filtergraph(settings, font_path, text_file, caption_file, fps)
+    else:
+        graph = (
+            f"[0:v]fps={FPS},{master_scale(master[1])},split[master][source];"
+            + build_filtergraph(settings, font_path, text_file, caption_file, fps, '[source]')
+        )
+
+    ffmpeg = (
+        _ffmpeg()
+        .option('filter_complex', graph)
+        .input(str(video_path), ss=f"{settings.start_time:.3f}", t=f"{settings.end_time - settings.start_time:.3f}")
+    )
+    if master is not None:
+        ffmpeg = ffmpeg.output(str(master[0]), {'map': '[master]', 'an': None, 'sn': None, **MASTER_OUTPUT_OPTIONS})
+    return ffmpeg.output(str(output_path), {'map': '[out]', 'an': None, 'sn': None, 'loop': 0, **_output_options(settings)})
+
+def build_batch_command(clips: List[ClipSettings], video_path: Path, font_path: Path, output_paths: List[Path], text_dir: Path) -> 'FFmpeg':
+    """Build a single ffmpeg invocation that renders several clips of the same video, decoding it only once.
+
+    The video is decoded from the start of the first clip until the end of the last one, and every clip is
+    trimmed from a copy of the decoded frames into its own output.
+    """
+    start = min(settings.start_time for settings in clips)
+    end = max(settings.end_time for settings in clips)
+    chains = [f"[0:v]split={len(clips)}" + ''.join(f"[in{i}]" for i in range(len(clips)))]
+    for i, settings in enumerate(clips):
+        text_file, caption_file = _text_files(settings, text_dir, str(i))
+        fps = PREVIEW_FPS if settings.preview else FPS
+        trim = (settings.start_time - start, settings.end_time - start)
+        chains.append(build_filtergraph(settings, font_path, text_file, caption_file, fps, f"[in{i}]", f"c{i}", trim))
+
+    ffmpeg = (
+        _ffmpeg()
+        .option('filter_complex', ';'.join(chains))
+        .input(str(video_path), ss=f"{start:.3f}", t=f"{end - start:.3f}")
+    )
+    for i, (settings, output_path) in enumerate(zip(clips, output_paths)):
+        ffmpeg = ffmpeg.output(str(output_path), {'map': f"[c{i}out]", 'an': None, 'sn': None, 'loop': 0, **_output_options(settings)})
+    return ffmpeg
+
+def render_clip(
+    settings: ClipSettings,
+    video_path: Path,
+    font_path: Path,
+    output_path: Path,
+    progress: Optional[Callable[[float], None]] = None,
+    cancellation: Optional[Cancellation] = None,
+    timeout: Optional[float] = None,
+    master: Optional[Tuple[Path, int]] = None
+):
+    """Render a clip into `output_path` with a single ffmpeg invocation, raising a RenderError if it fails.
+
+    The render is stopped with a RenderCancelled error when `cancellation` is cancelled or after `timeout`
+    seconds. The output file may be left incomplete then, removing it is up to the caller. With a `master`
+    path and resolution the master rendition of the clip is written as well, see `build_command`.
+    """
+    if cancellation is not None and cancellation.cancelled:
+        raise RenderCancelled(cancellation.reason)
+    duration = settings.end_time - settings.start_time
+    if settings.boomerang:
+        duration *= 2
+
+    # Only the subtitle and caption text files are written here, and they are removed even if ffmpeg fails
+    with tempfile.TemporaryDirectory(prefix='subclipper-') as text_dir:
+        _execute(build_command(settings, video_path, font_path, output_path, Path(text_dir), master), duration, progress, cancellation, timeout)
+
+def render_clips(
+    clips: List[ClipSettings],
+    video_path: Path,
+    font_path: Path,
+    output_paths: List[Path],
+    cancellation: Optional[Cancellation] = None,
+    timeout: Optional[float] = None
+):
+    """Render several clips of the same video with a single ffmpeg invocation, raising a RenderError if it fails.
+
+    Cancelling and timeouts work like they do for `render_clip`, for all clips at once.
+    """
+    if cancellation is not None and cancellation.cancelled:
+        raise RenderCancelled(cancellation.reason)
+    duration = max(settings.end_time for settings in clips) - min(settings.start_time for settings in clips)
+
+    with tempfile.TemporaryDirectory(prefix='subclipper-') as text_dir:
+        _execute(build_batch_command(clips, video_path, font_path, output_paths, Path(text_dir)), duration, None, cancellation, timeout)
+
+def _execute(
+    ffmpeg: 'FFmpeg',
+    duration: float,
+    progress: Optional[Callable[[float], None]],
+    cancellation: Optional[Cancellation],
+    timeout: Optional[float]
+):
+    """Run ffmpeg, terminating it when the render is cancelled or takes longer than `timeout` seconds."""
+    from ffmpeg import FFmpegError
+
+    logger.debug(f"Running {' '.join(ffmpeg.arguments)}")
+
+    first_progress_at: Optional[float] = None
+
+    @ffmpeg.on("progress")
+    def on_progress(status: 'Progress'):
+        nonlocal first_progress_at
+        if first_progress_at is None:
+            first_progress_at = time.perf_counter()
+        if progress is not None:
+            progress(min(status.time.total_seconds() / duration, 1.0))
+
+    start_time = time.perf_counter()
+    finished = threading.Event()
+    cancelled_because: Optional[str] = None
+
+    def supervise():
+        nonlocal cancelled_because
+        while not finished.wait(CANCEL_CHECK_SECONDS):
+            if cancelled_because is None:
+                if timeout is not None and time.perf_counter() - start_time >= timeout:
+                    cancelled_because = 'deadline'
+                elif cancellation is not None and cancellation.cancelled:
+                    cancelled_because = cancellation.reason
+            if cancelled_because is not None:
+                try:
+                    ffmpeg.terminate()
+                    return
+                except FFmpegError:
+                    # ffmpeg has not been started yet, try again on the next check
+                    pass
+
+    if cancellation is not None or timeout is not None:
+        threading.Thread(target=supervise, name='render-supervisor', daemon=True).start()
+    try:
+        ffmpeg.execute()
+    except FFmpegError as e:
+        if cancelled_because is not None:
+            raise RenderCancelled(cancelled_because) from e
+        raise RenderError(e.message or str(e)) from e
+    finally:
+        finished.set()
+        # Until the first frame is encoded ffmpeg is starting up and seeking in the source video
+        end_time = time.perf_counter()
+        if first_progress_at is None:
+            timing.record('ffmpeg', end_time - start_time)
+        else:
+            timing.record('seek', first_progress_at - start_time)
+            timing.record('encode', end_time - first_progress_at)
+    if cancelled_because is not None:
+        # A terminated ffmpeg does not raise an error
+        raise RenderCancelled(cancelled_because)
@@ -0,0 +1,248 @@
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, Optional, Set
+
+from .models import ClipSettings
+from .render import Cancellation
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Job ids are clip names or random ids, anything else is not a job of ours
+JOB_ID = re.compile(r'^[0-9a-f]{32}(\.(gif|webp))?$')
+
+class QueueFullError(Exception):
+    """Too many render jobs are waiting already."""
+
+@dataclass
+class RenderJob:
+    id: str
+    settings: Optional[ClipSettings]
+    status: str = QUEUED
+    progress: float = 0.0
+    submitted_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    output_path: Optional[Path] = None
+    error: Optional[str] = None
+    # When a client last asked about the job, and the browser sessions that want its clip
+    last_seen: float = field(default_factory=time.time)
+    sessions: Set[str] = field(default_factory=set)
+    cancellation: Cancellation = field(default_factory=Cancellation, repr=False)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+    def to_dict(self) -> dict:
+        """Describe the job for the job status API."""
+        queued_until = self.started_at or self.finished_at or time.time()
+        return {
+            'id': self.id,
+            'status': self.status,
+            'progress': self.progress,
+            'queued_seconds': round(queued_until - self.submitted_at, 3),
+            'render_seconds': round((self.finished_at or time.time()) - self.started_at, 3) if self.started_at else None,
+            'error': self.error,
+        }
+
+class RenderJobs:
+    """Runs clip renders in the background on a bounded pool of render threads.
+
+    Unfinished jobs are cancelled when no client asked about them for `abandon_seconds`, or when every
+    browser session that wanted them submitted another job. Clients may ask any worker process about a job,
+    so with a `heartbeat_dir` every process records when a job was last asked about in a file there.
+    """
+
+    def __init__(
+        self,
+        video_processor,
+        max_workers: int,
+        max_queued: int,
+        keep_seconds: float = 600,
+        abandon_seconds: float = 30,
+        heartbeat_dir: Optional[Path] = None
+    ):
+        self.video_processor = video_processor
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.keep_seconds = keep_seconds
+        self.abandon_seconds = abandon_seconds
+        self.heartbeat_dir = heartbeat_dir
+        if heartbeat_dir is not None:
+            try:
+                heartbeat_dir.mkdir(parents=True, exist_ok=True)
+            except OSError as e:
+                logger.warning(f"Render job heartbeat directory {heartbeat_dir} unavailable, only this process can keep jobs alive: {e}")
+                self.heartbeat_dir = None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='render')
+        self._lock = threading.Lock()
+        self._jobs: 'OrderedDict[str, RenderJob]' = OrderedDict()
+        # The latest job of every browser session
+        self._sessions: Dict[str, str] = {}
+        logger.info(f"Initialized RenderJobs with {max_workers} workers and room for {max_queued} queued jobs")
+
+    def submit(self, settings: ClipSettings, session: Optional[str] = None) -> RenderJob:
+        """Queue a render, or return the job that is already rendering the same clip.
+
+        A job submitted for a `session` replaces the previous job of that session, which is cancelled unless
+        other sessions want its clip too.
+        """
+        # Jobs of cacheable clips are named after the clip, so every worker process can find their result
+        job_id = self.video_processor.clip_name(settings) or uuid.uuid4().hex
+        with self._lock:
+            self._prune()
+            if session is not None:
+                self._replace_session_job(session, job_id)
+            job = self._jobs.get(job_id)
+            reusable = job is not None and job.status != FAILED and (job.status != DONE or job.output_path.exists())
+            if reusable and (job.finished or job.cancellation.reason is None):
+                job.last_seen = time.time()
+                if session is not None:
+                    job.sessions.add(session)
+                return job
+
+            if self._count(QUEUED) >= self.max_queued:
+                raise QueueFullError(f"{self.max_queued} render jobs are queued already")
+
+            job = RenderJob(id=job_id, settings=settings, sessions=set() if session is None else {session})
+            job.cancellation = Cancellation(self._abandoned(job))
+            self._jobs[job_id] = job
+            self._jobs.move_to_end(job_id)
+
+        self._executor.submit(self._run, job)
+        logger.debug(f"Queued render job {job_id}")
+        return job
+
+    def get(self, job_id: str) -> Optional[RenderJob]:
+        """Get a job, including jobs that another worker process has rendered or is rendering."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            job.last_seen = time.time()
+            return job
+
+        output_path = self.video_processor.cached_clip(job_id)
+        if output_path is not None:
+            return RenderJob(id=job_id, settings=None, status=DONE, progress=1.0, output_path=output_path)
+        if self.video_processor.clip_in_flight(job_id):
+            # The process rendering it would cancel it otherwise
+            self._heartbeat(job_id)
+            return RenderJob(id=job_id, settings=None, status=RUNNING)
+        return None
+
+    def _heartbeat_path(self, job_id: str) -> Optional[Path]:
+        if self.heartbeat_dir is None or not JOB_ID.match(job_id):
+            return None
+        return self.heartbeat_dir / f'{job_id}.seen'
+
+    def _heartbeat(self, job_id: str):
+        path = self._heartbeat_path(job_id)
+        if path is None:
+            return
+        try:
+            path.touch()
+        except OSError as e:
+            logger.debug(f"Failed to record that render job {job_id} was seen: {e}")
+
+    def _last_seen(self, job: RenderJob) -> float:
+        """When any process was last asked about a job."""
+        path = self._heartbeat_path(job.id)
+        if path is None:
+            return job.last_seen
+        try:
+            return max(job.last_seen, path.stat().st_mtime)
+        except OSError:
+            return job.last_seen
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'workers': self.max_workers,
+                'queued': self._count(QUEUED),
+                'running': self._count(RUNNING),
+                'max_queued': self.max_queued,
+            }
+
+    def _count(self, status: str) -> int:
+        return sum(1 for job in self._jobs.values() if job.status == status)
+
+    def _prune(self):
+        """Forget finished jobs after a while, cleaning up their output unless it is cached."""
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished and now - job.finished_at > self.keep_seconds:
+                del self._jobs[job_id]
+                heartbeat_path = self._heartbeat_path(job_id)
+                if heartbeat_path is not None:
+                    heartbeat_path.unlink(missing_ok=True)
+                if job.output_path is not None:
+                    self.video_processor.release_clip(job.output_path)
+        for session, job_id in list(self._sessions.items()):
+            if job_id not in self._jobs:
+                del self._sessions[session]
+
+    def _replace_session_job(self, session: str, job_id: str):
+        previous = self._jobs.get(self._sessions.get(session, ''))
+        self._sessions[session] = job_id
+        if previous is None or previous.id == job_id or previous.finished:
+            return
+        previous.sessions.discard(session)
+        if not previous.sessions:
+            logger.info(f"Cancelling render job {previous.id}, it was replaced by render job {job_id}")
+            previous.cancellation.cancel('superseded')
+
+    def _abandoned(self, job: RenderJob) -> Callable[[], Optional[str]]:
+        def check() -> Optional[str]:
+            if time.time() - self._last_seen(job) > self.abandon_seconds:
+                return 'abandoned'
+            return None
+        return check
+
+    def _progress_callback(self, job: RenderJob):
+        def update(progress: float):
+            job.progress = progress
+        return update
+
+    def _run(self, job: RenderJob):
+        job.started_at = time.time()
+        if job.cancellation.cancelled:
+            job.finished_at = job.started_at
+            job.error = f"Render cancelled: {job.cancellation.reason}"
+            job.status = FAILED
+            logger.info(f"Render job {job.id} was cancelled in the queue: {job.cancellation.reason}")
+            return
+
+        job.status = RUNNING
+        logger.info(f"Render job {job.id} started after {job.started_at - job.submitted_at:.2f} seconds in the queue")
+        try:
+            output_path, error = self.video_processor.generate_clip(
+                job.settings,
+                progress=self._progress_callback(job),
+                cancellation=job.cancellation
+            )
+        except Exception as e:
+            output_path, error = None, str(e)
+
+        job.finished_at = time.time()
+        if error is None:
+            job.output_path = output_path
+            job.progress = 1.0
+            job.status = DONE
+            logger.info(f"Render job {job.id} completed in {job.finished_at - job.started_at:.2f} seconds")
+        else:
+            job.error = error
+            job.status = FAILED
+            logger.warning(f"Render job {job.id} failed after {job.finished_at - job.started_at:.2f} seconds: {error}")
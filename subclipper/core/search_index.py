@@ -0,0 +1,297 @@
+import heapq
+import logging
+import threading
+from array import array
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .models import Video, Subtitle
+from .interval_index import IntervalIndex
+from .ranking import FUZZY_WEIGHT, Vocabulary, WordIndex, contains_phrase, parse_query, words
+from .subtitle_store import SubtitleView
+
+logger = logging.getLogger(__name__)
+
+def normalize(text: str) -> str:
+    """Normalize text the same way for indexing and for queries."""
+    return text.lower()
+
+def trigrams(text: str) -> set:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class VideoIndex:
+    """Trigram index over the subtitles of a single video."""
+
+    def __init__(self, video: Video, previous: Optional['VideoIndex'] = None):
+        self.video = video
+        self.video_id = video.id
+        self.subs = video.subs
+        self._positions: Optional[Dict[int, int]] = None
+        self._intervals: Optional[IntervalIndex] = None
+        self._word_index: Optional[WordIndex] = None
+        # Subtitles of a subtitle store are matched on its normalized text, without a copy of the text here
+        self._texts: Optional[List[str]] = None
+        if not isinstance(self.subs, SubtitleView):
+            self._texts = [normalize(sub.text) for sub in self.subs]
+
+        if previous is not None:
+            # Same subtitles, possibly from another store
+            self.postings = previous.postings
+            self._word_index = previous._word_index
+            return
+        self.postings: Dict[str, array] = {}
+        for pos in range(len(self.subs)):
+            for trigram in trigrams(self.text(pos)):
+                postings = self.postings.get(trigram)
+                if postings is None:
+                    postings = self.postings[trigram] = array('I')
+                postings.append(pos)
+
+    @property
+    def intervals(self) -> IntervalIndex:
+        """The interval index of the subtitles, built on first use."""
+        if self._intervals is None:
+            if isinstance(self.subs, SubtitleView):
+                self._intervals = IntervalIndex(self.subs.starts, self.subs.ends)
+            else:
+                self._intervals = IntervalIndex([sub.start for sub in self.subs], [sub.end for sub in self.subs])
+        return self._intervals
+
+    @property
+    def word_index(self) -> WordIndex:
+        """The word index of the subtitles for ranked search, built on first use."""
+        if self._word_index is None:
+            self._word_index = WordIndex(self.text(pos) for pos in range(len(self.subs)))
+        return self._word_index
+
+    def text(self, pos: int) -> str:
+        """Get the normalized text of the subtitle at `pos`."""
+        return self._texts[pos] if self._texts is not None else self.subs.normalized_text(pos)
+
+    def same_subtitles(self, video: Video) -> bool:
+        """Check whether the subtitles of `video` are the ones indexed here."""
+        if video is self.video:
+            return True
+        return video.identity is not None and (video.path, video.identity) == (self.video.path, self.video.identity)
+
+    def __len__(self) -> int:
+        return len(self.subs)
+
+    def position(self, sub_id: int) -> Optional[int]:
+        """Get the position of a subtitle within this video."""
+        if 0 <= sub_id < len(self.subs) and self.subs[sub_id].id == sub_id:
+            return sub_id
+        # Subtitle ids are their position in the video, this is only needed for hand-made videos
+        if self._positions is None:
+            self._positions = {sub.id: pos for pos, sub in enumerate(self.subs)}
+        return self._positions.get(sub_id)
+
+    def matches(self, needle: str) -> Iterator[int]:
+        """Yield the positions of all subtitles containing the normalized `needle`, in order."""
+        if not needle:
+            yield from range(len(self.subs))
+            return
+
+        if len(needle) < 3:
+            candidates = range(len(self.subs))
+        else:
+            # Every trigram of the needle has to occur in a match, so the rarest one bounds the candidates
+            candidates = None
+            for trigram in trigrams(needle):
+                postings = self.postings.get(trigram)
+                if postings is None:
+                    return
+                if candidates is None or len(postings) < len(candidates):
+                    candidates = postings
+
+        if self._texts is not None:
+            texts = self._texts
+            matches = lambda pos: needle in texts[pos]
+        else:
+            matches = self.subs.matcher(needle)
+        for pos in candidates:
+            if matches(pos):
+                yield pos
+
+class SubtitleIndex:
+    """Substring search index over the subtitles of all videos, in the order of `videos`.
+
+    Passing the `previous` index reuses the indexes of videos that did not change, so only new and changed
+    videos are indexed. The previous index stays usable, searches running on it are not disturbed.
+    The word indexes for ranked search are only built by the first ranked search.
+    """
+
+    def __init__(self, videos: List[Video], previous: Optional['SubtitleIndex'] = None):
+        self.videos = videos
+        reusable = {} if previous is None else previous._video_indexes
+        self._video_indexes: Dict[int, VideoIndex] = {}
+        reused = 0
+        for video in videos:
+            previous_index = reusable.get(video.id)
+            if previous_index is not None and previous_index.same_subtitles(video):
+                index = VideoIndex(video, previous_index)
+                reused += 1
+            else:
+                index = VideoIndex(video)
+            self._video_indexes[video.id] = index
+        # Position of the first subtitle of every video among the subtitles of all videos
+        self._offsets: Dict[int, int] = {}
+        offset = 0
+        for video_id, index in self._video_indexes.items():
+            self._offsets[video_id] = offset
+            offset += len(index)
+        self._vocabulary: Optional[Vocabulary] = None
+        self._vocabulary_lock = threading.Lock()
+        logger.info(f"Indexed {sum(len(index) for index in self._video_indexes.values())} subtitles of {len(videos)} videos, reusing the index of {reused} videos")
+
+    def video(self, video_id: int) -> Optional[Video]:
+        index = self._video_indexes.get(video_id)
+        return None if index is None else index.video
+
+    def _indexes(self, video_id: Optional[int]) -> List[VideoIndex]:
+        if video_id is None:
+            return list(self._video_indexes.values())
+        index = self._video_indexes.get(video_id)
+        return [] if index is None else [index]
+
+    def position(self, video_id: int, sub_id: int) -> Optional[int]:
+        """Get the position of a subtitle among the subtitles of all videos, or None if it does not exist."""
+        index = self._video_indexes.get(video_id)
+        if index is None:
+            return None
+        position = index.position(sub_id)
+        if position is None:
+            return None
+        return self._offsets[video_id] + position
+
+    def overlapping(self, video_id: int, start: float, end: float) -> List[Subtitle]:
+        """Find the subtitles of a video overlapping [start, end], ordered by start time."""
+        index = self._video_indexes.get(video_id)
+        if index is None:
+            return []
+        return [index.subs[pos] for pos in index.intervals.overlapping(start, end)]
+
+    def neighbours(self, video_id: int, sub_id: int, count: int) -> Optional[List[Subtitle]]:
+        """Find up to `count` subtitles around a subtitle in time, including it, or None if it does not exist."""
+        index = self._video_indexes.get(video_id)
+        if index is None:
+            return None
+        pos = index.position(sub_id)
+        if pos is None:
+            return None
+        return [index.subs[neighbour] for neighbour in index.intervals.neighbours(pos, count)]
+
+    def search(self, query: Optional[str], video_id: Optional[int] = None) -> List[Subtitle]:
+        """Find all subtitles containing `query` (case-insensitive), in video and subtitle order."""
+        needle = normalize(query) if query is not None else ''
+        results = []
+        for index in self._indexes(video_id):
+            subs = index.subs
+            results.extend(subs[pos] for pos in index.matches(needle))
+        return results
+
+    def search_page(self, query: Optional[str], video_id: Optional[int], offset: int, limit: int) -> Tuple[List[Subtitle], int]:
+        """Find the matches of `query` in [offset, offset + limit) and the total amount of matches."""
+        needle = normalize(query) if query is not None else ''
+        results = []
+        total = 0
+        for index in self._indexes(video_id):
+            subs = index.subs
+            if not needle:
+                # Every subtitle matches, so whole videos before the page can be skipped by their length
+                count = len(index)
+                if len(results) < limit and total + count > offset:
+                    start = max(offset - total, 0)
+                    results.extend(subs[pos] for pos in range(start, min(count, start + limit - len(results))))
+                total += count
+                continue
+
+            for pos in index.matches(needle):
+                if offset <= total and len(results) < limit:
+                    results.append(subs[pos])
+                total += 1
+        return results, total
+
+    def _get_vocabulary(self) -> Vocabulary:
+        if self._vocabulary is None:
+            with self._vocabulary_lock:
+                if self._vocabulary is None:
+                    self._vocabulary = Vocabulary(index.word_index for index in self._video_indexes.values())
+                    logger.info(f"Built the ranking vocabulary of {len(self._vocabulary.document_frequencies)} words")
+        return self._vocabulary
+
+    def search_ranked_page(self, query: Optional[str], video_id: Optional[int], offset: int, limit: int) -> Tuple[List[Subtitle], int]:
+        """Find the best matches of `query` in [offset, offset + limit) by BM25 score and the total amount of matches.
+
+        Quoted phrases have to occur in a match, other words only raise its score. A word that does not occur
+        in any subtitle matches the words a typo away from it instead, at a lower score. Equally good matches
+        are in video and subtitle order. Only the best `offset + limit` matches are kept while scoring.
+        """
+        parsed = parse_query(normalize(query)) if query is not None else None
+        if not parsed:
+            return self.search_page(None, video_id, offset, limit)
+
+        vocabulary = self._get_vocabulary()
+        # The words of the subtitles that every term matches, with their weight
+        term_words: List[List[Tuple[str, float]]] = []
+        for term in parsed.terms:
+            if term in vocabulary.document_frequencies:
+                term_words.append([(term, 1.0)])
+            else:
+                term_words.append([(word, FUZZY_WEIGHT) for word in vocabulary.similar(term)])
+        phrase_words = {word for phrase in parsed.phrases for word in phrase}
+
+        heap: List[Tuple[float, int, int, int]] = []
+        size = offset + limit
+        total = 0
+        for index in self._indexes(video_id):
+            word_index = index.word_index
+            scores: Dict[int, float] = {}
+            if parsed.phrases:
+                postings = [word_index.postings.get(word) for word in phrase_words]
+                if any(p is None for p in postings):
+                    continue
+                postings.sort(key=len)
+                others = [set(p) for p in postings[1:]]
+                for pos in postings[0]:
+                    if all(pos in other for other in others):
+                        text_words = words(index.text(pos))
+                        if all(contains_phrase(text_words, phrase) for phrase in parsed.phrases):
+                            scores[pos] = 0.0
+                if not scores:
+                    continue
+                for word in phrase_words:
+                    for pos, score in vocabulary.scores(word, word_index):
+                        if pos in scores:
+                            scores[pos] += score
+
+            for matches in term_words:
+                if len(matches) == 1:
+                    best = vocabulary.scores(matches[0][0], word_index, matches[0][1])
+                else:
+                    # A subtitle counts only its best match of every term
+                    best_scores: Dict[int, float] = {}
+                    for word, weight in matches:
+                        for pos, score in vocabulary.scores(word, word_index, weight):
+                            if score > best_scores.get(pos, 0.0):
+                                best_scores[pos] = score
+                    best = best_scores.items()
+                if parsed.phrases:
+                    for pos, score in best:
+                        if pos in scores:
+                            scores[pos] += score
+                else:
+                    for pos, score in best:
+                        scores[pos] = scores.get(pos, 0.0) + score
+
+            first = self._offsets[index.video_id]
+            for pos, score in scores.items():
+                total += 1
+                # Earlier subtitles win ties
+                entry = (score, -(first + pos), index.video_id, pos)
+                if len(heap) < size:
+                    heapq.heappush(heap, entry)
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+
+        best_matches = sorted(heap, reverse=True)[offset:offset + limit]
+        return [self._video_indexes[match_video_id].subs[pos] for _, _, match_video_id, pos in best_matches], total
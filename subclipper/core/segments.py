@@ -0,0 +1,93 @@
+import bisect
+import hashlib
+import json
+import logging
+import subprocess
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from .clip_cache import file_identity
+from .render import RenderError
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_FORMAT = 'mkv'
+# Videos with keyframes further apart than this are rendered from the source, a segment would not be small
+MAX_SEGMENT_SECONDS = 60.0
+
+def probe_keyframes(video_path: Path) -> List[float]:
+    """List the times of the keyframes of the first video stream, in seconds from the start of the video.
+
+    Only the packet headers are read, nothing is decoded.
+    """
+    result = subprocess.run(
+        [
+            'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+            '-show_entries', 'packet=pts_time,flags:format=start_time',
+            '-of', 'json', str(video_path),
+        ],
+        capture_output=True,
+        check=True,
+    )
+    probe = json.loads(result.stdout)
+    # ffmpeg seeks relative to the start time of the container
+    start_time = float(probe.get('format', {}).get('start_time') or 0.0)
+    keyframes = {
+        round(float(packet['pts_time']) - start_time, 6)
+        for packet in probe.get('packets', [])
+        if 'K' in packet.get('flags', '') and packet.get('pts_time') not in (None, 'N/A')
+    }
+    return sorted(keyframes)
+
+def segment_bounds(keyframes: List[float], start: float, end: float) -> Optional[Tuple[float, Optional[float]]]:
+    """Get the keyframes around [start, end], the end is None when the segment runs until the end of the video.
+
+    Returns None if there is no keyframe before `start` or the segment would be longer than MAX_SEGMENT_SECONDS.
+    """
+    i = bisect.bisect_right(keyframes, start)
+    if i == 0:
+        return None
+    segment_start = keyframes[i - 1]
+    j = bisect.bisect_right(keyframes, end)
+    segment_end = keyframes[j] if j < len(keyframes) else None
+    if (segment_end if segment_end is not None else end) - segment_start > MAX_SEGMENT_SECONDS:
+        return None
+    return segment_start, segment_end
+
+def segment_key(video_path: Path, start: float, end: Optional[float]) -> str:
+    """Get the cache key of a segment, which changes whenever the video does."""
+    identity = {'video': file_identity(video_path), 'start': start, 'end': end}
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()[:32]
+
+def cut_segment(video_path: Path, start: float, end: Optional[float], output_path: Path):
+    """Copy the video stream between two keyframes into `output_path` without re-encoding it."""
+    from ffmpeg import FFmpeg, FFmpegError
+
+    input_options = {'ss': f'{start:.6f}'}
+    if end is not None:
+        input_options['t'] = f'{end - start:.6f}'
+    ffmpeg = (
+        FFmpeg()
+        .option('y')
+        .option('hide_banner')
+        .option('nostdin')
+        .option('loglevel', 'error')
+        .input(str(video_path), input_options)
+        .output(
+            str(output_path),
+            {
+                'map': '0:v:0',
+                'c': 'copy',
+                'an': None,
+                'sn': None,
+                # The segment starts at its first keyframe, so times within it are relative to `start`
+                'avoid_negative_ts': 'make_zero',
+                'f': 'matroska',
+            }
+        )
+    )
+    logger.debug(f"Running {' '.join(ffmpeg.arguments)}")
+    try:
+        ffmpeg.execute()
+    except FFmpegError as e:
+        raise RenderError(e.message or str(e)) from e
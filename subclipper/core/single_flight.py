@@ -0,0 +1,139 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Generic, Iterator, Optional, TypeVar
+
+try:
+    import fcntl
+except ImportError:  # Windows, only coalesce within a process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+class SingleFlightError(Exception):
+    """A call failed in another process while this process was waiting for it."""
+
+class _Call(Generic[T]):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[T] = None
+        self.error: Optional[BaseException] = None
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into a single call.
+
+    Threads of the same process wait for the first caller and share its result or exception. Across
+    processes the first caller holds a lock file in `lock_dir`, and callers in other processes wait for
+    that lock and then use `check` to pick up the result instead of repeating the work.
+    """
+
+    def __init__(self, lock_dir: Path):
+        self.lock_dir = lock_dir
+        self.lock_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+
+    def do(
+        self,
+        key: str,
+        fn: Callable[[], T],
+        check: Callable[[], Optional[T]],
+        retry: Optional[Callable[[Exception], bool]] = None
+    ) -> T:
+        """Call `fn` unless a call for `key` is already in flight, in which case wait for its outcome.
+
+        Callers waiting for a call that failed with an error for which `retry` is true make the call themselves.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            logger.debug(f"Waiting for in-flight call {key}")
+            call.done.wait()
+            if call.error is not None:
+                if retry is not None and isinstance(call.error, Exception) and retry(call.error):
+                    logger.debug(f"Retrying call {key} that failed in another thread: {call.error}")
+                    return self.do(key, fn, check, retry)
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._do_exclusive(key, fn, check, retry)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def in_flight(self, key: str) -> bool:
+        """Check whether a call for `key` is running in this or another process."""
+        with self._lock:
+            if key in self._calls:
+                return True
+        return (self.lock_dir / f'{key}.lock').exists()
+
+    def _do_exclusive(self, key: str, fn: Callable[[], T], check: Callable[[], Optional[T]], retry: Optional[Callable[[Exception], bool]]) -> T:
+        started = time.time()
+        error_path = self.lock_dir / f'{key}.err'
+        with self._process_lock(key) as waited:
+            if waited:
+                # Another process did the work while we were waiting for the lock
+                result = check()
+                if result is not None:
+                    return result
+                try:
+                    if error_path.stat().st_mtime >= started:
+                        raise SingleFlightError(error_path.read_text())
+                except FileNotFoundError:
+                    pass
+
+            try:
+                result = fn()
+            except Exception as e:
+                if retry is None or not retry(e):
+                    error_path.write_text(str(e))
+                raise
+            error_path.unlink(missing_ok=True)
+            return result
+
+    @contextmanager
+    def _process_lock(self, key: str) -> Iterator[bool]:
+        """Hold the lock file of `key`, yielding whether another process held it first."""
+        if fcntl is None:
+            yield False
+            return
+
+        path = self.lock_dir / f'{key}.lock'
+        waited = False
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                waited = True
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            # The previous holder removes the lock file on release, so make sure we locked the current one
+            try:
+                current = os.fstat(fd).st_ino == os.stat(path).st_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                break
+            os.close(fd)
+
+        try:
+            yield waited
+        finally:
+            path.unlink(missing_ok=True)
+            os.close(fd)
@@ -0,0 +1,217 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple, Union
+
+from .catalog import SubtitleEvent
+from .models import Subtitle
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SUBSTORE'
+FORMAT_VERSION = 1
+# Magic, format version, whether the arrays are little endian, subtitle count and metadata length
+_HEADER = struct.Struct('<8sIIQQ')
+
+class StoreError(Exception):
+    """A subtitle store file is unreadable."""
+
+def library_version(files: Dict[Path, Tuple[int, int]], ids: Dict[Path, int]) -> str:
+    """Identify a state of the library by the id, path, size and mtime of every video file."""
+    entries = sorted((ids[path], str(path), size, mtime_ns) for path, (size, mtime_ns) in files.items())
+    return hashlib.sha256(json.dumps([FORMAT_VERSION, entries]).encode()).hexdigest()[:32]
+
+def _align(offset: int) -> int:
+    return (offset + 7) & ~7
+
+def build_store(videos: List[Tuple[dict, List[SubtitleEvent]]]) -> bytes:
+    """Serialize the subtitles of videos into the columnar store format.
+
+    Every video is described by a metadata dict, which is kept as is and extended with the range of its subtitles.
+    """
+    starts = array('d')
+    ends = array('d')
+    video_ids = array('i')
+    text_offsets = array('q', [0])
+    normalized_offsets = array('q', [0])
+    texts = bytearray()
+    normalized = bytearray()
+    metadata = []
+    for video, events in videos:
+        metadata.append({**video, 'first': len(starts), 'count': len(events)})
+        for start, end, text in events:
+            starts.append(start)
+            ends.append(end)
+            video_ids.append(video['id'])
+            texts += text.encode('utf-8')
+            text_offsets.append(len(texts))
+            # Lowercased once here, so searches never have to lowercase subtitles
+            normalized += text.lower().encode('utf-8')
+            normalized_offsets.append(len(normalized))
+
+    meta = json.dumps(metadata, separators=(',', ':')).encode('utf-8')
+    out = bytearray(_HEADER.pack(MAGIC, FORMAT_VERSION, sys.byteorder == 'little', len(starts), len(meta)))
+    out += meta
+    for column in (starts, ends, text_offsets, normalized_offsets, video_ids):
+        out += bytes(_align(len(out)) - len(out))
+        out += column.tobytes()
+    out += texts
+    out += normalized
+    return bytes(out)
+
+class SubtitleStore:
+    """Read-only columnar subtitle store: start and end times, video ids and the text of all subtitles.
+
+    The store is usually a memory-mapped file shared by all worker processes. Subtitle objects are only
+    created when a subtitle is accessed, searches work on the raw UTF-8 text.
+    """
+
+    def __init__(self, buffer: Union[bytes, mmap.mmap]):
+        self._buffer = buffer
+        view = memoryview(buffer)
+        try:
+            magic, version, little_endian, count, meta_length = _HEADER.unpack_from(view, 0)
+        except struct.error as e:
+            raise StoreError(f"Subtitle store is truncated: {e}") from e
+        if magic != MAGIC or version != FORMAT_VERSION or bool(little_endian) != (sys.byteorder == 'little'):
+            raise StoreError("Subtitle store has an unknown format")
+
+        offset = _HEADER.size
+        try:
+            self.videos: List[dict] = json.loads(bytes(view[offset:offset + meta_length]))
+        except ValueError as e:
+            raise StoreError(f"Subtitle store metadata is corrupt: {e}") from e
+        offset += meta_length
+
+        def column(typecode: str, length: int) -> memoryview:
+            nonlocal offset
+            offset = _align(offset)
+            size = length * array(typecode).itemsize
+            if offset + size > len(view):
+                raise StoreError("Subtitle store is truncated")
+            data = view[offset:offset + size].cast(typecode)
+            offset += size
+            return data
+
+        self.starts = column('d', count)
+        self.ends = column('d', count)
+        self._text_offsets = column('q', count + 1)
+        self._normalized_offsets = column('q', count + 1)
+        self.video_ids = column('i', count)
+        self._text_base = offset
+        self._normalized_base = offset + self._text_offsets[count]
+        if self._normalized_base + self._normalized_offsets[count] > len(view):
+            raise StoreError("Subtitle store is truncated")
+        self._view = view
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    @classmethod
+    def open(cls, path: Path) -> 'SubtitleStore':
+        """Memory-map a store file read-only."""
+        with open(path, 'rb') as f:
+            try:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError as e:  # empty file
+                raise StoreError(f"Subtitle store {path} is empty") from e
+        store = cls(buffer)
+        logger.info(f"Mapped subtitle store {path} with {len(store)} subtitles of {len(store.videos)} videos")
+        return store
+
+    @staticmethod
+    def write(path: Path, data: bytes):
+        """Write a store file atomically, so other processes never map a partial store."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        try:
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    def text(self, row: int) -> str:
+        start = self._text_base + self._text_offsets[row]
+        end = self._text_base + self._text_offsets[row + 1]
+        return str(self._view[start:end], 'utf-8')
+
+    def normalized_text(self, row: int) -> str:
+        start = self._normalized_base + self._normalized_offsets[row]
+        end = self._normalized_base + self._normalized_offsets[row + 1]
+        return str(self._view[start:end], 'utf-8')
+
+    def matcher(self, needle: str) -> Callable[[int], bool]:
+        """Get a function that checks whether the normalized text of a row contains the normalized `needle`."""
+        encoded = needle.encode('utf-8')
+        buffer = self._buffer
+        base = self._normalized_base
+        offsets = self._normalized_offsets
+
+        def matches(row: int) -> bool:
+            # UTF-8 is self-synchronizing, so a byte match is a character match
+            return buffer.find(encoded, base + offsets[row], base + offsets[row + 1]) != -1
+        return matches
+
+    def events(self, first: int, count: int) -> List[SubtitleEvent]:
+        return [(self.starts[row], self.ends[row], self.text(row)) for row in range(first, first + count)]
+
+    def subtitles(self, video: dict) -> 'SubtitleView':
+        return SubtitleView(self, video['id'], video['first'], video['count'])
+
+class SubtitleView(Sequence):
+    """The subtitles of a single video in a SubtitleStore, created on access."""
+
+    def __init__(self, store: SubtitleStore, video_id: int, first: int, count: int):
+        self.store = store
+        self.video_id = video_id
+        self.first = first
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, pos):
+        if isinstance(pos, slice):
+            return [self[i] for i in range(*pos.indices(self.count))]
+        if pos < 0:
+            pos += self.count
+        if not 0 <= pos < self.count:
+            raise IndexError('subtitle index out of range')
+        row = self.first + pos
+        store = self.store
+        return Subtitle(id=pos, start=store.starts[row], end=store.ends[row], text=store.text(row), video_id=self.video_id)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __repr__(self) -> str:
+        return f'SubtitleView(video_id={self.video_id}, count={self.count})'
+
+    @property
+    def starts(self) -> memoryview:
+        return self.store.starts[self.first:self.first + self.count]
+
+    @property
+    def ends(self) -> memoryview:
+        return self.store.ends[self.first:self.first + self.count]
+
+    def normalized_text(self, pos: int) -> str:
+        return self.store.normalized_text(self.first + pos)
+
+    def matcher(self, needle: str) -> Callable[[int], bool]:
+        """Get a function that checks whether the subtitle at a position contains the normalized `needle`."""
+        matches = self.store.matcher(needle)
+        first = self.first
+        return lambda pos: matches(first + pos)
+
+    def events(self) -> List[SubtitleEvent]:
+        return self.store.events(self.first, self.count)
@@ -0,0 +1,264 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import subprocess
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from .models import Video
+
+try:
+    import fcntl
+except ImportError:  # Windows, every process generates its own sprites
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+TILE_WIDTH = 160
+TILE_HEIGHT = 90
+# Frames are sampled at this rate, so a thumbnail is at most 1 / (2 * SAMPLE_FPS) seconds from a subtitle's midpoint
+SAMPLE_FPS = 2
+# JPEG images can not be higher than 65535 pixels
+MAX_ROWS = 65535 // TILE_HEIGHT
+# Sprite sheets and their indexes, but not the lock and temporary files
+SPRITE_FILE = re.compile(r'^([0-9a-f]{32}\.jpg)(\.json)?$')
+# How long to wait before checking again whether a missing sprite sheet was generated by another process
+MISSING_RECHECK_SECONDS = 30
+
+@dataclass
+class Thumbnail:
+    sprite: str
+    x: int
+    y: int
+    width: int = TILE_WIDTH
+    height: int = TILE_HEIGHT
+
+class ThumbnailSprites:
+    """Generates a sprite sheet per video in the background, with a thumbnail for every subtitle."""
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # By sprite name, so a changed video never gets the thumbnails of its previous version
+        self._indexes: Dict[str, dict] = {}
+        self._missing: Dict[str, float] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._pending: List[Video] = []
+        logger.info(f"Initialized ThumbnailSprites at {root}")
+
+    def sprite_name(self, video: Video) -> str:
+        """Name the sprite sheet after the identity of the video, so it changes whenever the video does.
+
+        The identity the subtitles were loaded with is used when there is one, so the tiles match the subtitles.
+        """
+        if video.identity is not None:
+            size, mtime_ns = video.identity
+        else:
+            stat = video.path.stat()
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+        identity = f'{video.path}:{size}:{mtime_ns}:{TILE_WIDTH}x{TILE_HEIGHT}@{SAMPLE_FPS}'
+        return hashlib.sha256(identity.encode()).hexdigest()[:32] + '.jpg'
+
+    def _index_path(self, sprite: str) -> Path:
+        return self.root / f'{sprite}.json'
+
+    def start(self, videos: List[Video]):
+        """Generate the missing sprite sheets of `videos` in a background thread, after those queued before."""
+        with self._lock:
+            positions = {video.path: i for i, video in enumerate(self._pending)}
+            for video in videos:
+                if video.path in positions:
+                    # The video changed again before its sprite sheet was generated
+                    self._pending[positions[video.path]] = video
+                else:
+                    positions[video.path] = len(self._pending)
+                    self._pending.append(video)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='thumbnails', daemon=True)
+                self._thread.start()
+
+    def prune(self, videos: List[Video]):
+        """Remove the sprite sheets of videos that were removed or changed, keeping those of `videos`."""
+        keep = set()
+        for video in videos:
+            try:
+                keep.add(self.sprite_name(video))
+            except OSError:
+                continue
+        removed = 0
+        for path in self.root.iterdir():
+            match = SPRITE_FILE.match(path.name)
+            if match is None or match.group(1) in keep:
+                continue
+            path.unlink(missing_ok=True)
+            removed += 1
+        with self._lock:
+            for cache in (self._indexes, self._missing):
+                for sprite in [sprite for sprite in cache if sprite not in keep]:
+                    del cache[sprite]
+        if removed:
+            logger.info(f"Removed {removed} thumbnail files of removed or changed videos")
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._thread = None
+                    return
+                video = self._pending.pop(0)
+            try:
+                self.generate(video)
+            except Exception:
+                logger.exception(f"Failed to generate thumbnails for {video.path}")
+
+    def generate(self, video: Video):
+        """Generate the sprite sheet of a video unless it exists already or another process is working on it."""
+        sprite = self.sprite_name(video)
+        if self._index_path(sprite).exists() or not video.subs:
+            return
+
+        lock_path = self.root / f'{sprite}.lock'
+        lock_fd = self._try_lock(lock_path)
+        if lock_fd is None:
+            logger.debug(f"Thumbnails of {video.path} are generated by another process")
+            return
+        try:
+            if self._index_path(sprite).exists():
+                return
+
+            start_time = time.time()
+            self._generate(video, sprite)
+            logger.info(f"thumbnail_generation of {video.path} completed in {time.time() - start_time:.2f} seconds")
+        finally:
+            # Only the holder removes the lock file, before releasing it
+            lock_path.unlink(missing_ok=True)
+            os.close(lock_fd)
+
+    @staticmethod
+    def _try_lock(path: Path) -> Optional[int]:
+        """Lock the lock file at `path` without waiting, returning its descriptor or None if another process holds it."""
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            if fcntl is None:
+                return fd
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return None
+            # The previous holder removes the lock file on release, so make sure we locked the current one
+            try:
+                if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def _generate(self, video: Video, sprite: str):
+        from PIL import Image
+
+        # Every subtitle gets the sampled frame closest to its midpoint, subtitles sharing a frame share a tile
+        frame_tiles: Dict[int, int] = {}
+        sub_tiles: List[int] = []
+        for sub in video.subs:
+            frame = round((sub.start + sub.end) / 2 * SAMPLE_FPS)
+            sub_tiles.append(frame_tiles.setdefault(frame, len(frame_tiles)))
+
+        columns = max(10, math.ceil(len(frame_tiles) / MAX_ROWS))
+        rows = math.ceil(len(frame_tiles) / columns)
+        sheet = Image.new('RGB', (columns * TILE_WIDTH, rows * TILE_HEIGHT))
+        frame_size = TILE_WIDTH * TILE_HEIGHT * 3
+        last_frame = max(frame_tiles)
+
+        # A single sequential decode of the video, instead of seeking to every subtitle
+        process = subprocess.Popen(
+            [
+                'ffmpeg', '-hide_banner', '-nostdin', '-loglevel', 'error',
+                '-t', f'{(last_frame + 1) / SAMPLE_FPS:.3f}', '-i', str(video.path),
+                '-map', '0:v:0', '-an', '-sn',
+                '-vf', (
+                    f'fps={SAMPLE_FPS},'
+                    f'scale={TILE_WIDTH}:{TILE_HEIGHT}:force_original_aspect_ratio=decrease,'
+                    f'pad={TILE_WIDTH}:{TILE_HEIGHT}:(ow-iw)/2:(oh-ih)/2'
+                ),
+                '-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:1',
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        found = set()
+        try:
+            frame = 0
+            while frame <= last_frame:
+                data = process.stdout.read(frame_size)
+                if len(data) < frame_size:
+                    break
+                tile = frame_tiles.get(frame)
+                if tile is not None:
+                    image = Image.frombytes('RGB', (TILE_WIDTH, TILE_HEIGHT), data)
+                    sheet.paste(image, ((tile % columns) * TILE_WIDTH, (tile // columns) * TILE_HEIGHT))
+                    found.add(tile)
+                frame += 1
+        finally:
+            process.stdout.close()
+            process.kill()
+            process.wait()
+
+        if not found:
+            raise Exception(f"ffmpeg did not produce any frames for {video.path}")
+
+        index = {
+            'columns': columns,
+            # Subtitles past the end of the video have no thumbnail
+            'tiles': [tile if tile in found else None for tile in sub_tiles],
+        }
+        tmp_sprite = self.root / f'{sprite}.{os.getpid()}.tmp'
+        sheet.save(tmp_sprite, format='JPEG', quality=80)
+        os.replace(tmp_sprite, self.root / sprite)
+        # The index is written last, so its existence marks a complete sprite sheet
+        tmp_index = self.root / f'{sprite}.json.{os.getpid()}.tmp'
+        tmp_index.write_text(json.dumps(index, separators=(',', ':')))
+        os.replace(tmp_index, self._index_path(sprite))
+
+    def _load_index(self, video: Video) -> Optional[dict]:
+        try:
+            sprite = self.sprite_name(video)
+        except OSError:
+            return None
+        with self._lock:
+            index = self._indexes.get(sprite)
+            missing_since = self._missing.get(sprite)
+        if index is not None:
+            return index
+        if missing_since is not None and time.time() - missing_since < MISSING_RECHECK_SECONDS:
+            return None
+
+        try:
+            index = json.loads(self._index_path(sprite).read_text())
+            index['sprite'] = sprite
+        except (FileNotFoundError, ValueError):
+            with self._lock:
+                self._missing[sprite] = time.time()
+            return None
+        with self._lock:
+            self._indexes[sprite] = index
+            self._missing.pop(sprite, None)
+        return index
+
+    def thumbnail(self, video: Video, position: int) -> Optional[Thumbnail]:
+        """Get the thumbnail of the subtitle at `position` in the video, if it has been generated yet."""
+        index = self._load_index(video)
+        if index is None or not 0 <= position < len(index['tiles']):
+            return None
+        tile = index['tiles'][position]
+        if tile is None:
+            return None
+        columns = index['columns']
+        return Thumbnail(sprite=index['sprite'], x=(tile % columns) * TILE_WIDTH, y=(tile // columns) * TILE_HEIGHT)
@@ -0,0 +1,38 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, List, Optional, Tuple
+
+# Stage timings of the request being handled, None outside of requests
+_timings: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar('timings', default=None)
+
+def start():
+    """Start collecting the stage timings of a request."""
+    _timings.set([])
+
+def stop():
+    """Stop collecting, so a thread that handled a request does not record into it afterwards."""
+    _timings.set(None)
+
+def collected() -> List[Tuple[str, float]]:
+    """Get the stage timings collected so far, in the order the stages finished."""
+    return list(_timings.get() or [])
+
+def record(name: str, seconds: float):
+    """Record the duration of a stage of the current request, if there is one."""
+    timings = _timings.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Record how long the block takes as a stage of the current request."""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start_time)
+
+def server_timing_header(timings: List[Tuple[str, float]]) -> str:
+    """Format stage timings as a Server-Timing header, with durations in milliseconds."""
+    return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in timings)
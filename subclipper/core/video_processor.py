@@ -1,13 +1,27 @@
 import logging
 from pathlib import Path
-from typing import List, Tuple, Optional
+from typing import Callable, Dict, Iterator, List, Tuple, Optional
 import tempfile
 import os
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from contextlib import contextmanager
+from dataclasses import replace
 
 from .models import Video, Subtitle, ClipSettings
-from subs.subs import (extract_subs, generate_video)
+from .catalog import SubtitleCatalog, SubtitleEvent
+from . import timing
+from .metrics import metrics
+from .search_index import SubtitleIndex
+from .subtitle_store import StoreError, SubtitleStore, build_store, library_version
+from .clip_cache import ClipCache, clip_cache_key, clip_name
+from .single_flight import SingleFlight, SingleFlightError
+from .export import plan_batches
+from .masters import MasterCache, master_key, master_resolution
+from .render import Cancellation, RenderCancelled, RenderError, output_resolution, render_clip, render_clips
+from .segments import SEGMENT_FORMAT, cut_segment, probe_keyframes, segment_bounds, segment_key
+from .thumbnails import Thumbnail, ThumbnailSprites
 
 logger = logging.getLogger(__name__)
 
@@ -20,128 +34,874 @@ def log_time(operation: str):
         duration = time.time() - start_time
         logger.info(f"{operation} completed in {duration:.2f} seconds")
 
+def _init_extraction_worker(log_level: int):
+    """Make sure log messages of extraction worker processes are not lost when they are not forked."""
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=log_level, format='[%(asctime)s] %(levelname)s in %(module)s: %(message)s')
+
+def _extract_subtitle_events(video_path: Path, video_id: int) -> List[SubtitleEvent]:
+    """Extract the subtitle events of a video file, with times in seconds. Safe to run in a worker process."""
+    # Imported on first use, starting a process that finds every subtitle in the catalog does not need it
+    from subs.subs import extract_subs
+
+    with log_time(f"subtitle_extraction_{video_id}"):
+        ssa_events, ok = extract_subs(str(video_path))
+        if not ok:
+            raise Exception(ssa_events)
+        return [(event.start / 1000, event.end / 1000, event.text) for event in ssa_events]
+
+def _extract_subtitle_events_timed(video_path: Path, video_id: int) -> Tuple[List[SubtitleEvent], float]:
+    """Extract the subtitle events of a video, also returning how long it took for the metrics of the parent process."""
+    start_time = time.perf_counter()
+    events = _extract_subtitle_events(video_path, video_id)
+    return events, time.perf_counter() - start_time
+
+def _subtitles_from_events(events: List[SubtitleEvent], video_id: int) -> List[Subtitle]:
+    return [
+        Subtitle(id=idx, start=start, end=end, text=text, video_id=video_id)
+        for idx, (start, end, text) in enumerate(events)
+    ]
+
 class VideoProcessor:
-    def __init__(self, search_path: Path, font_path: Path):
+    def __init__(
+        self,
+        search_path: Path,
+        font_path: Path,
+        cache_dir: Optional[Path] = None,
+        extraction_workers: int = 1,
+        clip_cache_bytes: int = 0,
+        thumbnails: bool = False,
+        render_timeout: Optional[float] = None,
+        segment_cache_bytes: int = 0,
+        master_cache_bytes: int = 0,
+        master_max_resolution: int = 1024
+    ):
         self.search_path = search_path
         self.font_path = font_path
+        self.cache_dir = cache_dir
+        self.extraction_workers = extraction_workers
+        self.clip_cache_bytes = clip_cache_bytes
+        self.thumbnails = thumbnails
+        self.render_timeout = render_timeout
+        self.segment_cache_bytes = segment_cache_bytes
+        self.master_cache_bytes = master_cache_bytes
+        self.master_max_resolution = master_max_resolution
         self._videos: List[Video] = []
-        logger.info(f"Initialized VideoProcessor with search_path: {search_path}, font_path: {font_path}")
+        self._catalog: Optional[SubtitleCatalog] = None
+        self._index: Optional[SubtitleIndex] = None
+        self._clip_cache: Optional[ClipCache] = None
+        self._segment_cache: Optional[ClipCache] = None
+        self._master_cache: Optional[MasterCache] = None
+        self._single_flight: Optional[SingleFlight] = None
+        self._thumbnails: Optional[ThumbnailSprites] = None
+        self._rescan_lock = threading.Lock()
+        self._scanned = False
+        # (size, mtime_ns) of every video file as of the last scan
+        self._video_stats: Dict[Path, Tuple[int, int]] = {}
+        self._memory_video_ids: Dict[Path, int] = {}
+        self._store: Optional[SubtitleStore] = None
+        self._store_flight: Optional[SingleFlight] = None
+        self._library_version: Optional[str] = None
+        # The cancellations of everyone waiting for a clip, it is only cancelled once they all are
+        self._clip_waiters: Dict[str, List[Optional[Cancellation]]] = {}
+        self._clip_waiters_lock = threading.Lock()
+        # Keyframe times and the (size, mtime_ns) of the video file they were probed from
+        self._keyframes: Dict[Path, Tuple[Tuple[int, int], List[float]]] = {}
+        self._keyframes_lock = threading.Lock()
+        logger.info(f"Initialized VideoProcessor with search_path: {search_path}, font_path: {font_path}, cache_dir: {cache_dir}")
+
+    def _get_catalog(self) -> Optional[SubtitleCatalog]:
+        """Get the subtitle catalog, or None if there is no usable cache directory."""
+        if self._catalog is None and self.cache_dir is not None:
+            try:
+                self._catalog = SubtitleCatalog(self.cache_dir / 'catalog.sqlite3')
+            except Exception as e:
+                logger.warning(f"Subtitle catalog unavailable, subtitles will not be cached: {e}")
+                self.cache_dir = None
+        return self._catalog
+
+    def _video_files(self) -> List[Path]:
+        """List the entries of the search path, leaving out the cache directory."""
+        return [p for p in sorted(self.search_path.glob('*')) if p != self.cache_dir]
 
     def load_videos(self) -> List[Video]:
         """Load all videos and their subtitles from the search path."""
         try:
-            if self._videos:
+            if self._videos or self._scanned:
                 logger.debug("Videos already loaded, returning cached list")
                 return self._videos
 
             logger.info(f"Loading videos from {self.search_path}")
             with log_time("video_loading"):
-                videos = []
-                for idx, video_file in enumerate(sorted(self.search_path.glob('*'))):
-                    if not video_file.is_file():
-                        continue
+                self.rescan()
+                return self._videos
+        except Exception as e:
+            logger.exception("Failed to load videos")
+            raise
 
+    def _video_ids(self, video_files: List[Path]) -> Dict[Path, int]:
+        """Get the stable ids of the video files, from the catalog if there is one."""
+        catalog = self._get_catalog()
+        if catalog is not None:
+            try:
+                return catalog.video_ids(video_files)
+            except Exception as e:
+                logger.warning(f"Failed to get video ids from the catalog, numbering the videos in this process: {e}")
+
+        next_id = max(self._memory_video_ids.values(), default=-1) + 1
+        for video_file in video_files:
+            if video_file not in self._memory_video_ids:
+                self._memory_video_ids[video_file] = next_id
+                next_id += 1
+        return {video_file: self._memory_video_ids[video_file] for video_file in video_files}
+
+    def rescan(self) -> bool:
+        """Pick up added, changed and removed videos, extracting only the subtitles of added and changed videos.
+
+        Returns whether anything changed.
+        """
+        with self._rescan_lock:
+            files = {}
+            for video_file in self._video_files():
+                try:
+                    if video_file.is_file():
+                        stat = video_file.stat()
+                        files[video_file] = (stat.st_size, stat.st_mtime_ns)
+                except OSError as e:
+                    logger.warning(f"Failed to stat {video_file}: {e}")
+
+            changed = [video_file for video_file, identity in files.items() if self._video_stats.get(video_file) != identity]
+            removed = [video_file for video_file in self._video_stats if video_file not in files]
+            if self._scanned and not changed and not removed:
+                logger.debug("No videos were added, changed or removed")
+                return False
+
+            ids = self._video_ids(list(files))
+            version = library_version(files, ids)
+            store = self._open_store(version, files, ids)
+            videos = [
+                Video(
+                    id=video['id'],
+                    title=video['title'],
+                    path=Path(video['path']),
+                    subs=store.subtitles(video),
+                    identity=tuple(video['identity'])
+                )
+                for video in store.videos
+            ]
+
+            catalog = self._get_catalog()
+            if catalog is not None:
+                catalog.prune(files)
+
+            with log_time("search_index_build"):
+                index = SubtitleIndex(videos, self._index)
+            self._index = index
+            self._videos = videos
+            self._store = store
+            self._library_version = version
+            metrics.set_gauge('subclipper_subtitles_loaded', len(store))
+            # Failed videos are remembered as well, so they are not extracted again until they change
+            self._video_stats = files
+            if self._scanned:
+                logger.info(f"Rescan found {len(changed)} added or changed and {len(removed)} removed videos")
+            self._scanned = True
+
+            changed_videos = set(changed)
+            thumbnails = self._get_thumbnails()
+            if thumbnails is not None:
+                thumbnails.prune(videos)
+                thumbnails.start([video for video in videos if video.path in changed_videos])
+            if self._get_segment_cache() is not None:
+                self._probe_keyframes([video for video in videos if video.path in changed_videos])
+            return True
+
+    def _open_store(self, version: str, files: Dict[Path, Tuple[int, int]], ids: Dict[Path, int]) -> SubtitleStore:
+        """Get the subtitle store of a library version, building it unless another worker process did already."""
+        if self.cache_dir is None:
+            return SubtitleStore(build_store(self._collect_subtitles(files, ids)))
+
+        store_dir = self.cache_dir / 'store'
+        path = store_dir / f'{version}.store'
+
+        def open_existing() -> Optional[SubtitleStore]:
+            try:
+                return SubtitleStore.open(path)
+            except FileNotFoundError:
+                return None
+            except StoreError as e:
+                logger.warning(f"Rebuilding subtitle store {path}: {e}")
+                path.unlink(missing_ok=True)
+                return None
+
+        def build() -> SubtitleStore:
+            with log_time("subtitle_store_build"):
+                SubtitleStore.write(path, build_store(self._collect_subtitles(files, ids)))
+            # Processes that still map an older store keep their mapping, new ones only need this one
+            for old_path in store_dir.iterdir():
+                if old_path.suffix == '.store' and old_path != path:
                     try:
-                        subs = self._extract_subtitles(video_file, idx)
-                        video = Video(
-                            id=idx,
-                            title=video_file.stem,
-                            path=video_file,
-                            subs=subs
-                        )
-                        videos.append(video)
+                        old_path.unlink()
+                    except OSError as e:
+                        logger.debug(f"Failed to remove old subtitle store {old_path}: {e}")
+            return SubtitleStore.open(path)
+
+        store = open_existing()
+        if store is not None:
+            return store
+        if self._store_flight is None:
+            self._store_flight = SingleFlight(self.cache_dir / 'locks')
+        # Worker processes starting at the same time wait for the first one instead of extracting the same videos
+        return self._store_flight.do(f'store-{version}', build, open_existing)
+
+    def _collect_subtitles(self, files: Dict[Path, Tuple[int, int]], ids: Dict[Path, int]) -> List[Tuple[dict, List[SubtitleEvent]]]:
+        """Gather the subtitles of all video files, ordered by video id, for a new subtitle store."""
+        current = {}
+        if self._store is not None:
+            current = {Path(video['path']): video for video in self._store.videos}
+
+        subtitles: Dict[Path, List[SubtitleEvent]] = {}
+        entries = []
+        for video_file, identity in files.items():
+            video = current.get(video_file)
+            if video is not None and tuple(video['identity']) == identity:
+                subtitles[video_file] = self._store.events(video['first'], video['count'])
+            else:
+                entries.append((ids[video_file], video_file))
+
+        if self.extraction_workers > 1:
+            subtitles.update(self._load_subtitles_parallel(entries))
+        else:
+            for video_id, video_file in entries:
+                try:
+                    subtitles[video_file] = self._load_subtitles(video_file, video_id)
+                except Exception as e:
+                    logger.error(f"Failed to process video {video_file}: {e}")
+
+        return [
+            (
+                {'id': ids[video_file], 'title': video_file.stem, 'path': str(video_file), 'identity': files[video_file]},
+                subtitles[video_file]
+            )
+            for video_file in sorted(subtitles, key=lambda video_file: ids[video_file])
+        ]
+
+    def start_rescanning(self, interval: float):
+        """Rescan the search path every `interval` seconds in a background thread."""
+        def rescan_periodically():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.rescan()
+                except Exception:
+                    logger.exception("Failed to rescan videos")
+
+        threading.Thread(target=rescan_periodically, name='rescan', daemon=True).start()
+        logger.info(f"Rescanning {self.search_path} every {interval} seconds")
+
+    @property
+    def library_version(self) -> Optional[str]:
+        """Identifies the current state of the library, it changes whenever a video is added, changed or removed."""
+        self.load_videos()
+        return self._library_version
+
+    def get_video(self, video_id: int) -> Optional[Video]:
+        """Get a video by its id, or None if there is no such video."""
+        return self._get_index().video(video_id)
+
+    def _cached_subtitles(self, video_path: Path) -> Optional[List[SubtitleEvent]]:
+        """Get the subtitles of a video from the catalog, or None if they still have to be extracted."""
+        catalog = self._get_catalog()
+        if catalog is None:
+            return None
+
+        events = catalog.get(video_path, video_path.stat())
+        if events is None:
+            return None
+        logger.debug(f"Loaded subtitles of {video_path} from the catalog")
+        return events
+
+    def _cache_subtitles(self, video_path: Path, stat: os.stat_result, events: List[SubtitleEvent]):
+        """Store freshly extracted subtitles in the catalog."""
+        catalog = self._get_catalog()
+        if catalog is not None:
+            catalog.put(video_path, stat, events)
+
+    def _load_subtitles(self, video_path: Path, video_id: int) -> List[SubtitleEvent]:
+        """Load the subtitles of a video from the catalog, extracting them only if they are not cached yet."""
+        events = self._cached_subtitles(video_path)
+        if events is not None:
+            return events
+
+        stat = video_path.stat()
+        events = [(sub.start, sub.end, sub.text) for sub in self._extract_subtitles(video_path, video_id)]
+        self._cache_subtitles(video_path, stat, events)
+        return events
+
+    def _load_subtitles_parallel(self, entries: List[Tuple[int, Path]]) -> Dict[Path, List[SubtitleEvent]]:
+        """Load the subtitles of all videos, extracting the ones missing from the catalog in a process pool."""
+        subtitles = {}
+        pending = []
+        for idx, video_file in entries:
+            try:
+                events = self._cached_subtitles(video_file)
+                if events is None:
+                    pending.append((idx, video_file, video_file.stat()))
+                else:
+                    subtitles[video_file] = events
+            except Exception as e:
+                logger.error(f"Failed to process video {video_file}: {e}")
+
+        if not pending:
+            return subtitles
+
+        workers = min(self.extraction_workers, len(pending))
+        with log_time(f"parallel_subtitle_extraction of {len(pending)} videos on {workers} workers"):
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_extraction_worker,
+                initargs=(logging.getLogger().getEffectiveLevel(),)
+            ) as executor:
+                futures = [
+                    (idx, video_file, stat, executor.submit(_extract_subtitle_events_timed, video_file, idx))
+                    for idx, video_file, stat in pending
+                ]
+                for idx, video_file, stat, future in futures:
+                    try:
+                        events, seconds = future.result()
                     except Exception as e:
+                        logger.exception(f"Failed to extract subtitles from {video_file}")
                         logger.error(f"Failed to process video {video_file}: {e}")
+                        continue
+                    metrics.observe('subclipper_subtitle_extraction_seconds', seconds)
+                    self._cache_subtitles(video_file, stat, events)
+                    subtitles[video_file] = events
 
-                self._videos = videos
-                return videos
-        except Exception as e:
-            logger.exception("Failed to load videos")
-            raise
+        return subtitles
 
     def _extract_subtitles(self, video_path: Path, video_id: int) -> List[Subtitle]:
         """Extract subtitles from a video file."""
         try:
-            with log_time(f"subtitle_extraction_{video_id}"):
-                logger.debug(f"Extracting subtitles from {video_path}")
-                ssa_events, ok = extract_subs(str(video_path))
-                if ok:
-                    return [
-                        Subtitle(
-                            id=idx,
-                            start=event.start / 1000,  # Convert to seconds
-                            end=event.end / 1000,
-                            text=event.text,
-                            video_id=video_id
-                        )
-                        for idx, event in enumerate(ssa_events)
-                    ]
-                raise Exception(ssa_events)
+            logger.debug(f"Extracting subtitles from {video_path}")
+            with metrics.time('subclipper_subtitle_extraction_seconds'):
+                return _subtitles_from_events(_extract_subtitle_events(video_path, video_id), video_id)
         except Exception as e:
             logger.exception(f"Failed to extract subtitles from {video_path}")
             raise
 
-    def generate_clip(self, settings: ClipSettings) -> Tuple[Optional[Path], Optional[str]]:
-        """Generate a video clip with the given settings."""
+    def _get_thumbnails(self) -> Optional[ThumbnailSprites]:
+        """Get the thumbnail sprite sheets, or None if thumbnails are disabled."""
+        if self._thumbnails is None and self.cache_dir is not None and self.thumbnails:
+            try:
+                self._thumbnails = ThumbnailSprites(self.cache_dir / 'thumbnails')
+            except Exception as e:
+                logger.warning(f"Thumbnails unavailable: {e}")
+                self.thumbnails = False
+        return self._thumbnails
+
+    def thumbnail(self, sub: Subtitle) -> Optional[Thumbnail]:
+        """Get the thumbnail of a subtitle, or None if it has not been generated (yet)."""
+        thumbnails = self._get_thumbnails()
+        if thumbnails is None:
+            return None
+        video = self.get_video(sub.video_id)
+        if video is None:
+            return None
+        return thumbnails.thumbnail(video, sub.id)
+
+    def thumbnail_dir(self) -> Optional[Path]:
+        """Get the directory the thumbnail sprite sheets are stored in."""
+        thumbnails = self._get_thumbnails()
+        return thumbnails.root if thumbnails is not None else None
+
+    def _get_clip_cache(self) -> Optional[ClipCache]:
+        """Get the cache of rendered clips, or None if clips should not be cached."""
+        if self._clip_cache is None and self.cache_dir is not None and self.clip_cache_bytes > 0:
+            try:
+                self._clip_cache = ClipCache(self.cache_dir / 'clips', self.clip_cache_bytes)
+                self._single_flight = SingleFlight(self.cache_dir / 'locks')
+            except Exception as e:
+                logger.warning(f"Clip cache unavailable, clips will not be cached: {e}")
+                self._clip_cache = None
+                self.clip_cache_bytes = 0
+        return self._clip_cache
+
+    def _get_segment_cache(self) -> Optional[ClipCache]:
+        """Get the cache of keyframe aligned segments of the videos, or None if clips are rendered from the videos."""
+        if self._segment_cache is None and self.cache_dir is not None and self.segment_cache_bytes > 0:
+            try:
+                self._segment_cache = ClipCache(self.cache_dir / 'segments', self.segment_cache_bytes, name='segments')
+                if self._single_flight is None:
+                    self._single_flight = SingleFlight(self.cache_dir / 'locks')
+            except Exception as e:
+                logger.warning(f"Segment cache unavailable, clips will be rendered from the videos: {e}")
+                self._segment_cache = None
+                self.segment_cache_bytes = 0
+        return self._segment_cache
+
+    def _get_master_cache(self) -> Optional[MasterCache]:
+        """Get the cache of master renditions of clips, or None if every clip is rendered from the video."""
+        if self._master_cache is None and self.cache_dir is not None and self.master_cache_bytes > 0:
+            try:
+                self._master_cache = MasterCache(self.cache_dir / 'masters', self.master_cache_bytes)
+            except Exception as e:
+                logger.warning(f"Master cache unavailable, every clip will be rendered from the video: {e}")
+                self._master_cache = None
+                self.master_cache_bytes = 0
+        return self._master_cache
+
+    def _master(self, settings: ClipSettings, video: Video) -> Tuple[Optional[Tuple[ClipSettings, Path]], Optional[Tuple[Path, int]]]:
+        """Find the master rendition a clip can be derived from, or else where to write a new one while rendering it.
+
+        Returns the clip settings relative to an existing master and its path, or the temporary path and resolution
+        of the master to write. Previews only use masters, and clips larger than the ceiling neither.
+        """
+        cache = self._get_master_cache()
+        resolution = output_resolution(settings)
+        if cache is None or resolution > self.master_max_resolution:
+            return None, None
+        try:
+            key = master_key(settings, video.path)
+            found = cache.find(key, resolution)
+        except OSError as e:
+            logger.warning(f"Failed to look up the master of a clip of {video.path}: {e}")
+            return None, None
+        if found is not None:
+            path, _ = found
+            return (replace(settings, start_time=0.0, end_time=settings.end_time - settings.start_time), path), None
+        if settings.preview:
+            return None, None
+        # A larger master than the cached one replaces it
+        resolution = master_resolution(resolution)
+        return None, (cache.temporary_path(key, resolution), resolution)
+
+    def _probe_keyframes(self, videos: List[Video]):
+        """Load the keyframe times of `videos` in a background thread, probing the ones missing from the catalog."""
+        def probe_all():
+            with log_time(f"keyframe_probing of {len(videos)} videos"):
+                for video in videos:
+                    self._video_keyframes(video, probe=True)
+
+        if videos:
+            threading.Thread(target=probe_all, name='keyframes', daemon=True).start()
+
+    def _video_keyframes(self, video: Video, probe: bool = False) -> Optional[List[float]]:
+        """Get the keyframe times of a video, probing it with ffprobe if `probe` is set and they are not cataloged yet."""
+        try:
+            stat = video.path.stat()
+        except OSError:
+            return None
+        identity = (stat.st_size, stat.st_mtime_ns)
+        with self._keyframes_lock:
+            known = self._keyframes.get(video.path)
+        if known is not None and known[0] == identity:
+            return known[1]
+
+        catalog = self._get_catalog()
+        if catalog is None:
+            return None
+        keyframes = catalog.get_keyframes(video.path, stat)
+        if keyframes is None and probe:
+            def probe_and_catalog() -> List[float]:
+                times = probe_keyframes(video.path)
+                catalog.put_keyframes(video.path, stat, times)
+                logger.debug(f"Probed {len(times)} keyframes of {video.path}")
+                return times
+
+            try:
+                # Worker processes starting at the same time wait for the first one instead of probing the same video
+                keyframes = self._single_flight.do(
+                    f'keyframes-{video.id}',
+                    probe_and_catalog,
+                    lambda: catalog.get_keyframes(video.path, stat)
+                )
+            except Exception as e:
+                # Clips of this video are rendered from the video itself until it changes or the process restarts
+                logger.warning(f"Failed to probe the keyframes of {video.path}: {e}")
+                keyframes = []
+        if keyframes is not None:
+            with self._keyframes_lock:
+                self._keyframes[video.path] = (identity, keyframes)
+        return keyframes
+
+    def _segment(self, settings: ClipSettings, video: Video) -> Optional[Tuple[ClipSettings, Path]]:
+        """Get a cached segment of the video around the clip and the clip settings relative to it, cutting it if needed.
+
+        Returns None if the clip has to be rendered from the video itself.
+        """
+        cache = self._get_segment_cache()
+        if cache is None:
+            return None
+        keyframes = self._video_keyframes(video)
+        if not keyframes:
+            return None
+        bounds = segment_bounds(keyframes, settings.start_time, settings.end_time)
+        if bounds is None:
+            return None
+        start, end = bounds
+
+        def cut() -> Path:
+            tmp_path = cache.temporary_path(key, SEGMENT_FORMAT)
+            try:
+                cut_segment(video.path, start, end, tmp_path)
+                return cache.put(key, SEGMENT_FORMAT, tmp_path)
+            finally:
+                tmp_path.unlink(missing_ok=True)
+
+        try:
+            with timing.stage('segment'):
+                key = segment_key(video.path, start, end)
+                path = cache.get(key, SEGMENT_FORMAT)
+                if path is None:
+                    path = self._single_flight.do(f'segment-{key}', cut, lambda: cache.get(key, SEGMENT_FORMAT))
+        except (OSError, RenderError, SingleFlightError) as e:
+            logger.warning(f"Failed to cut a segment of {video.path}, rendering from the video: {e}")
+            return None
+        return replace(settings, start_time=settings.start_time - start, end_time=settings.end_time - start), path
+
+    def generate_clip(
+        self,
+        settings: ClipSettings,
+        progress: Optional[Callable[[float], None]] = None,
+        cancellation: Optional[Cancellation] = None
+    ) -> Tuple[Optional[Path], Optional[str]]:
+        """Generate a video clip with the given settings, optionally reporting its progress from 0 to 1.
+
+        The render stops when `cancellation` is cancelled, unless others are waiting for the same clip.
+        """
         try:
             with log_time("clip_generation"):
                 logger.debug(f"Starting clip generation with settings: {settings}")
-                errors = settings.validate()
+                with timing.stage('validate'):
+                    errors = settings.validate()
                 if errors:
                     return None, str(errors)
 
-                try:
-                    video = self._videos[settings.episode]
-                except IndexError:
+                with timing.stage('lookup'):
+                    video = self.get_video(settings.episode)
+                if video is None:
                     return None, "Invalid episode ID"
 
-                # Create a temporary directory that won't be automatically cleaned up
-                tmp_dir = Path(tempfile.mkdtemp())
-                output_clip = tmp_dir / 'clip.mp4'
-                output_path = tmp_dir / f'clip.{settings.format}'
-
-                err, ok = generate_video(
-                    settings.start_time,
-                    settings.end_time,
-                    str(output_clip),
-                    str(output_path),
-                    settings.text,
-                    settings.caption,
-                    str(video.path),
-                    20,  # fps
-                    settings.crop,
-                    settings.boomerang,
-                    settings.resolution,
-                    self.font_path,
-                    settings.font_size,
-                    settings.colour,
-                    settings.format
-                )
+                cache = self._get_clip_cache()
+                if cache is None:
+                    fd, output_path = tempfile.mkstemp(prefix='subclipper-', suffix=f'.{settings.format}')
+                    os.close(fd)
+                    try:
+                        with timing.stage('render'):
+                            self._render_clip(settings, video, Path(output_path), progress, cancellation)
+                        return Path(output_path), None
+                    except RenderError as e:
+                        os.unlink(output_path)
+                        return None, str(e)
 
-                if ok:
+                with timing.stage('cache'):
+                    key = clip_cache_key(settings, video.path, self.font_path)
+                    cached_path = cache.get(key, settings.format)
+                if cached_path is not None:
+                    return cached_path, None
+
+                # Identical requests that arrive while this clip is rendering wait for it instead of rendering it again
+                with self._clip_waiters_lock:
+                    self._clip_waiters.setdefault(key, []).append(cancellation)
+                try:
+                    with timing.stage('render'):
+                        output_path = self._single_flight.do(
+                            key,
+                            lambda: self._render_cached_clip(key, settings, video, cache, progress, self._shared_cancellation(key)),
+                            lambda: cache.get(key, settings.format),
+                            # Waiters that still want the clip render it themselves when everyone else gave up on it
+                            retry=lambda e: isinstance(e, RenderCancelled) and e.reason != 'deadline'
+                        )
                     return output_path, None
-                return None, err
+                except (RenderError, SingleFlightError) as e:
+                    return None, str(e)
+                finally:
+                    with self._clip_waiters_lock:
+                        waiters = self._clip_waiters[key]
+                        waiters.remove(cancellation)
+                        if not waiters:
+                            del self._clip_waiters[key]
         except Exception as e:
             logger.exception("Failed to generate clip")
             raise
 
+    def export_clips(
+        self,
+        clips: List[ClipSettings],
+        workers: int = 1,
+        cancellation: Optional[Cancellation] = None
+    ) -> Iterator[Tuple[int, Optional[Path], Optional[str]]]:
+        """Render many clips, yielding the position of every clip in `clips` with its output or error as it is done.
+
+        Clips of the same video that are close together are rendered in a single ffmpeg pass over the video, and
+        up to `workers` of those passes run at the same time. The caller releases every output with `release_clip`.
+        Closing the iterator cancels the renders that did not finish yet.
+        """
+        cache = self._get_clip_cache()
+        pending = []
+        for position, settings in enumerate(clips):
+            errors = settings.validate()
+            if errors:
+                yield position, None, str(errors)
+                continue
+            video = self.get_video(settings.episode)
+            if video is None:
+                yield position, None, "Invalid episode ID"
+                continue
+            if cache is not None:
+                cached_path = cache.get(clip_cache_key(settings, video.path, self.font_path), settings.format)
+                if cached_path is not None:
+                    yield position, cached_path, None
+                    continue
+            pending.append((position, settings))
+
+        if not pending:
+            return
+        batches = plan_batches(pending)
+        logger.info(f"Exporting {len(pending)} clips in {len(batches)} renders on {workers} workers")
+        cancellation = cancellation or Cancellation()
+        executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='export')
+        futures = {executor.submit(self._render_batch, batch, cancellation) for batch in batches}
+        try:
+            while futures:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for result in future.result():
+                        yield result
+        finally:
+            if futures:
+                logger.info(f"Cancelling {len(futures)} renders of an unfinished export")
+                cancellation.cancel('disconnected')
+            executor.shutdown(wait=False, cancel_futures=True)
+            # Renders that finished after the export was given up on have nobody to release their outputs
+            for future in futures:
+                future.add_done_callback(self._release_batch)
+
+    def _release_batch(self, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        for _, output_path, _ in future.result():
+            if output_path is not None:
+                self.release_clip(output_path)
+
+    def _render_batch(self, batch: List[Tuple[int, ClipSettings]], cancellation: Cancellation) -> List[Tuple[int, Optional[Path], Optional[str]]]:
+        """Render the clips of a batch planned by `plan_batches` with a single ffmpeg invocation."""
+        clips = [settings for _, settings in batch]
+        video = self.get_video(clips[0].episode)
+        if video is None:
+            return [(position, None, "Invalid episode ID") for position, _ in batch]
+
+        cache = self._get_clip_cache()
+        if cache is not None:
+            keys = [clip_cache_key(settings, video.path, self.font_path) for settings in clips]
+            output_paths = [cache.temporary_path(key, settings.format) for key, settings in zip(keys, clips)]
+        else:
+            output_paths = []
+            for settings in clips:
+                fd, output_path = tempfile.mkstemp(prefix='subclipper-', suffix=f'.{settings.format}')
+                os.close(fd)
+                output_paths.append(Path(output_path))
+
+        metrics.add_gauge('subclipper_renders_in_flight', len(clips))
+        try:
+            with log_time(f"batch_render of {len(clips)} clips"), metrics.time('subclipper_batch_render_seconds'):
+                render_clips(clips, video.path, self.font_path, output_paths, cancellation=cancellation, timeout=self.render_timeout)
+        except RenderError as e:
+            for output_path in output_paths:
+                output_path.unlink(missing_ok=True)
+            if isinstance(e, RenderCancelled):
+                metrics.inc('subclipper_renders_cancelled_total', {'reason': e.reason})
+            elif len(batch) > 1:
+                # A clip the video can not provide fails the whole batch, the clips of the batch might be fine on their own
+                logger.warning(f"Failed to render a batch of {len(batch)} clips of {video.path}, rendering them one by one: {e}")
+                return [result for clip in batch for result in self._render_batch([clip], cancellation)]
+            else:
+                metrics.inc('subclipper_render_errors_total', {'format': clips[0].format})
+            return [(position, None, str(e)) for position, _ in batch]
+        finally:
+            metrics.add_gauge('subclipper_renders_in_flight', -len(clips))
+
+        if cache is not None:
+            output_paths = [cache.put(key, settings.format, output_path) for key, settings, output_path in zip(keys, clips, output_paths)]
+        return [(position, output_path, None) for (position, _), output_path in zip(batch, output_paths)]
+
+    def _render_cached_clip(
+        self,
+        key: str,
+        settings: ClipSettings,
+        video: Video,
+        cache: ClipCache,
+        progress: Optional[Callable[[float], None]],
+        cancellation: Cancellation
+    ) -> Path:
+        """Render a clip straight into the clip cache."""
+        tmp_path = cache.temporary_path(key, settings.format)
+        try:
+            self._render_clip(settings, video, tmp_path, progress, cancellation)
+            return cache.put(key, settings.format, tmp_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    def _render_clip(
+        self,
+        settings: ClipSettings,
+        video: Video,
+        output_path: Path,
+        progress: Optional[Callable[[float], None]],
+        cancellation: Optional[Cancellation] = None
+    ):
+        """Render a clip into `output_path`, raising a RenderError if it fails."""
+        labels = {'format': settings.format, 'resolution': settings.resolution}
+        # A master rendition only needs scaling and re-encoding, and decoding a small local segment is cheaper than
+        # seeking in the video, which remains the fallback
+        sources = [('video', settings, video.path)]
+        segment = self._segment(settings, video)
+        if segment is not None:
+            sources.insert(0, ('segment', *segment))
+        master, new_master = self._master(settings, video)
+        if master is not None:
+            sources.insert(0, ('master', *master))
+        metrics.add_gauge('subclipper_renders_in_flight', 1)
+        try:
+            with log_time(f"clip_render_{settings.format}_{settings.resolution}"), metrics.time('subclipper_clip_render_seconds', labels):
+                for i, (source, source_settings, source_path) in enumerate(sources):
+                    try:
+                        render_clip(
+                            source_settings, source_path, self.font_path, output_path, progress=progress,
+                            cancellation=cancellation, timeout=self.render_timeout, master=new_master
+                        )
+                        metrics.inc('subclipper_clip_renders_total', {'source': source})
+                        break
+                    except RenderCancelled:
+                        raise
+                    except RenderError as e:
+                        if i == len(sources) - 1:
+                            raise
+                        logger.warning(f"Failed to render a clip from {source} {source_path}, trying the next source: {e}")
+            if new_master is not None:
+                self._store_master(settings, video, new_master)
+        except RenderCancelled as e:
+            logger.info(f"Cancelled the render of a clip of {video.path}: {e.reason}")
+            metrics.inc('subclipper_renders_cancelled_total', {'reason': e.reason})
+            raise
+        except RenderError:
+            metrics.inc('subclipper_render_errors_total', {'format': settings.format})
+            raise
+        finally:
+            metrics.add_gauge('subclipper_renders_in_flight', -1)
+
+    def _store_master(self, settings: ClipSettings, video: Video, new_master: Tuple[Path, int]):
+        """Move a master written by a render into the master cache, a clip that was rendered is fine without it."""
+        tmp_path, resolution = new_master
+        try:
+            self._get_master_cache().put(master_key(settings, video.path), resolution, tmp_path)
+        except OSError as e:
+            logger.warning(f"Failed to store the master of a clip of {video.path}: {e}")
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    def _shared_cancellation(self, key: str) -> Cancellation:
+        """Cancel the render of a clip once everyone waiting for it has been cancelled."""
+        def check() -> Optional[str]:
+            with self._clip_waiters_lock:
+                waiters = list(self._clip_waiters.get(key, ()))
+            if not waiters or any(waiter is None or not waiter.cancelled for waiter in waiters):
+                return None
+            return waiters[0].reason
+        return Cancellation(check)
+
+    def clip_key(self, settings: ClipSettings) -> Optional[str]:
+        """Get the key identifying the output of `settings` without rendering it, or None if it can not be rendered."""
+        if settings.validate():
+            return None
+        video = self.get_video(settings.episode)
+        if video is None:
+            return None
+        try:
+            return clip_cache_key(settings, video.path, self.font_path)
+        except OSError as e:
+            logger.warning(f"Failed to identify the clip of {video.path}: {e}")
+            return None
+
+    def clip_name(self, settings: ClipSettings) -> Optional[str]:
+        """Get the name under which the clip of `settings` is cached, or None if it can not be cached."""
+        if self._get_clip_cache() is None:
+            return None
+        key = self.clip_key(settings)
+        return None if key is None else clip_name(key, settings.format)
+
+    def cached_clip(self, name: str) -> Optional[Path]:
+        """Get a clip from the clip cache by its name."""
+        cache = self._get_clip_cache()
+        if cache is None:
+            return None
+        return cache.find(name)
+
+    def clip_in_flight(self, name: str) -> bool:
+        """Check whether the clip with this name is being rendered by any worker process."""
+        if self._get_clip_cache() is None:
+            return False
+        return self._single_flight.in_flight(name.split('.')[0])
+
+    def release_clip(self, output_path: Path):
+        """Clean up a clip returned by generate_clip once it has been sent, unless it is cached."""
+        cache = self._get_clip_cache()
+        if cache is not None and cache.contains(output_path):
+            return
+
+        try:
+            output_path.unlink(missing_ok=True)
+        except Exception as e:
+            logger.warning(f"Failed to clean up temporary files: {e}")
+
+    def _get_index(self) -> SubtitleIndex:
+        """Get the search index of the loaded videos, building it if the videos changed."""
+        videos = self.load_videos()
+        index = self._index
+        if index is None or index.videos is not videos:
+            # A rescan replaces the videos and the index together while holding the lock
+            with self._rescan_lock:
+                videos = self._videos
+                index = self._index
+                if index is None or index.videos is not videos:
+                    with log_time("search_index_build"):
+                        index = self._index = SubtitleIndex(videos, index)
+        return index
+
     def search_subtitles(self, query: Optional[str], video_id: Optional[int] = None) -> List[Subtitle]:
         """Search subtitles across all videos or a specific video."""
         try:
-            with log_time("subtitle_search"):
+            with log_time("subtitle_search"), metrics.time('subclipper_search_seconds'):
                 logger.debug(f"Searching subtitles with query: {query}, video_id: {video_id}")
-                videos = self.load_videos()
-                results = []
-
-                for video in videos:
-                    if video_id is not None and video.id != video_id:
-                        continue
+                return self._get_index().search(query, video_id)
+        except Exception as e:
+            logger.exception("Failed to search subtitles")
+            raise
 
-                    for sub in video.subs:
-                        if query is None or query.lower() in sub.text.lower():
-                            results.append(sub)
+    def search_subtitles_page(self, query: Optional[str], video_id: Optional[int], page: int, page_length: int, ranked: bool = False) -> Tuple[List[Subtitle], int]:
+        """Search subtitles, returning only the requested page of results and the total amount of results.
 
-                return results
+        Ranked searches order the results by relevance instead of by video and subtitle.
+        """
+        try:
+            with log_time("subtitle_page_search"), metrics.time('subclipper_search_seconds'):
+                logger.debug(f"Searching subtitles with query: {query}, video_id: {video_id}, page: {page}, page_length: {page_length}, ranked: {ranked}")
+                page_length = max(page_length, 1)
+                index = self._get_index()
+                search_page = index.search_ranked_page if ranked else index.search_page
+                return search_page(query, video_id, max(page, 0) * page_length, page_length)
         except Exception as e:
             logger.exception("Failed to search subtitles")
-            raise
\ No newline at end of file
+            raise
+
+    def subtitles_between(self, video_id: int, start: float, end: float) -> List[Subtitle]:
+        """Get the subtitles of a video that overlap the time range [start, end], ordered by start time."""
+        return self._get_index().overlapping(video_id, start, end)
+
+    def neighbouring_subtitles(self, video_id: int, sub_id: int, count: int) -> Optional[List[Subtitle]]:
+        """Get up to `count` subtitles before and after a subtitle, including it, or None if it does not exist."""
+        return self._get_index().neighbours(video_id, sub_id, max(count, 0))
+
+    def locate_subtitle(self, video_id: int, sub_id: int) -> Optional[int]:
+        """Get the position of a subtitle in the unfiltered list of all subtitles, or None if it does not exist."""
+        return self._get_index().position(video_id, sub_id)
@@ -0,0 +1,35 @@
+import random
+from subclipper.benchmarks.__main__ import compare
+from subclipper.benchmarks.library import generate_library, synthetic_events
+from subclipper.core.catalog import SubtitleCatalog
+
+def test_synthetic_events_are_deterministic():
+    events = synthetic_events(random.Random(1), 100)
+    assert events == synthetic_events(random.Random(1), 100)
+    assert len(events) == 100
+    assert all(end > start >= 0 for start, end, _ in events)
+    assert all(text for _, _, text in events)
+
+def test_generate_library(tmp_path):
+    video_count = generate_library(tmp_path / "library", tmp_path / "cache", 1000)
+    videos = sorted((tmp_path / "library").iterdir())
+    assert len(videos) == video_count
+
+    catalog = SubtitleCatalog(tmp_path / "cache" / "catalog.sqlite3")
+    assert sum(len(catalog.get(video, video.stat())) for video in videos) == 1000
+
+def result(seconds, peak_bytes=1000):
+    return {'seconds': seconds, 'min_seconds': seconds, 'runs': 1, 'peak_bytes': peak_bytes}
+
+def test_compare_with_baseline():
+    baseline = {'results': [{'size': 100, 'benchmarks': {'search': result(0.1), 'tiny': result(0.0001), 'memory': result(0.1)}}]}
+    results = {'results': [
+        {'size': 100, 'benchmarks': {'search': result(0.2), 'tiny': result(0.0005), 'memory': result(0.1, 2000), 'new': result(1.0)}},
+        {'size': 200, 'benchmarks': {'search': result(5.0)}},
+    ]}
+
+    regressions = compare(results, baseline, 0.25)
+    assert len(regressions) == 2
+    assert regressions[0].startswith("search at 100 subtitles")
+    assert "peak memory" in regressions[1]
+    assert compare(results, baseline, 1.5) == []
@@ -0,0 +1,90 @@
+import pytest
+from pathlib import Path
+from subclipper.core.catalog import SubtitleCatalog
+
+@pytest.fixture
+def video_file(tmp_path):
+    path = tmp_path / "episode.mkv"
+    path.write_bytes(b"video")
+    return path
+
+@pytest.fixture
+def catalog(tmp_path):
+    return SubtitleCatalog(tmp_path / "cache" / "catalog.sqlite3")
+
+def test_catalog_roundtrip(catalog, video_file):
+    events = [(0.0, 1.5, "Hello world"), (2.0, 3.0, "Goodbye world")]
+    assert catalog.get(video_file, video_file.stat()) is None
+
+    catalog.put(video_file, video_file.stat(), events)
+    assert catalog.get(video_file, video_file.stat()) == events
+
+def test_catalog_persists_across_instances(tmp_path, video_file):
+    events = [(0.0, 1.0, "Hello")]
+    SubtitleCatalog(tmp_path / "catalog.sqlite3").put(video_file, video_file.stat(), events)
+
+    assert SubtitleCatalog(tmp_path / "catalog.sqlite3").get(video_file, video_file.stat()) == events
+
+def test_catalog_detects_changed_videos(catalog, video_file):
+    catalog.put(video_file, video_file.stat(), [(0.0, 1.0, "Hello")])
+
+    video_file.write_bytes(b"a different video")
+    assert catalog.get(video_file, video_file.stat()) is None
+
+def test_catalog_prune(catalog, tmp_path, video_file):
+    other_file = tmp_path / "other.mkv"
+    other_file.write_bytes(b"other")
+    catalog.put(video_file, video_file.stat(), [(0.0, 1.0, "Hello")])
+    catalog.put(other_file, other_file.stat(), [(0.0, 1.0, "Other")])
+
+    catalog.prune([video_file])
+    assert catalog.get(video_file, video_file.stat()) is not None
+    assert catalog.get(other_file, other_file.stat()) is None
+
+def test_corrupt_catalog_is_rebuilt(tmp_path, video_file):
+    catalog_path = tmp_path / "catalog.sqlite3"
+    catalog_path.write_bytes(b"this is not a database" * 100)
+
+    catalog = SubtitleCatalog(catalog_path)
+    assert catalog.get(video_file, video_file.stat()) is None
+    catalog.put(video_file, video_file.stat(), [(0.0, 1.0, "Hello")])
+    assert catalog.get(video_file, video_file.stat()) == [(0.0, 1.0, "Hello")]
+
+def test_catalog_video_ids_are_stable(tmp_path, video_file):
+    first = tmp_path / "a.mkv"
+    second = tmp_path / "b.mkv"
+    catalog = SubtitleCatalog(tmp_path / "catalog.sqlite3")
+    assert catalog.video_ids([first, second]) == {first: 0, second: 1}
+
+    # New videos get new ids, even if they sort before the existing ones, and removed videos keep theirs
+    reopened = SubtitleCatalog(tmp_path / "catalog.sqlite3")
+    assert reopened.video_ids([video_file, second]) == {video_file: 2, second: 1}
+    assert reopened.video_ids([first]) == {first: 0}
+
+def test_catalog_upgrade_keeps_subtitles(tmp_path, video_file):
+    import sqlite3
+    catalog_path = tmp_path / "catalog.sqlite3"
+    conn = sqlite3.connect(catalog_path)
+    with conn:
+        conn.execute('CREATE TABLE videos (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, events TEXT NOT NULL)')
+        stat = video_file.stat()
+        conn.execute('INSERT INTO videos VALUES (?, ?, ?, ?)', (str(video_file), stat.st_size, stat.st_mtime_ns, '[[0.0, 1.0, "Hello"]]'))
+        conn.execute('PRAGMA user_version = 1')
+    conn.close()
+
+    catalog = SubtitleCatalog(catalog_path)
+    assert catalog.get(video_file, video_file.stat()) == [(0.0, 1.0, "Hello")]
+    assert catalog.video_ids([video_file]) == {video_file: 0}
+    assert catalog.get_keyframes(video_file, video_file.stat()) is None
+
+def test_catalog_keyframes(catalog, tmp_path, video_file):
+    other_file = tmp_path / "other.mkv"
+    other_file.write_bytes(b"other")
+    catalog.put_keyframes(video_file, video_file.stat(), [0.0, 2.5, 5.0])
+    catalog.put_keyframes(other_file, other_file.stat(), [0.0])
+    assert catalog.get_keyframes(video_file, video_file.stat()) == [0.0, 2.5, 5.0]
+
+    catalog.prune([video_file])
+    assert catalog.get_keyframes(other_file, other_file.stat()) is None
+    video_file.write_bytes(b"a different video")
+    assert catalog.get_keyframes(video_file, video_file.stat()) is None
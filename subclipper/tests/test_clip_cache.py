@@ -0,0 +1,101 @@
+import os
+import pytest
+from pathlib import Path
+from subclipper.core.clip_cache import ClipCache, clip_cache_key
+from subclipper.core.metrics import metrics
+from subclipper.core.models import ClipSettings
+
+@pytest.fixture
+def cache(tmp_path):
+    return ClipCache(tmp_path / "clips", max_bytes=250)
+
+@pytest.fixture
+def settings():
+    return ClipSettings(
+        start_time=0.0,
+        end_time=5.0,
+        original_start_time=0.0,
+        original_end_time=5.0,
+        text="Test",
+        crop=False,
+        resolution=500,
+        id=0,
+        episode=0,
+        font_size=20,
+        caption="",
+        boomerang=False,
+        colour=False,
+        format="webp",
+        font_path=Path("/path/to/font.ttf")
+    )
+
+def make_clip(tmp_path, name, size=100):
+    path = tmp_path / name
+    path.write_bytes(b"x" * size)
+    return path
+
+def test_clip_cache_put_and_get(cache, tmp_path):
+    assert cache.get("key", "webp") is None
+
+    path = cache.put("key", "webp", make_clip(tmp_path, "clip.webp"))
+    assert cache.get("key", "webp") == path
+    assert path.read_bytes() == b"x" * 100
+    assert cache.contains(path)
+    assert cache.stats() == {"hits": 1, "misses": 1, "evictions": 0}
+
+def test_clip_cache_evicts_least_recently_used(cache, tmp_path):
+    first = cache.put("first", "webp", make_clip(tmp_path, "first.webp"))
+    second = cache.put("second", "webp", make_clip(tmp_path, "second.webp"))
+    os.utime(first, (1, 1))
+    os.utime(second, (2, 2))
+    # Using the first clip makes the second one the least recently used
+    cache.get("first", "webp")
+
+    third = cache.put("third", "webp", make_clip(tmp_path, "third.webp"))
+    assert first.exists()
+    assert not second.exists()
+    assert third.exists()
+    assert cache.stats()["evictions"] == 1
+
+def metric(line):
+    return next((float(sample.rsplit(' ', 1)[1]) for sample in metrics.render().splitlines() if sample.startswith(line + ' ')), 0)
+
+def test_clip_cache_metrics(tmp_path):
+    cache = ClipCache(tmp_path / "segments", max_bytes=150, name="segments")
+    hits = 'subclipper_clip_cache_requests_total{cache="segments",result="hit"}'
+    misses = 'subclipper_clip_cache_requests_total{cache="segments",result="miss"}'
+    evictions = 'subclipper_clip_cache_evictions_total{cache="segments"}'
+    before = {line: metric(line) for line in (hits, misses, evictions)}
+
+    cache.get("first", "webp")
+    first = cache.put("first", "webp", make_clip(tmp_path, "first.webp"))
+    os.utime(first, (1, 1))
+    cache.put("second", "webp", make_clip(tmp_path, "second.webp"))
+    cache.get("second", "webp")
+
+    assert {line: metric(line) - value for line, value in before.items()} == {hits: 1, misses: 1, evictions: 1}
+
+def test_clip_cache_removes_stale_temporary_files(cache):
+    tmp_file = cache.temporary_path("crashed", "webp")
+    tmp_file.write_bytes(b"partial")
+    os.utime(tmp_file, (1, 1))
+
+    cache.evict()
+    assert not tmp_file.exists()
+
+def test_clip_cache_key(settings, tmp_path):
+    video = make_clip(tmp_path, "video.mkv")
+    font = make_clip(tmp_path, "font.ttf")
+    key = clip_cache_key(settings, video, font)
+
+    # Settings that do not change the output do not change the key
+    settings.id = 5
+    settings.colour = True
+    assert clip_cache_key(settings, video, font) == key
+
+    settings.format = "gif"
+    assert clip_cache_key(settings, video, font) != key
+
+    settings.format = "webp"
+    video.write_bytes(b"a different video")
+    assert clip_cache_key(settings, video, font) != key
@@ -0,0 +1,46 @@
+import io
+import zipfile
+import pytest
+from pathlib import Path
+from subclipper.core.export import MAX_BATCH_CLIPS, MAX_BATCH_GAP_SECONDS, export_name, plan_batches, stream_zip
+from subclipper.core.models import ClipSettings
+
+def clip(episode, start, end):
+    return ClipSettings(
+        start_time=start, end_time=end, original_start_time=start, original_end_time=end, text="", crop=False,
+        resolution=320, id=0, episode=episode, font_size=20, caption="", boomerang=False, colour=False,
+        format="gif", font_path=Path("/fonts/font.ttf"),
+    )
+
+def test_batches_group_clips_by_video_in_time_order():
+    clips = [clip(0, 40.0, 42.0), clip(1, 5.0, 6.0), clip(0, 10.0, 12.0), clip(0, 11.0, 13.0)]
+    batches = plan_batches(enumerate(clips))
+    assert [[position for position, _ in batch] for batch in batches] == [[2, 3, 0], [1]]
+
+def test_batches_are_split_at_gaps():
+    clips = [clip(0, 0.0, 2.0), clip(0, 2.0 + MAX_BATCH_GAP_SECONDS + 1, 40.0)]
+    assert len(plan_batches(enumerate(clips))) == 2
+
+def test_batches_are_bounded():
+    clips = [clip(0, float(i), i + 1.0) for i in range(MAX_BATCH_CLIPS + 1)]
+    assert [len(batch) for batch in plan_batches(enumerate(clips))] == [MAX_BATCH_CLIPS, 1]
+
+def test_export_name():
+    assert export_name(0, clip(3, 12.5, 15.0)) == "0001-3-12.50.gif"
+
+def test_stream_zip(tmp_path):
+    first = tmp_path / "first.gif"
+    first.write_bytes(b"first clip")
+    second = tmp_path / "second.gif"
+    second.write_bytes(b"second clip")
+    released = []
+
+    chunks = list(stream_zip([("a.gif", first, None), ("b.gif", None, "clip too long"), ("c.gif", second, None)], released.append))
+
+    # Every clip is sent as soon as it is archived
+    assert len(chunks) == 3
+    with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as archive:
+        assert archive.namelist() == ["a.gif", "c.gif", "errors.txt"]
+        assert archive.read("c.gif") == b"second clip"
+        assert archive.read("errors.txt") == b"b.gif: clip too long\n"
+    assert released == [first, second]
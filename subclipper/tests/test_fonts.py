@@ -0,0 +1,50 @@
+import pytest
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+from subclipper.utils.fonts import find_font, is_font_file
+
+@pytest.fixture
+def font_file(tmp_path):
+    path = tmp_path / "font.ttf"
+    path.write_bytes(b"\x00\x01\x00\x00" + b"\x00" * 100)
+    return path
+
+def test_is_font_file(tmp_path, font_file):
+    collection = tmp_path / "fonts.ttc"
+    collection.write_bytes(b"ttcf" + b"\x00" * 100)
+    html = tmp_path / "font.html"
+    html.write_bytes(b"<html>Not found</html>")
+
+    assert is_font_file(font_file)
+    assert is_font_file(collection)
+    assert not is_font_file(html)
+    assert not is_font_file(tmp_path / "missing.ttf")
+
+def test_find_font_asks_fontconfig_once(tmp_path, font_file):
+    cache_file = tmp_path / "cache" / "font_path"
+    fc_match = MagicMock(stdout=str(font_file).encode())
+
+    with patch('subclipper.utils.fonts.shutil.which', return_value='/usr/bin/fc-match'), \
+            patch('subclipper.utils.fonts.subprocess.run', return_value=fc_match) as mock_run:
+        assert find_font(cache_file) == font_file
+        assert find_font(cache_file) == font_file
+
+    # The second lookup found the remembered font without running fc-match
+    assert mock_run.call_count == 1
+    assert cache_file.read_text() == str(font_file)
+
+def test_find_font_skips_invalid_fonts(tmp_path, font_file):
+    cache_file = tmp_path / "font_path"
+    cache_file.write_text(str(tmp_path / "removed.ttf"))
+    broken = tmp_path / "broken.ttf"
+    broken.write_bytes(b"")
+
+    with patch('subclipper.utils.fonts.shutil.which', return_value=None), \
+            patch('subclipper.utils.fonts.KNOWN_FONTS', (str(broken), str(font_file))):
+        assert find_font(cache_file) == font_file
+    assert cache_file.read_text() == str(font_file)
+
+def test_find_font_without_fonts(tmp_path):
+    with patch('subclipper.utils.fonts.shutil.which', return_value=None), \
+            patch('subclipper.utils.fonts.KNOWN_FONTS', ()):
+        assert find_font(tmp_path / "font_path") is None
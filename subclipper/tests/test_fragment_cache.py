@@ -0,0 +1,26 @@
+from subclipper.core.fragment_cache import FragmentCache
+
+def test_least_recently_used_pages_are_evicted():
+    cache = FragmentCache(10)
+    cache.put("v1", "a", b"aaaa", "text/html")
+    cache.put("v1", "b", b"bbbb", "text/html")
+    assert cache.get("v1", "a") == (b"aaaa", "text/html")
+    cache.put("v1", "c", b"cccc", "text/html")
+
+    assert cache.get("v1", "b") is None
+    assert cache.get("v1", "a") is not None
+    assert cache.get("v1", "c") is not None
+    assert cache.stats() == {'entries': 2, 'bytes': 8, 'max_bytes': 10}
+
+    # Too large to cache at all
+    cache.put("v1", "d", b"d" * 11, "text/html")
+    assert cache.get("v1", "d") is None
+    assert cache.stats()['entries'] == 2
+
+def test_library_change_drops_pages():
+    cache = FragmentCache(100)
+    cache.put("v1", "a", b"old", "text/html")
+    assert cache.get("v2", "a") is None
+    assert cache.stats()['entries'] == 0
+    cache.put("v2", "a", b"new", "text/html")
+    assert cache.get("v2", "a") == (b"new", "text/html")
@@ -0,0 +1,39 @@
+import random
+import pytest
+from subclipper.core.interval_index import IntervalIndex
+
+def make_intervals(seed):
+    rng = random.Random(seed)
+    starts, ends = [], []
+    for _ in range(200):
+        start = rng.uniform(0, 100)
+        # Mostly short lines with the odd long sign
+        length = rng.uniform(20, 60) if rng.random() < 0.05 else rng.uniform(0.5, 4)
+        starts.append(round(start, 2))
+        ends.append(round(start + length, 2))
+    return starts, ends
+
+@pytest.mark.parametrize("seed", range(5))
+def test_overlapping_matches_linear_scan(seed):
+    starts, ends = make_intervals(seed)
+    index = IntervalIndex(starts, ends)
+    rng = random.Random(seed)
+    for _ in range(50):
+        t0 = rng.uniform(-10, 110)
+        t1 = t0 + rng.uniform(0, 10)
+        expected = sorted((pos for pos in range(len(starts)) if starts[pos] <= t1 and ends[pos] >= t0), key=lambda pos: (starts[pos], pos))
+        assert index.overlapping(t0, t1) == expected
+    assert index.overlapping(50, 40) == []
+
+def test_neighbours():
+    # Not in start order, like subtitles of overlapping tracks
+    starts = [5.0, 1.0, 3.0, 2.0, 4.0]
+    ends = [6.0, 2.0, 4.0, 3.0, 5.0]
+    index = IntervalIndex(starts, ends)
+    assert index.neighbours(2, 1) == [3, 2, 4]
+    assert index.neighbours(1, 2) == [1, 3, 2]
+    assert index.neighbours(0, 0) == [0]
+
+def test_empty_index():
+    index = IntervalIndex([], [])
+    assert index.overlapping(0, 100) == []
@@ -0,0 +1,65 @@
+import pytest
+from dataclasses import replace
+from pathlib import Path
+from subclipper.core.masters import MasterCache, master_key, master_resolution
+from subclipper.core.models import ClipSettings
+
+@pytest.fixture
+def cache(tmp_path):
+    return MasterCache(tmp_path / "masters", max_bytes=1024 * 1024)
+
+@pytest.fixture
+def settings():
+    return ClipSettings(
+        start_time=12.5,
+        end_time=15.0,
+        original_start_time=12.5,
+        original_end_time=15.0,
+        text="Test",
+        crop=False,
+        resolution=320,
+        id=0,
+        episode=0,
+        font_size=20,
+        caption="",
+        boomerang=False,
+        colour=False,
+        format="webp",
+        font_path=Path("/path/to/font.ttf")
+    )
+
+def put_master(cache, tmp_path, key, resolution):
+    source = tmp_path / f"master{resolution}.mkv"
+    source.write_bytes(b"master")
+    return cache.put(key, resolution, source)
+
+def test_master_key_only_depends_on_the_frames(settings, tmp_path):
+    video_path = tmp_path / "episode.mkv"
+    video_path.write_bytes(b"video")
+    key = master_key(settings, video_path)
+
+    assert master_key(replace(settings, text="Other", format="gif", resolution=160, crop=True), video_path) == key
+    assert master_key(replace(settings, end_time=16.0), video_path) != key
+    video_path.write_bytes(b"changed video")
+    assert master_key(settings, video_path) != key
+
+def test_master_resolution_is_even():
+    assert master_resolution(320) == 320
+    assert master_resolution(321) == 322
+
+def test_find_the_smallest_large_enough_master(cache, tmp_path):
+    put_master(cache, tmp_path, "a" * 32, 320)
+
+    assert cache.find("a" * 32, 160) == (cache.root / f"{'a' * 32}.320.mkv", 320)
+    assert cache.find("a" * 32, 320)[1] == 320
+    assert cache.find("a" * 32, 480) is None
+    assert cache.find("b" * 32, 160) is None
+
+def test_larger_master_replaces_smaller_ones(cache, tmp_path):
+    put_master(cache, tmp_path, "a" * 32, 320)
+    put_master(cache, tmp_path, "b" * 32, 320)
+    path = put_master(cache, tmp_path, "a" * 32, 640)
+
+    assert cache.find("a" * 32, 160) == (path, 640)
+    assert not (cache.root / f"{'a' * 32}.320.mkv").exists()
+    assert cache.find("b" * 32, 320) is not None
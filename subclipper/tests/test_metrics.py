@@ -0,0 +1,103 @@
+import json
+import os
+import pytest
+from subclipper.core.metrics import Metrics
+
+def sample_lines(text, name):
+    return [line for line in text.splitlines() if line.startswith(name)]
+
+def test_render_prometheus_text():
+    metrics = Metrics(buckets=(0.1, 1.0))
+    metrics.inc('subclipper_render_errors_total', {'format': 'gif'})
+    metrics.inc('subclipper_render_errors_total', {'format': 'gif'})
+    metrics.set_gauge('subclipper_subtitles_loaded', 15)
+    metrics.observe('subclipper_clip_render_seconds', 0.05, {'format': 'webp', 'resolution': 320})
+    metrics.observe('subclipper_clip_render_seconds', 0.5, {'format': 'webp', 'resolution': 320})
+    metrics.observe('subclipper_clip_render_seconds', 5, {'format': 'webp', 'resolution': 320})
+
+    text = metrics.render()
+    assert '# TYPE subclipper_render_errors_total counter' in text
+    assert 'subclipper_render_errors_total{format="gif"} 2' in text
+    assert 'subclipper_subtitles_loaded 15' in text
+    assert sample_lines(text, 'subclipper_clip_render_seconds') == [
+        'subclipper_clip_render_seconds_bucket{format="webp",resolution="320",le="0.1"} 1',
+        'subclipper_clip_render_seconds_bucket{format="webp",resolution="320",le="1"} 2',
+        'subclipper_clip_render_seconds_bucket{format="webp",resolution="320",le="+Inf"} 3',
+        'subclipper_clip_render_seconds_sum{format="webp",resolution="320"} 5.55',
+        'subclipper_clip_render_seconds_count{format="webp",resolution="320"} 3',
+    ]
+
+def test_time_observes_failures():
+    metrics = Metrics(buckets=(1.0,))
+    with pytest.raises(ValueError):
+        with metrics.time('subclipper_search_seconds'):
+            raise ValueError()
+    assert 'subclipper_search_seconds_count 1' in metrics.render()
+
+def test_metrics_are_combined_across_processes(tmp_path):
+    metrics = Metrics(buckets=(1.0,))
+    metrics.configure(tmp_path)
+    metrics.inc('subclipper_render_errors_total', {'format': 'gif'})
+    metrics.add_gauge('subclipper_renders_in_flight', 1)
+    metrics.set_gauge('subclipper_subtitles_loaded', 10)
+    metrics.observe('subclipper_search_seconds', 0.5)
+
+    def other_process(pid):
+        return {
+            'pid': pid,
+            'buckets': [1.0],
+            'counters': {'subclipper_render_errors_total': [[[['format', 'gif']], 3]]},
+            'gauges': {'subclipper_renders_in_flight': [[[], 2]], 'subclipper_subtitles_loaded': [[[], 10]]},
+            'histograms': {'subclipper_search_seconds': [[[], [0, 1, 2.0]]]},
+        }
+
+    # The parent process is alive, the other process is not
+    (tmp_path / f'{os.getppid()}.json').write_text(json.dumps(other_process(os.getppid())))
+    (tmp_path / '999999999.json').write_text(json.dumps(other_process(999999999)))
+    (tmp_path / 'garbage.json').write_text('{')
+
+    text = metrics.render()
+    assert 'subclipper_render_errors_total{format="gif"} 7' in text
+    # Gauges of exited processes are dropped, the loaded library is the same in every process
+    assert 'subclipper_renders_in_flight 3' in text
+    assert 'subclipper_subtitles_loaded 10' in text
+    assert 'subclipper_search_seconds_count 3' in text
+    assert 'subclipper_search_seconds_bucket{le="1"} 1' in text
+    assert len(list(tmp_path.glob(f'{os.getpid()}-*.json'))) == 1
+    # The exited process was folded into the totals
+    assert not (tmp_path / '999999999.json').exists()
+    assert metrics.render() == text
+
+def test_exited_processes_are_folded_once(tmp_path):
+    def exited_process(pid, errors):
+        return {
+            'pid': pid,
+            'buckets': [1.0],
+            'counters': {'subclipper_render_errors_total': [[[['format', 'gif']], errors]]},
+            'gauges': {'subclipper_renders_in_flight': [[[], 1]]},
+            'histograms': {'subclipper_search_seconds': [[[], [1, 0, 0.5]]]},
+        }
+
+    metrics = Metrics(buckets=(1.0,))
+    metrics.configure(tmp_path)
+    # Two starts of a process that got the same pid
+    (tmp_path / '999999999-a.json').write_text(json.dumps(exited_process(999999999, 2)))
+    (tmp_path / '999999999-b.json').write_text(json.dumps(exited_process(999999999, 3)))
+    first = metrics.render()
+    assert 'subclipper_render_errors_total{format="gif"} 5' in first
+    assert sample_lines(first, 'subclipper_renders_in_flight') == []
+    assert 'subclipper_search_seconds_count 2' in first
+    assert list(tmp_path.glob('999999999-*')) == []
+
+    # Another process renders the totals, and a file left behind by an interrupted fold is not counted again
+    (tmp_path / '999999999-b.json').write_text(json.dumps(exited_process(999999999, 3)))
+    totals = json.loads((tmp_path / 'exited.json').read_text())
+    totals['folded'] = ['999999999-b']
+    (tmp_path / 'exited.json').write_text(json.dumps(totals))
+    other = Metrics(buckets=(1.0,))
+    other.configure(tmp_path)
+    assert other.render() == first
+    assert not (tmp_path / '999999999-b.json').exists()
+    # Once its file is gone the process no longer has to be remembered
+    assert other.render() == first
+    assert json.loads((tmp_path / 'exited.json').read_text())['folded'] == []
@@ -101,4 +101,27 @@ def test_clip_settings_validation_errors():
     # Test invalid format
     settings.font_size = 20
     settings.format = "invalid"
-    assert "format" in settings.validate() 
\ No newline at end of file
+    assert "format" in settings.validate() 
+def test_clip_settings_preview_is_part_of_normalized_settings():
+    settings = ClipSettings(
+        start_time=0.0,
+        end_time=5.0,
+        original_start_time=0.0,
+        original_end_time=5.0,
+        text="Test",
+        crop=False,
+        resolution=500,
+        id=0,
+        episode=0,
+        font_size=20,
+        caption="",
+        boomerang=False,
+        colour=False,
+        format="webp",
+        font_path=Path("/path/to/font.ttf")
+    )
+    assert settings.preview is False
+    full_quality = settings.normalized()
+
+    settings.preview = True
+    assert settings.normalized() != full_quality
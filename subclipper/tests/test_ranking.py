@@ -0,0 +1,41 @@
+import pytest
+from subclipper.core.ranking import Vocabulary, WordIndex, parse_query, within_one_typo
+
+def test_parse_query():
+    parsed = parse_query('see "you later" see, alligator "in a')
+    assert parsed.terms == ["see", "alligator"]
+    assert parsed.phrases == [["you", "later"], ["in", "a"]]
+    assert not parse_query('"" ,')
+
+@pytest.mark.parametrize("a,b,expected", [
+    ("wizard", "wizard", True),
+    ("wizard", "wizzard", True),
+    ("wizard", "wizrd", True),
+    ("wizard", "wixard", True),
+    ("wizard", "wziard", True),
+    ("wizard", "wzirad", False),
+    ("wizard", "lizards", False),
+    ("wizard", "wizardry", False),
+])
+def test_within_one_typo(a, b, expected):
+    assert within_one_typo(a, b) == expected
+    assert within_one_typo(b, a) == expected
+
+def test_word_index_frequencies():
+    index = WordIndex(["hello hello world", "world", ""])
+    assert list(index.postings["hello"]) == [0]
+    assert list(index.postings["world"]) == [0, 1]
+    assert index.frequency("hello", 0) == 2
+    assert index.frequency("world", 1) == 1
+    assert list(index.lengths) == [3, 1, 0]
+
+def test_vocabulary():
+    vocabulary = Vocabulary([WordIndex(["the wizard", "the lizard"]), WordIndex(["the wizards of oz"])])
+    assert vocabulary.document_count == 3
+    assert vocabulary.average_length == 8 / 3
+    assert vocabulary.document_frequencies["the"] == 3
+    assert vocabulary.idf("wizard") > vocabulary.idf("the")
+    assert vocabulary.similar("wizzard") == ["wizard"]
+    assert vocabulary.similar("wizard") == ["lizard", "wizards"]
+    # Too short to match with a typo
+    assert vocabulary.similar("ox") == []
@@ -0,0 +1,168 @@
+import sys
+import threading
+import time
+import pytest
+from pathlib import Path
+from unittest.mock import patch
+from ffmpeg import FFmpeg
+from subclipper.core.models import ClipSettings
+from subclipper.core.render import (
+    Cancellation, RenderCancelled, build_batch_command, build_command, build_filtergraph, escape_filter_value, plain_text,
+    render_clip
+)
+from dataclasses import replace
+
+@pytest.fixture
+def settings():
+    return ClipSettings(
+        start_time=12.5,
+        end_time=15.0,
+        original_start_time=12.5,
+        original_end_time=15.0,
+        text="Hello {\\i1}world{\\i0}\\Nsecond line",
+        crop=False,
+        resolution=320,
+        id=0,
+        episode=0,
+        font_size=20,
+        caption="",
+        boomerang=False,
+        colour=False,
+        format="webp",
+        font_path=Path("/path/to/font.ttf")
+    )
+
+def test_plain_text():
+    assert plain_text("Hello {\\i1}world{\\i0}\\Nsecond line") == "Hello world\nsecond line"
+
+def test_escape_filter_value():
+    assert escape_filter_value("/fonts/DejaVuSans.ttf") == "/fonts/DejaVuSans.ttf"
+    assert escape_filter_value("C:/Fonts/it's.ttf") == "C\\\\:/Fonts/it\\\\\\'s.ttf"
+
+def test_build_command(settings, tmp_path):
+    ffmpeg = build_command(settings, Path("/videos/episode.mkv"), Path("/fonts/font.ttf"), tmp_path / "clip.webp", tmp_path)
+    arguments = ffmpeg.arguments
+
+    # Seeking happens on the input and the output is encoded directly, without an intermediate clip
+    assert arguments[arguments.index("-ss") + 1] == "12.500"
+    assert arguments[arguments.index("-t") + 1] == "2.500"
+    assert arguments.index("-ss") < arguments.index("-i")
+    assert arguments[arguments.index("-i") + 1] == "/videos/episode.mkv"
+    assert arguments[arguments.index("-c:v") + 1] == "libwebp_anim"
+    assert arguments[-1] == str(tmp_path / "clip.webp")
+    assert (tmp_path / "text.txt").read_text() == "Hello world\nsecond line"
+    assert not (tmp_path / "caption.txt").exists()
+
+def test_build_command_with_master(settings, tmp_path):
+    master_path = tmp_path / "master.mkv"
+    ffmpeg = build_command(
+        settings, Path("/videos/episode.mkv"), Path("/fonts/font.ttf"), tmp_path / "clip.webp", tmp_path, master=(master_path, 640)
+    )
+    arguments = ffmpeg.arguments
+
+    # The master is written from the same decoded frames as the clip, which is rendered from the master's frames
+    assert arguments.count("-i") == 1
+    graph = arguments[arguments.index("-filter_complex") + 1]
+    assert graph.startswith("[0:v]fps=20,scale=")
+    assert "min(640,ih)" in graph
+    assert "split[master][source];[source]fps=20,scale=320:-2" in graph
+    assert "drawtext" not in graph.split(";")[0]
+    assert [arguments[i + 1] for i, argument in enumerate(arguments) if argument == "-map"] == ["[master]", "[out]"]
+    assert arguments[arguments.index(str(master_path)) - 2:arguments.index(str(master_path))] == ["-f", "matroska"]
+    assert arguments[-1] == str(tmp_path / "clip.webp")
+
+def test_build_batch_command(settings, tmp_path):
+    clips = [settings, replace(settings, start_time=20.0, end_time=21.0, text="Later", format="gif", boomerang=True)]
+    output_paths = [tmp_path / "first.webp", tmp_path / "second.gif"]
+    ffmpeg = build_batch_command(clips, Path("/videos/episode.mkv"), Path("/fonts/font.ttf"), output_paths, tmp_path)
+    arguments = ffmpeg.arguments
+
+    # The video is decoded once, from the start of the first clip until the end of the last one
+    assert arguments.count("-i") == 1
+    assert arguments[arguments.index("-ss") + 1] == "12.500"
+    assert arguments[arguments.index("-t") + 1] == "8.500"
+    graph = arguments[arguments.index("-filter_complex") + 1]
+    assert graph.startswith("[0:v]split=2[in0][in1];")
+    assert "[in0]trim=start=0.000:end=2.500,setpts=PTS-STARTPTS,fps=20" in graph
+    assert "[in1]trim=start=7.500:end=8.500,setpts=PTS-STARTPTS,fps=20" in graph
+    assert "[c1clip]split[c1forward][c1backward]" in graph
+    assert [arguments[i + 1] for i, argument in enumerate(arguments) if argument == "-map"] == ["[c0out]", "[c1out]"]
+    assert arguments[-1] == str(output_paths[1])
+    assert (tmp_path / "text0.txt").read_text() == "Hello world\nsecond line"
+    assert (tmp_path / "text1.txt").read_text() == "Later"
+
+def test_build_filtergraph(settings, tmp_path):
+    graph = build_filtergraph(settings, Path("/fonts/font.ttf"), tmp_path / "text.txt", None, 20)
+    assert graph.startswith("[0:v]fps=20,scale=320:-2")
+    assert "drawtext=fontfile=/fonts/font.ttf" in graph
+    assert "reverse" not in graph
+    assert "palettegen" not in graph
+    assert graph.endswith("[out]")
+
+    settings.crop = True
+    settings.boomerang = True
+    settings.format = "gif"
+    settings.colour = True
+    graph = build_filtergraph(settings, Path("/fonts/font.ttf"), None, tmp_path / "caption.txt", 20)
+    assert "crop=" in graph
+    assert "scale=320:320" in graph
+    assert "reverse" in graph
+    assert "palettegen" in graph
+    assert graph.endswith("[out]")
+
+def test_preview_filtergraph(settings, tmp_path):
+    settings.resolution = 480
+    settings.format = "gif"
+    settings.colour = True
+    settings.preview = True
+    graph = build_filtergraph(settings, Path("/fonts/font.ttf"), tmp_path / "text.txt", None, 10)
+    assert graph.startswith("[0:v]fps=10,scale=240:-2:flags=bilinear")
+    assert "fontsize=10" in graph
+    assert "palettegen" not in graph
+
+@pytest.fixture
+def slow_ffmpeg(monkeypatch):
+    """Make renders run a process that takes 30 seconds instead of ffmpeg."""
+    monkeypatch.setattr('subclipper.core.render.CANCEL_CHECK_SECONDS', 0.05)
+    commands = []
+
+    def build_slow_command(*args):
+        command = FFmpeg(executable=sys.executable).option('c', 'import time; time.sleep(30)')
+        commands.append(command)
+        return command
+
+    with patch('subclipper.core.render.build_command', side_effect=build_slow_command):
+        yield commands
+
+def test_cancelled_render_is_terminated(settings, tmp_path, slow_ffmpeg):
+    cancellation = Cancellation()
+    threading.Timer(0.3, cancellation.cancel, args=('superseded',)).start()
+
+    start = time.perf_counter()
+    with pytest.raises(RenderCancelled) as error:
+        render_clip(settings, tmp_path / "video.mkv", tmp_path / "font.ttf", tmp_path / "clip.webp", cancellation=cancellation)
+    assert error.value.reason == 'superseded'
+    assert time.perf_counter() - start < 10
+
+def test_render_is_cancelled_by_its_check(settings, tmp_path, slow_ffmpeg):
+    hung_up_at = time.perf_counter() + 0.3
+    cancellation = Cancellation(lambda: 'disconnected' if time.perf_counter() > hung_up_at else None)
+
+    with pytest.raises(RenderCancelled) as error:
+        render_clip(settings, tmp_path / "video.mkv", tmp_path / "font.ttf", tmp_path / "clip.webp", cancellation=cancellation)
+    assert error.value.reason == 'disconnected'
+    assert cancellation.reason == 'disconnected'
+
+def test_render_deadline(settings, tmp_path, slow_ffmpeg):
+    start = time.perf_counter()
+    with pytest.raises(RenderCancelled) as error:
+        render_clip(settings, tmp_path / "video.mkv", tmp_path / "font.ttf", tmp_path / "clip.webp", timeout=0.3)
+    assert error.value.reason == 'deadline'
+    assert time.perf_counter() - start < 10
+
+def test_cancelled_render_is_not_started(settings, tmp_path, slow_ffmpeg):
+    cancellation = Cancellation()
+    cancellation.cancel('abandoned')
+    with pytest.raises(RenderCancelled):
+        render_clip(settings, tmp_path / "video.mkv", tmp_path / "font.ttf", tmp_path / "clip.webp", cancellation=cancellation)
+    assert slow_ffmpeg == []
@@ -0,0 +1,153 @@
+import threading
+import time
+import pytest
+from pathlib import Path
+from unittest.mock import MagicMock
+from subclipper.core.render_jobs import RenderJobs, QueueFullError, DONE, FAILED, RUNNING
+
+def make_processor(output_path, error=None, block=None):
+    processor = MagicMock()
+    processor.clip_name.return_value = "clip.webp"
+    processor.cached_clip.return_value = None
+    processor.clip_in_flight.return_value = False
+
+    def generate_clip(settings, progress=None, cancellation=None):
+        if block is not None:
+            # Like a render, stop waiting when cancelled
+            while not block.wait(0.01):
+                if cancellation is not None and cancellation.cancelled:
+                    return None, f"Render cancelled: {cancellation.reason}"
+        return (None, error) if error else (output_path, None)
+
+    processor.generate_clip.side_effect = generate_clip
+    return processor
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out waiting"
+        time.sleep(0.01)
+
+def wait_for(jobs, job):
+    jobs._executor.shutdown(wait=True)
+    return jobs.get(job.id)
+
+def test_render_job_completes(tmp_path):
+    output_path = tmp_path / "clip.webp"
+    output_path.write_bytes(b"clip")
+    jobs = RenderJobs(make_processor(output_path), max_workers=1, max_queued=4)
+
+    job = wait_for(jobs, jobs.submit(MagicMock()))
+    assert job.status == DONE
+    assert job.output_path == output_path
+    assert job.to_dict()["progress"] == 1.0
+    assert job.to_dict()["render_seconds"] is not None
+
+def test_render_job_failure(tmp_path):
+    jobs = RenderJobs(make_processor(None, error="ffmpeg failed"), max_workers=1, max_queued=4)
+
+    job = wait_for(jobs, jobs.submit(MagicMock()))
+    assert job.status == FAILED
+    assert job.error == "ffmpeg failed"
+
+def test_identical_render_jobs_are_shared(tmp_path):
+    block = threading.Event()
+    processor = make_processor(tmp_path / "clip.webp", block=block)
+    jobs = RenderJobs(processor, max_workers=1, max_queued=4)
+
+    first = jobs.submit(MagicMock())
+    second = jobs.submit(MagicMock())
+    block.set()
+    assert first is second
+    wait_for(jobs, first)
+    assert processor.generate_clip.call_count == 1
+
+def test_render_queue_is_bounded(tmp_path):
+    block = threading.Event()
+    processor = make_processor(tmp_path / "clip.webp", block=block)
+    processor.clip_name.return_value = None
+    jobs = RenderJobs(processor, max_workers=1, max_queued=1)
+
+    jobs.submit(MagicMock())
+    # Wait for the first job to occupy the only render worker
+    wait_until(lambda: jobs.stats()["running"] == 1)
+    jobs.submit(MagicMock())
+    with pytest.raises(QueueFullError):
+        jobs.submit(MagicMock())
+    assert jobs.stats() == {"workers": 1, "queued": 1, "running": 1, "max_queued": 1}
+    block.set()
+
+def test_render_jobs_of_other_processes(tmp_path):
+    processor = make_processor(tmp_path / "clip.webp")
+    jobs = RenderJobs(processor, max_workers=1, max_queued=4)
+    assert jobs.get("other.webp") is None
+
+    processor.clip_in_flight.return_value = True
+    assert jobs.get("other.webp").status == RUNNING
+
+    processor.cached_clip.return_value = tmp_path / "other.webp"
+    job = jobs.get("other.webp")
+    assert job.status == DONE
+    assert job.output_path == tmp_path / "other.webp"
+
+def test_superseded_render_job_is_cancelled(tmp_path):
+    block = threading.Event()
+    processor = make_processor(tmp_path / "clip.webp", block=block)
+    processor.clip_name.side_effect = lambda settings: settings
+    jobs = RenderJobs(processor, max_workers=2, max_queued=4)
+
+    first = jobs.submit("a" * 32 + ".webp", session="one")
+    shared = jobs.submit("b" * 32 + ".webp", session="one")
+    assert jobs.submit("b" * 32 + ".webp", session="two") is shared
+    # Another session still wants the shared clip
+    jobs.submit("c" * 32 + ".webp", session="one")
+    wait_until(lambda: first.finished)
+    block.set()
+    jobs._executor.shutdown(wait=True)
+
+    assert first.status == FAILED
+    assert first.error == "Render cancelled: superseded"
+    assert shared.status == DONE
+
+def test_abandoned_render_job_is_cancelled(tmp_path):
+    block = threading.Event()
+    processor = make_processor(tmp_path / "clip.webp", block=block)
+    jobs = RenderJobs(processor, max_workers=1, max_queued=4, abandon_seconds=0.2)
+
+    job = wait_for(jobs, jobs.submit(MagicMock()))
+    assert job.status == FAILED
+    assert job.error == "Render cancelled: abandoned"
+
+def test_render_jobs_are_kept_alive_by_other_processes(tmp_path):
+    block = threading.Event()
+    processor = make_processor(tmp_path / "clip.webp", block=block)
+    processor.clip_name.return_value = "a" * 32 + ".webp"
+    jobs = RenderJobs(processor, max_workers=1, max_queued=4, abandon_seconds=0.5, heartbeat_dir=tmp_path / "render_jobs")
+    other = RenderJobs(processor, max_workers=1, max_queued=4, heartbeat_dir=tmp_path / "render_jobs")
+    processor.clip_in_flight.return_value = True
+
+    job = jobs.submit(MagicMock())
+    # Clients polling another worker process keep the job alive
+    for _ in range(10):
+        assert other.get(job.id).status == RUNNING
+        time.sleep(0.1)
+    assert not job.cancellation.cancelled
+    block.set()
+    assert wait_for(jobs, job).status == DONE
+
+def test_cancelled_queued_render_job_is_not_started(tmp_path):
+    block = threading.Event()
+    processor = make_processor(tmp_path / "clip.webp", block=block)
+    processor.clip_name.side_effect = lambda settings: settings
+    jobs = RenderJobs(processor, max_workers=1, max_queued=4)
+
+    jobs.submit("a" * 32 + ".webp")
+    wait_until(lambda: jobs.stats()["running"] == 1)
+    queued = jobs.submit("b" * 32 + ".webp", session="one")
+    jobs.submit("c" * 32 + ".webp", session="one")
+    block.set()
+    jobs._executor.shutdown(wait=True)
+
+    assert queued.status == FAILED
+    assert queued.error == "Render cancelled: superseded"
+    assert processor.generate_clip.call_count == 2
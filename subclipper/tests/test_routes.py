@@ -0,0 +1,108 @@
+import pytest
+from pathlib import Path
+from unittest.mock import patch
+from flask import render_template
+from subclipper.core.models import Subtitle, Video
+from subclipper.core.video_processor import VideoProcessor
+
+@pytest.fixture
+def sample_video_path():
+    return Path(__file__).parent.parent / "samples" / "sample.mp4"
+
+@pytest.fixture
+def processor(sample_video_path, tmp_path):
+    font_path = tmp_path / "font.ttf"
+    font_path.write_bytes(b"true")
+    processor = VideoProcessor(sample_video_path.parent, font_path, tmp_path / "cache")
+    subs = [Subtitle(id=idx, start=idx * 2, end=idx * 2 + 1.5, text=f"Line {idx}", video_id=0) for idx in range(10)]
+    processor._videos = [Video(id=0, title="sample", path=sample_video_path, subs=subs)]
+    processor._library_version = "v1"
+    return processor
+
+@pytest.fixture
+def client(processor, monkeypatch, tmp_path):
+    monkeypatch.setenv("SEARCH_PATH", str(processor.search_path))
+    monkeypatch.setenv("SHOW_NAME", "Test")
+    monkeypatch.setenv("CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("FONT_PATH", str(processor.font_path))
+    monkeypatch.setenv("THUMBNAILS", "false")
+    monkeypatch.setenv("RESCAN_INTERVAL", "0")
+    from subclipper.app import create_app, routes
+    from subclipper.utils.config import Config
+
+    config = Config()
+    config._video_processor = processor
+    monkeypatch.setattr(routes, "config", config)
+    return create_app().test_client()
+
+def test_range(client):
+    response = client.get("/range/0?start=3&end=6.2")
+    assert response.status_code == 200
+    page = response.get_data(as_text=True)
+    assert [f"Line {idx}" in page for idx in range(5)] == [False, True, True, True, False]
+
+@pytest.mark.parametrize("path, status", [
+    ("/range/0?start=3", 400),
+    ("/range/0?start=6&end=3", 400),
+    ("/range/0?start=a&end=3", 400),
+    ("/range/1?start=0&end=3", 404),
+    ("/range/x?start=0&end=3", 404),
+])
+def test_invalid_range(client, path, status):
+    assert client.get(path).status_code == status
+
+def fake_render_clip(settings, video_path, font_path, output_path, progress=None, cancellation=None, timeout=None, master=None):
+    output_path.write_bytes(b"RIFF" + bytes(range(256)) * 4)
+
+def test_gif_revalidation_does_not_render(client):
+    with patch('subclipper.core.video_processor.render_clip', side_effect=fake_render_clip) as mock_render_clip:
+        response = client.get("/gif?episode=0&start=2&end=3")
+        assert response.status_code == 200
+        etag = response.headers["ETag"]
+
+        response = client.get("/gif?episode=0&start=2&end=3", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+        assert mock_render_clip.call_count == 1
+
+        # Other settings are another clip
+        assert client.get("/gif?episode=0&start=2&end=3&text=Hi", headers={"If-None-Match": etag}).status_code == 200
+
+def test_gif_range(client):
+    with patch('subclipper.core.video_processor.render_clip', side_effect=fake_render_clip):
+        response = client.get("/gif?episode=0&start=2&end=3", headers={"Range": "bytes=4-7"})
+    assert response.status_code == 206
+    assert response.data == bytes(range(4))
+    assert response.headers["Content-Range"] == f"bytes 4-7/{4 + 256 * 4}"
+
+def test_page_revalidation_does_not_render(client, processor):
+    response = client.get("/?q=line")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    with patch.object(processor, 'search_subtitles_page', wraps=processor.search_subtitles_page) as mock_search, \
+            patch('subclipper.app.routes.render_template', wraps=render_template) as mock_render_template:
+        response = client.get("/?q=line", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert mock_search.call_count == 0
+    assert mock_render_template.call_count == 0
+    # HTMX requests get the fragment, which is another page
+    assert client.get("/?q=line", headers={"If-None-Match": etag, "HX-Request": "true"}).status_code == 200
+
+def test_pages_are_served_from_the_page_cache(client, processor):
+    with patch.object(processor, 'search_subtitles_page', wraps=processor.search_subtitles_page) as mock_search:
+        first = client.get("/?q=line")
+        second = client.get("/?q=line")
+    assert mock_search.call_count == 1
+    assert second.status_code == 200
+    assert second.data == first.data
+    assert second.headers["ETag"] == first.headers["ETag"]
+
+def test_library_changes_invalidate_cached_pages(client, processor):
+    first = client.get("/?q=line")
+    processor._library_version = "v2"
+    with patch.object(processor, 'search_subtitles_page', wraps=processor.search_subtitles_page) as mock_search:
+        second = client.get("/?q=line", headers={"If-None-Match": first.headers["ETag"]})
+    assert second.status_code == 200
+    assert mock_search.call_count == 1
+    assert second.headers["ETag"] != first.headers["ETag"]
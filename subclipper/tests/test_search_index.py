@@ -0,0 +1,120 @@
+import pytest
+from pathlib import Path
+from subclipper.core.models import Video, Subtitle
+from subclipper.core.search_index import SubtitleIndex
+
+TEXTS = [
+    "Hello world",
+    "Goodbye world",
+    "HELLO THERE",
+    "Straße in München",
+    "İstanbul",
+    "a",
+    "",
+    "world wide web",
+]
+
+def make_videos():
+    videos = []
+    for video_id in range(3):
+        subs = [
+            Subtitle(id=idx, start=idx, end=idx + 1, text=f"{text} {video_id}", video_id=video_id)
+            for idx, text in enumerate(TEXTS)
+        ]
+        videos.append(Video(id=video_id, title=f"video {video_id}", path=Path(f"/videos/{video_id}.mkv"), subs=subs))
+    return videos
+
+def linear_search(videos, query, video_id=None):
+    return [
+        sub
+        for video in videos
+        if video_id is None or video.id == video_id
+        for sub in video.subs
+        if query is None or query.lower() in sub.text.lower()
+    ]
+
+@pytest.mark.parametrize("query", [None, "", "w", "wo", "world", "hello", "LLO T", "straße", "i̇st", "xyz", "d 1", "web 2"])
+@pytest.mark.parametrize("video_id", [None, 0, 2, 5])
+def test_index_matches_linear_search(query, video_id):
+    videos = make_videos()
+    index = SubtitleIndex(videos)
+    assert index.search(query, video_id) == linear_search(videos, query, video_id)
+
+@pytest.mark.parametrize("query", [None, "world", "xyz", "a"])
+@pytest.mark.parametrize("video_id", [None, 1])
+@pytest.mark.parametrize("offset,limit", [(0, 5), (3, 4), (7, 10), (20, 5), (100, 5)])
+def test_index_pages_match_linear_search(query, video_id, offset, limit):
+    videos = make_videos()
+    index = SubtitleIndex(videos)
+    expected = linear_search(videos, query, video_id)
+    assert index.search_page(query, video_id, offset, limit) == (expected[offset:offset + limit], len(expected))
+
+def test_index_position_matches_linear_search():
+    videos = make_videos()
+    index = SubtitleIndex(videos)
+    everything = linear_search(videos, None)
+    for position, sub in enumerate(everything):
+        assert index.position(sub.video_id, sub.id) == position
+
+    assert index.position(0, len(TEXTS)) is None
+    assert index.position(5, 0) is None
+    assert index.position(0, -1) is None
+
+def test_index_update_reuses_unchanged_videos():
+    videos = make_videos()
+    index = SubtitleIndex(videos)
+
+    changed = Video(id=1, title="video 1", path=Path("/videos/1.mkv"), subs=[Subtitle(id=0, start=0, end=1, text="new world", video_id=1)])
+    added = Video(id=7, title="video 7", path=Path("/videos/7.mkv"), subs=[Subtitle(id=0, start=0, end=1, text="added world", video_id=7)])
+    updated_videos = [videos[0], changed, added]
+    updated = SubtitleIndex(updated_videos, index)
+
+    assert updated._video_indexes[0].postings is index._video_indexes[0].postings
+    assert updated.search("world") == linear_search(updated_videos, "world")
+    assert updated.position(7, 0) == len(TEXTS) + 1
+    assert updated.video(2) is None
+    assert updated.video(7) is added
+    # The previous index is left untouched for searches that are still using it
+    assert index.search("world") == linear_search(videos, "world")
+
+def make_ranked_index(texts):
+    subs = [Subtitle(id=idx, start=idx, end=idx + 1, text=text, video_id=0) for idx, text in enumerate(texts)]
+    return SubtitleIndex([Video(id=0, title="video", path=Path("/videos/0.mkv"), subs=subs)])
+
+def test_ranked_search_orders_by_relevance():
+    index = make_ranked_index([
+        "the ship is ready",
+        "the captain of the ship",
+        "captain",
+        "nothing to see here",
+        "the captain is on the ship, captain",
+    ])
+    subs, total = index.search_ranked_page("captain ship", None, 0, 10)
+    assert total == 4
+    # Matching both words beats repeating one, a rare word beats a common one
+    assert [sub.id for sub in subs] == [4, 1, 2, 0]
+    assert index.search_ranked_page("captain ship", None, 1, 2) == (subs[1:3], 4)
+
+def test_ranked_search_phrases():
+    index = make_ranked_index(["see you later", "later, see you!", "you see", "see you"])
+    subs, total = index.search_ranked_page('"see you" later', None, 0, 10)
+    assert total == 3
+    # Punctuation does not break up a phrase, equally good matches keep their order
+    assert [sub.id for sub in subs] == [0, 1, 3]
+    assert index.search_ranked_page('"later you"', None, 0, 10) == ([], 0)
+    assert index.search_ranked_page('"see you" "missing phrase"', None, 0, 10) == ([], 0)
+
+def test_ranked_search_tolerates_typos():
+    index = make_ranked_index(["a wizard arrives", "the lizard", "the wizards"])
+    subs, total = index.search_ranked_page("wizzard", None, 0, 10)
+    assert [sub.id for sub in subs] == [0]
+    # A word that does occur is not matched with typos
+    assert [sub.id for sub in index.search_ranked_page("wizard", None, 0, 10)[0]] == [0]
+
+@pytest.mark.parametrize("video_id", [None, 1])
+def test_ranked_search_without_words_lists_everything(video_id):
+    videos = make_videos()
+    index = SubtitleIndex(videos)
+    assert index.search_ranked_page(' ". ', video_id, 2, 5) == index.search_page(None, video_id, 2, 5)
+    subs, total = index.search_ranked_page("world", video_id, 0, 100)
+    assert sorted(subs, key=lambda sub: (sub.video_id, sub.id)) == linear_search(videos, "world", video_id)
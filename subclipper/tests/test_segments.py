@@ -0,0 +1,42 @@
+import json
+import pytest
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+from subclipper.core.segments import MAX_SEGMENT_SECONDS, probe_keyframes, segment_bounds, segment_key
+
+def test_probe_keyframes():
+    probe = {
+        'packets': [
+            {'pts_time': '1.400000', 'flags': 'K__'},
+            {'pts_time': '1.441667', 'flags': '___'},
+            {'pts_time': '3.400000', 'flags': 'K__'},
+            {'pts_time': 'N/A', 'flags': 'K__'},
+        ],
+        'format': {'start_time': '1.400000'},
+    }
+    with patch('subclipper.core.segments.subprocess.run', return_value=MagicMock(stdout=json.dumps(probe).encode())) as run:
+        assert probe_keyframes(Path("episode.mkv")) == [0.0, 2.0]
+    assert run.call_args[0][0][0] == 'ffprobe'
+
+@pytest.mark.parametrize("start, end, bounds", [
+    (0.5, 3.0, (0.0, 4.0)),
+    (2.0, 3.0, (2.0, 4.0)),
+    (2.0, 4.0, (2.0, 6.0)),
+    (6.5, 7.0, (6.0, None)),
+])
+def test_segment_bounds(start, end, bounds):
+    assert segment_bounds([0.0, 2.0, 4.0, 6.0], start, end) == bounds
+
+def test_segment_bounds_without_useful_keyframes():
+    assert segment_bounds([1.0, 2.0], 0.5, 1.5) is None
+    assert segment_bounds([0.0, MAX_SEGMENT_SECONDS + 1], 1.0, 2.0) is None
+
+def test_segment_key_changes_with_the_video(tmp_path):
+    video_path = tmp_path / "episode.mkv"
+    video_path.write_bytes(b"video")
+    key = segment_key(video_path, 2.0, 4.0)
+    assert key == segment_key(video_path, 2.0, 4.0)
+    assert key != segment_key(video_path, 2.0, None)
+
+    video_path.write_bytes(b"a different video")
+    assert key != segment_key(video_path, 2.0, 4.0)
@@ -0,0 +1,116 @@
+import threading
+import time
+import pytest
+from subclipper.core.single_flight import SingleFlight, SingleFlightError
+
+def run_concurrently(count, target):
+    results = [None] * count
+    def run(i):
+        try:
+            results[i] = target()
+        except Exception as e:
+            results[i] = e
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def test_concurrent_calls_are_coalesced(tmp_path):
+    single_flight = SingleFlight(tmp_path)
+    calls = []
+
+    def render():
+        calls.append(1)
+        time.sleep(0.2)
+        return "clip"
+
+    results = run_concurrently(5, lambda: single_flight.do("key", render, lambda: None))
+    assert results == ["clip"] * 5
+    assert len(calls) == 1
+    assert list(tmp_path.glob("*.lock")) == []
+
+def test_failure_is_shared_with_all_waiters(tmp_path):
+    single_flight = SingleFlight(tmp_path)
+    calls = []
+
+    def render():
+        calls.append(1)
+        time.sleep(0.2)
+        raise RuntimeError("ffmpeg failed")
+
+    results = run_concurrently(5, lambda: single_flight.do("key", render, lambda: None))
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert len(calls) == 1
+
+def test_calls_are_coalesced_across_processes(tmp_path):
+    # Separate instances only share the lock directory, like separate worker processes
+    first, second = SingleFlight(tmp_path), SingleFlight(tmp_path)
+    output = []
+
+    def render():
+        time.sleep(0.2)
+        output.append("clip")
+        return "clip"
+
+    def check():
+        return output[0] if output else None
+
+    def second_render():
+        raise AssertionError("the second process should not render")
+
+    def run_second():
+        time.sleep(0.05)
+        return second.do("key", second_render, check)
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(run_second()))
+    thread.start()
+    assert first.do("key", render, check) == "clip"
+    thread.join()
+    assert results == ["clip"]
+
+def test_failure_is_shared_across_processes(tmp_path):
+    first, second = SingleFlight(tmp_path), SingleFlight(tmp_path)
+
+    def render():
+        time.sleep(0.2)
+        raise RuntimeError("ffmpeg failed")
+
+    def second_render():
+        raise AssertionError("the second process should not render")
+
+    errors = []
+    def run_second():
+        time.sleep(0.05)
+        try:
+            second.do("key", second_render, lambda: None)
+        except SingleFlightError as e:
+            errors.append(str(e))
+
+    thread = threading.Thread(target=run_second)
+    thread.start()
+    with pytest.raises(RuntimeError):
+        first.do("key", render, lambda: None)
+    thread.join()
+    assert errors == ["ffmpeg failed"]
+
+def test_waiters_retry_calls_that_were_given_up(tmp_path):
+    single_flight = SingleFlight(tmp_path)
+    calls = []
+
+    def render():
+        calls.append(1)
+        time.sleep(0.2)
+        if len(calls) == 1:
+            raise LookupError("cancelled")
+        return "clip"
+
+    results = run_concurrently(3, lambda: single_flight.do("key", render, lambda: None, retry=lambda e: isinstance(e, LookupError)))
+    # The first caller gets its own error, the others render the clip again once
+    assert sum(isinstance(result, LookupError) for result in results) == 1
+    assert results.count("clip") == 2
+    assert len(calls) == 2
+    # Given up calls are not reported to other processes as failures
+    assert list(tmp_path.glob("*.err")) == []
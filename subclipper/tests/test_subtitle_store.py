@@ -0,0 +1,55 @@
+import pytest
+from pathlib import Path
+from subclipper.core.models import Subtitle
+from subclipper.core.subtitle_store import StoreError, SubtitleStore, build_store, library_version
+
+VIDEOS = [
+    ({'id': 0, 'title': 'first'}, [(0.0, 1.5, "Hello world"), (2.0, 3.25, "Straße in München")]),
+    ({'id': 3, 'title': 'empty'}, []),
+    ({'id': 4, 'title': 'last'}, [(10.0, 11.0, "İstanbul\\Nline")]),
+]
+
+@pytest.fixture
+def store(tmp_path):
+    path = tmp_path / "library.store"
+    SubtitleStore.write(path, build_store(VIDEOS))
+    return SubtitleStore.open(path)
+
+def test_store_roundtrip(store):
+    assert [video['title'] for video in store.videos] == ['first', 'empty', 'last']
+    assert len(store) == 3
+    assert list(store.video_ids) == [0, 0, 4]
+
+    first, empty, last = (store.subtitles(video) for video in store.videos)
+    assert len(first) == 2 and len(empty) == 0 and len(last) == 1
+    assert first[1] == Subtitle(id=1, start=2.0, end=3.25, text="Straße in München", video_id=0)
+    assert first[-1] == first[1]
+    assert last == [Subtitle(id=0, start=10.0, end=11.0, text="İstanbul\\Nline", video_id=4)]
+    assert last.events() == VIDEOS[2][1]
+    with pytest.raises(IndexError):
+        first[2]
+
+def test_store_matcher(store):
+    first = store.subtitles(store.videos[0])
+    assert first.normalized_text(1) == "straße in münchen"
+    assert first.matcher("münch")(1)
+    assert not first.matcher("münch")(0)
+    # Matches never cross into the next subtitle
+    assert not first.matcher("worldstraße")(0)
+
+def test_corrupt_store(tmp_path):
+    path = tmp_path / "library.store"
+    path.write_bytes(build_store(VIDEOS)[:-5])
+    with pytest.raises(StoreError):
+        SubtitleStore.open(path)
+
+    path.write_bytes(b"not a store")
+    with pytest.raises(StoreError):
+        SubtitleStore.open(path)
+
+def test_library_version():
+    files = {Path("/videos/a.mkv"): (10, 100), Path("/videos/b.mkv"): (20, 200)}
+    ids = {Path("/videos/a.mkv"): 0, Path("/videos/b.mkv"): 1}
+    version = library_version(files, ids)
+    assert version == library_version(dict(reversed(list(files.items()))), ids)
+    assert version != library_version({**files, Path("/videos/b.mkv"): (20, 201)}, ids)
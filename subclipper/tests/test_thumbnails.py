@@ -0,0 +1,127 @@
+import io
+import os
+import pytest
+import threading
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+from PIL import Image
+from subclipper.core.models import Video, Subtitle
+from subclipper.core.thumbnails import ThumbnailSprites, fcntl, TILE_WIDTH, TILE_HEIGHT, SAMPLE_FPS
+
+def fake_ffmpeg(frame_count):
+    """Fake an ffmpeg process that decodes `frame_count` frames, each filled with its frame number."""
+    frames = b''.join(bytes([frame]) * (TILE_WIDTH * TILE_HEIGHT * 3) for frame in range(frame_count))
+    process = MagicMock()
+    process.stdout = io.BytesIO(frames)
+    return MagicMock(return_value=process)
+
+@pytest.fixture
+def video(tmp_path):
+    video_path = tmp_path / "episode.mkv"
+    video_path.write_bytes(b"video")
+    subs = [
+        Subtitle(id=0, start=0.0, end=1.0, text="first", video_id=0),
+        # Shares its midpoint frame with the first subtitle
+        Subtitle(id=1, start=0.2, end=0.8, text="second", video_id=0),
+        Subtitle(id=2, start=2.0, end=3.0, text="third", video_id=0),
+        # Past the end of the video
+        Subtitle(id=3, start=100.0, end=101.0, text="fourth", video_id=0),
+    ]
+    return Video(id=0, title="episode", path=video_path, subs=subs)
+
+def test_generate_sprite_sheet(tmp_path, video):
+    sprites = ThumbnailSprites(tmp_path / "thumbnails")
+    popen = fake_ffmpeg(10)
+    with patch("subclipper.core.thumbnails.subprocess.Popen", popen):
+        sprites.generate(video)
+
+    # A single decode of the video for all subtitles
+    assert popen.call_count == 1
+    first, second, third, fourth = (sprites.thumbnail(video, position) for position in range(4))
+    assert (first.x, first.y) == (0, 0)
+    assert second == first
+    assert (third.x, third.y) == (TILE_WIDTH, 0)
+    assert fourth is None
+
+    sheet = Image.open(tmp_path / "thumbnails" / first.sprite)
+    assert sheet.width == 10 * TILE_WIDTH
+    # The frame closest to the midpoint of the third subtitle
+    assert abs(sheet.getpixel((TILE_WIDTH + 80, 45))[0] - round(2.5 * SAMPLE_FPS)) <= 2
+
+def test_generation_is_resumable(tmp_path, video):
+    with patch("subclipper.core.thumbnails.subprocess.Popen", fake_ffmpeg(10)):
+        ThumbnailSprites(tmp_path / "thumbnails").generate(video)
+
+    # Sprite sheets generated before a restart are reused
+    popen = fake_ffmpeg(10)
+    sprites = ThumbnailSprites(tmp_path / "thumbnails")
+    with patch("subclipper.core.thumbnails.subprocess.Popen", popen):
+        sprites.generate(video)
+    assert popen.call_count == 0
+    assert sprites.thumbnail(video, 0) is not None
+
+def test_missing_thumbnails(tmp_path, video):
+    sprites = ThumbnailSprites(tmp_path / "thumbnails")
+    assert sprites.thumbnail(video, 0) is None
+
+    with patch("subclipper.core.thumbnails.subprocess.Popen", fake_ffmpeg(0)):
+        with pytest.raises(Exception):
+            sprites.generate(video)
+    assert list((tmp_path / "thumbnails").glob("*.json")) == []
+
+@pytest.mark.skipif(fcntl is None, reason="sprite sheets are not locked without fcntl")
+def test_generation_locked_by_another_process(tmp_path, video):
+    sprites = ThumbnailSprites(tmp_path / "thumbnails")
+    lock_path = tmp_path / "thumbnails" / f"{sprites.sprite_name(video)}.lock"
+    lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.flock(lock_fd, fcntl.LOCK_EX)
+    try:
+        popen = fake_ffmpeg(10)
+        with patch("subclipper.core.thumbnails.subprocess.Popen", popen):
+            sprites.generate(video)
+        assert popen.call_count == 0
+        # The lock file belongs to the process generating the sprite sheet
+        assert lock_path.exists()
+    finally:
+        os.close(lock_fd)
+
+def test_changed_video_does_not_reuse_thumbnails(tmp_path, video):
+    sprites = ThumbnailSprites(tmp_path / "thumbnails")
+    with patch("subclipper.core.thumbnails.subprocess.Popen", fake_ffmpeg(10)):
+        sprites.generate(video)
+    assert sprites.thumbnail(video, 0) is not None
+
+    video.path.write_bytes(b"changed video")
+    os.utime(video.path, ns=(1, 1))
+    assert sprites.thumbnail(video, 0) is None
+
+def test_prune_removes_thumbnails_of_removed_and_changed_videos(tmp_path, video):
+    sprites = ThumbnailSprites(tmp_path / "thumbnails")
+    with patch("subclipper.core.thumbnails.subprocess.Popen", fake_ffmpeg(10)):
+        sprites.generate(video)
+    old_sprite = sprites.sprite_name(video)
+
+    sprites.prune([video])
+    assert (tmp_path / "thumbnails" / old_sprite).exists()
+
+    video.path.write_bytes(b"changed video")
+    os.utime(video.path, ns=(1, 1))
+    with patch("subclipper.core.thumbnails.subprocess.Popen", fake_ffmpeg(10)):
+        sprites.generate(video)
+    sprites.prune([video])
+    assert sorted(path.name for path in (tmp_path / "thumbnails").iterdir()) == sorted(
+        [sprites.sprite_name(video), f"{sprites.sprite_name(video)}.json"]
+    )
+
+    sprites.prune([])
+    assert list((tmp_path / "thumbnails").iterdir()) == []
+
+def test_start_queues_after_pending_videos(tmp_path, video):
+    sprites = ThumbnailSprites(tmp_path / "thumbnails")
+    other = Video(id=1, title="other", path=tmp_path / "other.mkv", subs=[])
+    changed = Video(id=0, title="episode", path=video.path, subs=video.subs[:1])
+    # Keep the background thread from picking up the queue
+    with patch.object(threading.Thread, "start"):
+        sprites.start([video])
+        sprites.start([other, changed])
+    assert sprites._pending == [changed, other]
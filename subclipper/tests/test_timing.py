@@ -0,0 +1,22 @@
+import contextvars
+import pytest
+from subclipper.core import timing
+
+def test_stages_are_recorded_in_order():
+    def request():
+        timing.start()
+        with timing.stage('lookup'):
+            pass
+        with pytest.raises(ValueError):
+            with timing.stage('render'):
+                raise ValueError()
+        timing.record('encode', 0.25)
+        return timing.collected()
+
+    timings = contextvars.copy_context().run(request)
+    assert [name for name, _ in timings] == ['lookup', 'render', 'encode']
+    assert timing.server_timing_header(timings[2:]) == 'encode;dur=250.0'
+
+def test_nothing_is_recorded_outside_requests():
+    contextvars.copy_context().run(lambda: timing.record('encode', 1.0))
+    assert contextvars.copy_context().run(timing.collected) == []
@@ -1,8 +1,14 @@
 import pytest
 from pathlib import Path
-from unittest.mock import MagicMock, patch
+from unittest.mock import ANY, MagicMock, patch
+import os
 import platform
+import threading
+import time
+from tempfile import mkstemp as tempfile_mkstemp
 from subclipper.core.video_processor import VideoProcessor
+from subclipper.core.metrics import metrics
+from subclipper.core.render import Cancellation, RenderCancelled, RenderError
 from subclipper.core.models import Video, Subtitle, ClipSettings
 
 def get_system_font():
@@ -96,11 +102,12 @@ def test_generate_clip(video_processor, system_font_path, sample_video_path):
         font_path=system_font_path
     )
     
-    with patch('subclipper.core.video_processor.generate_video') as mock_generate_video:
-        mock_generate_video.return_value = (None, True)
+    with patch('subclipper.core.video_processor.render_clip') as mock_render_clip:
         output_path, error = video_processor.generate_clip(settings)
         assert error is None
         assert output_path is not None
+        video_processor.release_clip(output_path)
+        assert not output_path.exists()
         
     # Test with invalid settings
     settings.episode = 999
@@ -136,8 +143,433 @@ def test_generate_clip_error_handling(video_processor, system_font_path, sample_
         font_path=system_font_path
     )
     
-    with patch('subclipper.core.video_processor.generate_video') as mock_generate_video:
-        mock_generate_video.return_value = ("Error generating video", False)
+    with patch('subclipper.core.video_processor.render_clip') as mock_render_clip:
+        mock_render_clip.side_effect = RenderError("Error generating video")
         output_path, error = video_processor.generate_clip(settings)
         assert error == "Error generating video"
-        assert output_path is None 
\ No newline at end of file
+        assert output_path is None
+
+def test_load_videos_uses_catalog(sample_video_path, system_font_path, tmp_path):
+    processor = VideoProcessor(sample_video_path.parent, system_font_path, tmp_path)
+    subs = [Subtitle(id=0, start=0, end=1, text="Hello world", video_id=0)]
+
+    with patch('pathlib.Path.glob') as mock_glob, \
+            patch.object(VideoProcessor, '_extract_subtitles', return_value=subs) as mock_extract:
+        mock_glob.return_value = [sample_video_path]
+        processor.load_videos()
+
+        # A fresh processor should find the subtitles in the catalog instead of extracting them again
+        cached_processor = VideoProcessor(sample_video_path.parent, system_font_path, tmp_path)
+        videos = cached_processor.load_videos()
+
+    assert mock_extract.call_count == 1
+    assert videos[0].subs == subs
+
+def test_load_videos_parallel(sample_video_path, system_font_path):
+    sequential = VideoProcessor(sample_video_path.parent, system_font_path).load_videos()
+    parallel = VideoProcessor(sample_video_path.parent, system_font_path, extraction_workers=2).load_videos()
+
+    assert [video.id for video in parallel] == [video.id for video in sequential]
+    assert [video.path for video in parallel] == [video.path for video in sequential]
+    assert [video.subs for video in parallel] == [video.subs for video in sequential]
+
+def test_search_subtitles_page(video_processor, sample_video_path):
+    subs = [Subtitle(id=idx, start=idx, end=idx + 1, text=f"Hello {idx}", video_id=0) for idx in range(5)]
+    video_processor._videos = [Video(id=0, title="sample", path=sample_video_path, subs=subs)]
+
+    results, total = video_processor.search_subtitles_page("hello", None, 1, 2)
+    assert total == 5
+    assert results == subs[2:4]
+
+    results, total = video_processor.search_subtitles_page("hello", None, 3, 2)
+    assert total == 5
+    assert results == []
+
+def test_generate_clip_uses_cache(sample_video_path, system_font_path, tmp_path):
+    font_path = tmp_path / "font.ttf"
+    font_path.write_bytes(b"font")
+    processor = VideoProcessor(sample_video_path.parent, font_path, tmp_path, clip_cache_bytes=1024 * 1024)
+    processor._videos = [Video(id=0, title="sample", path=sample_video_path, subs=[])]
+
+    settings = ClipSettings(
+        start_time=0.0,
+        end_time=5.0,
+        original_start_time=0.0,
+        original_end_time=5.0,
+        text="Test",
+        crop=False,
+        resolution=500,
+        id=0,
+        episode=0,
+        font_size=20,
+        caption="",
+        boomerang=False,
+        colour=False,
+        format="webp",
+        font_path=font_path
+    )
+
+    def fake_render_clip(settings, video_path, font_path, output_path, progress=None, cancellation=None, timeout=None, master=None):
+        output_path.write_bytes(b"clip")
+
+    with patch('subclipper.core.video_processor.render_clip', side_effect=fake_render_clip) as mock_render_clip:
+        output_path, error = processor.generate_clip(settings)
+        processor.release_clip(output_path)
+        cached_path, cached_error = processor.generate_clip(settings)
+
+    assert error is None and cached_error is None
+    assert cached_path == output_path
+    assert cached_path.read_bytes() == b"clip"
+    assert mock_render_clip.call_count == 1
+    assert list((tmp_path / "clips").glob("*.tmp")) == []
+
+def cancelled_renders(reason):
+    prefix = f'subclipper_renders_cancelled_total{{reason="{reason}"}} '
+    return next((float(line[len(prefix):]) for line in metrics.render().splitlines() if line.startswith(prefix)), 0)
+
+def wait_for_cancellation(settings, video_path, font_path, output_path, progress=None, cancellation=None, timeout=None, master=None):
+    """Render like ffmpeg does until the render is cancelled."""
+    output_path.write_bytes(b"partial")
+    deadline = time.time() + 10
+    while not cancellation.cancelled:
+        assert time.time() < deadline, "render was not cancelled"
+        time.sleep(0.01)
+    raise RenderCancelled(cancellation.reason)
+
+def clip_settings(font_path, **overrides):
+    values = dict(
+        start_time=0.0, end_time=5.0, original_start_time=0.0, original_end_time=5.0, text="Test",
+        crop=False, resolution=500, id=0, episode=0, font_size=20, caption="", boomerang=False,
+        colour=False, format="webp", font_path=font_path,
+    )
+    values.update(overrides)
+    return ClipSettings(**values)
+
+@pytest.mark.parametrize("clip_cache_bytes", [0, 1024 * 1024])
+def test_cancelled_render_is_cleaned_up(sample_video_path, tmp_path, clip_cache_bytes):
+    font_path = tmp_path / "font.ttf"
+    font_path.write_bytes(b"font")
+    processor = VideoProcessor(sample_video_path.parent, font_path, tmp_path, clip_cache_bytes=clip_cache_bytes)
+    processor._videos = [Video(id=0, title="sample", path=sample_video_path, subs=[])]
+    cancellation = Cancellation()
+    threading.Timer(0.1, cancellation.cancel, args=('superseded',)).start()
+    before = cancelled_renders('superseded')
+
+    with patch('subclipper.core.video_processor.render_clip', side_effect=wait_for_cancellation), \
+            patch('subclipper.core.video_processor.tempfile.mkstemp', side_effect=lambda **kwargs: tempfile_mkstemp(dir=tmp_path, **kwargs)):
+        output_path, error = processor.generate_clip(clip_settings(font_path), cancellation=cancellation)
+
+    assert output_path is None
+    assert error == "Render cancelled: superseded"
+    assert cancelled_renders('superseded') == before + 1
+    assert list(tmp_path.rglob("*.webp*")) == []
+
+def test_shared_render_is_only_cancelled_when_all_waiters_are(sample_video_path, tmp_path):
+    font_path = tmp_path / "font.ttf"
+    font_path.write_bytes(b"font")
+    processor = VideoProcessor(sample_video_path.parent, font_path, tmp_path, clip_cache_bytes=1024 * 1024)
+    processor._videos = [Video(id=0, title="sample", path=sample_video_path, subs=[])]
+    first, second = Cancellation(), Cancellation()
+    results = {}
+
+    def generate(name, cancellation):
+        results[name] = processor.generate_clip(clip_settings(font_path), cancellation=cancellation)
+
+    with patch('subclipper.core.video_processor.render_clip', side_effect=wait_for_cancellation) as mock_render_clip:
+        threads = [threading.Thread(target=generate, args=(name, c)) for name, c in (("first", first), ("second", second))]
+        for thread in threads:
+            thread.start()
+        deadline = time.time() + 10
+        while sum(len(waiters) for waiters in list(processor._clip_waiters.values())) < 2 or mock_render_clip.call_count == 0:
+            assert time.time() < deadline, "clip was not requested twice"
+            time.sleep(0.01)
+        first.cancel('disconnected')
+        time.sleep(0.2)
+        # The second waiter still wants the clip
+        assert mock_render_clip.call_count == 1
+        second.cancel('disconnected')
+        for thread in threads:
+            thread.join(timeout=10)
+
+    assert results["first"] == (None, "Render cancelled: disconnected")
+    assert results["second"] == (None, "Render cancelled: disconnected")
+    assert processor._clip_waiters == {}
+
+def test_clips_are_rendered_from_cached_segments(sample_video_path, tmp_path):
+    font_path = tmp_path / "font.ttf"
+    font_path.write_bytes(b"font")
+    processor = VideoProcessor(sample_video_path.parent, font_path, tmp_path, segment_cache_bytes=1024 * 1024)
+    processor._videos = [Video(id=0, title="sample", path=sample_video_path, subs=[])]
+    processor._get_catalog().put_keyframes(sample_video_path, sample_video_path.stat(), [0.0, 2.0, 4.0, 6.0])
+
+    def fake_cut_segment(video_path, start, end, output_path):
+        output_path.write_bytes(b"segment")
+
+    def fake_render_clip(settings, video_path, font_path, output_path, progress=None, cancellation=None, timeout=None, master=None):
+        output_path.write_bytes(b"clip")
+
+    with patch('subclipper.core.video_processor.cut_segment', side_effect=fake_cut_segment) as mock_cut_segment, \
+            patch('subclipper.core.video_processor.render_clip', side_effect=fake_render_clip) as mock_render_clip:
+        for text in ("Test", "Other text"):
+            output_path, error = processor.generate_clip(clip_settings(font_path, start_time=2.5, end_time=3.5, text=text))
+            assert error is None
+            processor.release_clip(output_path)
+
+    mock_cut_segment.assert_called_once_with(sample_video_path, 2.0, 4.0, ANY)
+    for call in mock_render_clip.call_args_list:
+        rendered_settings, source_path = call.args[:2]
+        assert source_path.parent == tmp_path / "segments"
+        assert (rendered_settings.start_time, rendered_settings.end_time) == (0.5, 1.5)
+
+def test_failed_segment_renders_fall_back_to_the_video(sample_video_path, tmp_path):
+    font_path = tmp_path / "font.ttf"
+    font_path.write_bytes(b"font")
+    processor = VideoProcessor(sample_video_path.parent, font_path, tmp_path, segment_cache_bytes=1024 * 1024)
+    processor._videos = [Video(id=0, title="sample", path=sample_video_path, subs=[])]
+    processor._get_catalog().put_keyframes(sample_video_path, sample_video_path.stat(), [0.0, 2.0, 4.0, 6.0])
+
+    def fake_cut_segment(video_path, start, end, output_path):
+        output_path.write_bytes(b"broken segment")
+
+    def fake_render_clip(settings, video_path, font_path, output_path, progress=None, cancellation=None, timeout=None, master=None):
+        if video_path != sample_video_path:
+            raise RenderError("Invalid data found when processing input")
+        output_path.write_bytes(b"clip")
+
+    with patch('subclipper.core.video_processor.cut_segment', side_effect=fake_cut_segment), \
+            patch('subclipper.core.video_processor.render_clip', side_effect=fake_render_clip) as mock_render_clip:
+        output_path, error = processor.generate_clip(clip_settings(font_path, start_time=2.5, end_time=3.5))
+
+    assert error is None
+    assert output_path.read_bytes() == b"clip"
+    assert mock_render_clip.call_args.args[0].start_time == 2.5
+    processor.release_clip(output_path)
+
+def test_keyframes_are_probed_once(sample_video_path, tmp_path):
+    processor = VideoProcessor(sample_video_path.parent, tmp_path / "font.ttf", tmp_path, segment_cache_bytes=1024 * 1024)
+    processor._get_segment_cache()
+    video = Video(id=0, title="sample", path=sample_video_path, subs=[])
+
+    with patch('subclipper.core.video_processor.probe_keyframes', return_value=[0.0, 2.0]) as mock_probe:
+        assert processor._video_keyframes(video) is None
+        assert processor._video_keyframes(video, probe=True) == [0.0, 2.0]
+        # Other processes find them in the catalog
+        other = VideoProcessor(sample_video_path.parent, tmp_path / "font.ttf", tmp_path, segment_cache_bytes=1024 * 1024)
+        assert other._video_keyframes(video, probe=True) == [0.0, 2.0]
+    assert mock_probe.call_count == 1
+
+def fake_render_clip_with_master(settings, video_path, font_path, output_path, progress=None, cancellation=None, timeout=None, master=None):
+    output_path.write_bytes(b"clip")
+    if master is not None:
+        master[0].write_bytes(b"master")
+
+def test_smaller_clips_are_derived_from_the_master(sample_video_path, tmp_path):
+    font_path = tmp_path / "font.ttf"
+    font_path.write_bytes(b"font")
+    processor = VideoProcessor(sample_video_path.parent, font_path, tmp_path, master_cache_bytes=1024 * 1024)
+    processor._videos = [Video(id=0, title="sample", path=sample_video_path, subs=[])]
+
+    with patch('subclipper.core.video_processor.render_clip', side_effect=fake_render_clip_with_master) as mock_render_clip:
+        for overrides in (dict(), dict(resolution=250, text="Other", format="gif"), dict(preview=True)):
+            output_path, error = processor.generate_clip(clip_settings(font_path, start_time=2.5, end_time=3.5, **overrides))
+            assert error is None
+            processor.release_clip(output_path)
+
+    first, *derived = mock_render_clip.call_args_list
+    # The first render decodes the video and writes the master in the same pass
+    assert first.args[1] == sample_video_path
+    assert first.kwargs['master'][1] == 500
+    master_path = tmp_path / "masters" / f"{first.kwargs['master'][0].name.split('.')[0]}.500.mkv"
+    assert master_path.read_bytes() == b"master"
+    for call in derived:
+        rendered_settings, source_path = call.args[:2]
+        assert source_path == master_path
+        assert (rendered_settings.start_time, rendered_settings.end_time) == (0.0, 1.0)
+        assert call.kwargs['master'] is None
+    assert list((tmp_path / "masters").glob("*.tmp")) == []
+
+def test_larger_clips_replace_the_master(sample_video_path, tmp_path):
+    font_path = tmp_path / "font.ttf"
+    font_path.write_bytes(b"font")
+    processor = VideoProcessor(sample_video_path.parent, font_path, tmp_path, master_cache_bytes=1024 * 1024, master_max_resolution=800)
+    processor._videos = [Video(id=0, title="sample", path=sample_video_path, subs=[])]
+
+    with patch('subclipper.core.video_processor.render_clip', side_effect=fake_render_clip_with_master) as mock_render_clip:
+        for resolution in (300, 600, 1000):
+            output_path, error = processor.generate_clip(clip_settings(font_path, resolution=resolution))
+            assert error is None
+            processor.release_clip(output_path)
+
+    assert all(call.args[1] == sample_video_path for call in mock_render_clip.call_args_list)
+    # Clips above the ceiling neither use nor write a master
+    assert [call.kwargs['master'] and call.kwargs['master'][1] for call in mock_render_clip.call_args_list] == [300, 600, None]
+    assert [path.name.split('.')[1] for path in (tmp_path / "masters").glob("*.mkv")] == ["600"]
+
+def fake_render_clips(clips, video_path, font_path, output_paths, cancellation=None, timeout=None):
+    for settings, output_path in zip(clips, output_paths):
+        output_path.write_bytes(settings.text.encode())
+
+def test_export_clips_renders_each_video_once(sample_video_path, tmp_path):
+    font_path = tmp_path / "font.ttf"
+    font_path.write_bytes(b"font")
+    processor = VideoProcessor(sample_video_path.parent, font_path, tmp_path, clip_cache_bytes=1024 * 1024)
+    processor._videos = [Video(id=0, title="sample", path=sample_video_path, subs=[])]
+    clips = [
+        clip_settings(font_path, start_time=4.0, end_time=5.0, text="second"),
+        clip_settings(font_path, start_time=0.0, end_time=20.0, text="too long"),
+        clip_settings(font_path, start_time=1.0, end_time=2.0, text="first"),
+    ]
+
+    with patch('subclipper.core.video_processor.render_clips', side_effect=fake_render_clips) as mock_render_clips:
+        results = sorted(processor.export_clips(clips, workers=2), key=lambda result: result[0])
+        # Exported clips are cached like any other clip
+        again = list(processor.export_clips([clips[0]]))
+
+    assert mock_render_clips.call_count == 1
+    assert [settings.text for settings in mock_render_clips.call_args.args[0]] == ["first", "second"]
+    assert [output_path.read_bytes() for _, output_path, _ in (results[0], results[2])] == [b"second", b"first"]
+    assert results[1][1] is None and "clip too long" in results[1][2]
+    assert again == [(0, results[0][1], None)]
+
+def test_failed_export_batches_are_rendered_clip_by_clip(sample_video_path, tmp_path):
+    font_path = tmp_path / "font.ttf"
+    font_path.write_bytes(b"font")
+    processor = VideoProcessor(sample_video_path.parent, font_path, tmp_path)
+    processor._videos = [Video(id=0, title="sample", path=sample_video_path, subs=[])]
+    clips = [clip_settings(font_path, start_time=1.0, end_time=2.0, text="fine"), clip_settings(font_path, start_time=4.0, end_time=5.0, text="broken")]
+
+    def render_clips_failing_on_broken(clips, video_path, font_path, output_paths, cancellation=None, timeout=None):
+        if any(settings.text == "broken" for settings in clips):
+            raise RenderError("Output file is empty")
+        fake_render_clips(clips, video_path, font_path, output_paths)
+
+    with patch('subclipper.core.video_processor.render_clips', side_effect=render_clips_failing_on_broken) as mock_render_clips:
+        results = sorted(processor.export_clips(clips), key=lambda result: result[0])
+
+    assert mock_render_clips.call_count == 3
+    assert results[0][1].read_bytes() == b"fine"
+    assert results[1] == (1, None, "Output file is empty")
+    processor.release_clip(results[0][1])
+
+def test_closing_an_export_cancels_its_renders(sample_video_path, tmp_path):
+    font_path = tmp_path / "font.ttf"
+    font_path.write_bytes(b"font")
+    processor = VideoProcessor(sample_video_path.parent, font_path, tmp_path)
+    processor._videos = [
+        Video(id=0, title="sample", path=sample_video_path, subs=[]),
+        Video(id=1, title="other", path=sample_video_path, subs=[]),
+    ]
+    clips = [clip_settings(font_path, episode=0), clip_settings(font_path, episode=1)]
+    cancelled = []
+    started = threading.Event()
+
+    def render_clips_until_cancelled(clips, video_path, font_path, output_paths, cancellation=None, timeout=None):
+        if clips[0].episode == 0:
+            return fake_render_clips(clips, video_path, font_path, output_paths)
+        started.set()
+        try:
+            wait_for_cancellation(clips[0], video_path, font_path, output_paths[0], cancellation=cancellation)
+        except RenderCancelled as e:
+            cancelled.append(e.reason)
+            raise
+
+    with patch('subclipper.core.video_processor.render_clips', side_effect=render_clips_until_cancelled):
+        results = processor.export_clips(clips, workers=2)
+        position, output_path, error = next(results)
+        # Renders that did not start yet are dropped without being cancelled
+        assert started.wait(10)
+        results.close()
+        deadline = time.time() + 10
+        while not cancelled and time.time() < deadline:
+            time.sleep(0.01)
+
+    assert (position, error) == (0, None)
+    assert cancelled == ["disconnected"]
+    processor.release_clip(output_path)
+
+def test_clip_key_identifies_the_output(sample_video_path, tmp_path):
+    font_path = tmp_path / "font.ttf"
+    font_path.write_bytes(b"font")
+    processor = VideoProcessor(sample_video_path.parent, font_path, None)
+    processor._videos = [Video(id=0, title="sample", path=sample_video_path, subs=[])]
+
+    def settings(**overrides):
+        values = dict(
+            start_time=0.0, end_time=5.0, original_start_time=0.0, original_end_time=5.0, text="Test",
+            crop=False, resolution=500, id=0, episode=0, font_size=20, caption="", boomerang=False,
+            colour=False, format="webp", font_path=font_path,
+        )
+        values.update(overrides)
+        return ClipSettings(**values)
+
+    key = processor.clip_key(settings())
+    assert key is not None
+    assert processor.clip_key(settings()) == key
+    assert processor.clip_key(settings(resolution=320)) != key
+    assert processor.clip_key(settings(episode=5)) is None
+    assert processor.clip_key(settings(end_time=-1.0)) is None
+    # Changing the font changes the output
+    os.utime(font_path, ns=(0, 0))
+    assert processor.clip_key(settings()) != key
+
+def test_rescan_keeps_video_ids(system_font_path, tmp_path):
+    library = tmp_path / "library"
+    library.mkdir()
+    (library / "b.mkv").write_bytes(b"b")
+    (library / "c.mkv").write_bytes(b"c")
+
+    def extract_subtitles(video_path, video_id):
+        return [Subtitle(id=0, start=0, end=1, text=video_path.read_text(), video_id=video_id)]
+
+    with patch.object(VideoProcessor, '_extract_subtitles', side_effect=extract_subtitles) as mock_extract:
+        processor = VideoProcessor(library, system_font_path, tmp_path / "cache")
+        videos = processor.load_videos()
+        assert [(video.id, video.title) for video in videos] == [(0, "b"), (1, "c")]
+        assert processor.rescan() is False
+
+        (library / "a.mkv").write_bytes(b"a")
+        (library / "b.mkv").unlink()
+        (library / "c.mkv").write_bytes(b"changed")
+        assert processor.rescan() is True
+
+        videos = processor.load_videos()
+        assert [(video.id, video.title) for video in videos] == [(1, "c"), (2, "a")]
+        assert processor.get_video(0) is None
+        assert processor.get_video(1).subs[0].text == "changed"
+        assert [sub.text for sub in processor.search_subtitles(None)] == ["changed", "a"]
+        # Only the added and the changed video were extracted again
+        assert mock_extract.call_count == 4
+
+        # Ids survive a restart
+        restarted = VideoProcessor(library, system_font_path, tmp_path / "cache")
+        assert [(video.id, video.title) for video in restarted.load_videos()] == [(1, "c"), (2, "a")]
+        assert mock_extract.call_count == 4
+
+def test_worker_processes_share_the_subtitle_store(system_font_path, tmp_path):
+    library = tmp_path / "library"
+    library.mkdir()
+    (library / "a.mkv").write_bytes(b"a")
+    subs = [Subtitle(id=0, start=0, end=1, text="Hello world", video_id=0)]
+
+    with patch.object(VideoProcessor, '_extract_subtitles', return_value=subs):
+        first = VideoProcessor(library, system_font_path, tmp_path / "cache")
+        first.load_videos()
+
+    # Another worker maps the same store, without reading the catalog or extracting anything
+    with patch.object(VideoProcessor, '_load_subtitles', side_effect=AssertionError):
+        second = VideoProcessor(library, system_font_path, tmp_path / "cache")
+        videos = second.load_videos()
+    assert videos[0].subs == subs
+    assert second.library_version == first.library_version
+    assert second.search_subtitles("WORLD") == subs
+    assert len(list((tmp_path / "cache" / "store").iterdir())) == 1
+
+def test_time_range_queries(video_processor, sample_video_path):
+    subs = [Subtitle(id=idx, start=idx * 2, end=idx * 2 + 1.5, text=f"Line {idx}", video_id=0) for idx in range(10)]
+    video_processor._videos = [Video(id=0, title="sample", path=sample_video_path, subs=subs)]
+
+    assert video_processor.subtitles_between(0, 3.0, 6.2) == subs[1:4]
+    assert video_processor.subtitles_between(1, 3.0, 6.2) == []
+    assert video_processor.neighbouring_subtitles(0, 0, 2) == subs[0:3]
+    assert video_processor.neighbouring_subtitles(0, 5, 1) == subs[4:7]
+    assert video_processor.neighbouring_subtitles(0, 10, 1) is None
@@ -10,9 +10,31 @@ class Config:
         self.search_path = Path(self._get_required_env('SEARCH_PATH'))
         self.show_name = self._get_required_env('SHOW_NAME')
         self.default_page_length = int(self._get_optional_env('DEFAULT_PAGE_LENGTH', '50'))
+        self.cache_dir = Path(self._get_optional_env('CACHE_DIR', str(self.search_path / '.subclipper')))
+        # Worker processes combine their metrics through this directory
+        from ..core.metrics import metrics
+        metrics.configure(self.cache_dir / 'metrics')
+        self.extraction_workers = int(self._get_optional_env('EXTRACTION_WORKERS', '1'))
+        self.clip_cache_bytes = int(self._get_optional_env('CLIP_CACHE_SIZE_MB', '1024')) * 1024 * 1024
+        self.segment_cache_bytes = int(self._get_optional_env('SEGMENT_CACHE_SIZE_MB', '512')) * 1024 * 1024
+        self.master_cache_bytes = int(self._get_optional_env('MASTER_CACHE_SIZE_MB', '1024')) * 1024 * 1024
+        self.master_max_resolution = int(self._get_optional_env('MASTER_MAX_RESOLUTION', '1024'))
+        self.page_cache_bytes = int(self._get_optional_env('PAGE_CACHE_SIZE_MB', '32')) * 1024 * 1024
+        self.render_workers = int(self._get_optional_env('RENDER_WORKERS', '2'))
+        self.render_queue_size = int(self._get_optional_env('RENDER_QUEUE_SIZE', '32'))
+        self.render_timeout = float(self._get_optional_env('RENDER_TIMEOUT', '300'))
+        self.render_abandon_seconds = float(self._get_optional_env('RENDER_ABANDON_SECONDS', '30'))
+        self.export_workers = int(self._get_optional_env('EXPORT_WORKERS', str(os.cpu_count() or 1)))
+        self.export_max_clips = int(self._get_optional_env('EXPORT_MAX_CLIPS', '500'))
+        self.rescan_interval = float(self._get_optional_env('RESCAN_INTERVAL', '60'))
+        profile_dir = self._get_optional_env('PROFILE_DIR', '')
+        self.profile_dir = Path(profile_dir) if profile_dir else None
+        self.thumbnails = self._get_optional_env('THUMBNAILS', 'true').lower() in ('1', 'true', 'yes')
         self.font_path = self._find_font()
         logger.info(f"Initialized Config with search_path: {self.search_path}, show_name: {self.show_name}, font_path: {self.font_path}")
         self._video_processor = None
+        self._render_jobs = None
+        self._page_cache = None
         
     def _get_required_env(self, name: str) -> str:
         """Get a required environment variable. If it is not present, the program will panic."""
@@ -30,17 +52,62 @@ class Config:
         return value
         
     def _find_font(self) -> Path:
-        """Find a suitable font for subtitle rendering."""
-        from matplotlib import font_manager
-        font = font_manager.findfont('')  # Get a fallback font
-        return Path(font)
+        """Find a suitable font for subtitle rendering. If FONT_PATH is not a usable font, the program will panic."""
+        from .fonts import find_font, is_font_file
+        font_path = os.getenv('FONT_PATH')
+        if font_path is not None:
+            if not is_font_file(Path(font_path)):
+                logger.error(f"FONT_PATH {font_path} is not a TrueType or OpenType font")
+                sys.exit(4)
+            return Path(font_path)
+
+        font = find_font(self.cache_dir / 'font_path')
+        if font is None:
+            logger.error("No font found for rendering subtitles. Set the FONT_PATH env var")
+            sys.exit(4)
+        return font
         
     @property
     def video_processor(self):
         """Get the VideoProcessor instance, creating it if necessary."""
         if self._video_processor is None:
             from ..core.video_processor import VideoProcessor
-            self._video_processor = VideoProcessor(self.search_path, self.font_path)
+            self._video_processor = VideoProcessor(
+                self.search_path,
+                self.font_path,
+                self.cache_dir,
+                extraction_workers=self.extraction_workers,
+                clip_cache_bytes=self.clip_cache_bytes,
+                thumbnails=self.thumbnails,
+                render_timeout=self.render_timeout if self.render_timeout > 0 else None,
+                segment_cache_bytes=self.segment_cache_bytes,
+                master_cache_bytes=self.master_cache_bytes,
+                master_max_resolution=self.master_max_resolution
+            )
             # Load videos on startup
             self._video_processor.load_videos()
-        return self._video_processor 
\ No newline at end of file
+            if self.rescan_interval > 0:
+                self._video_processor.start_rescanning(self.rescan_interval)
+        return self._video_processor
+
+    @property
+    def render_jobs(self):
+        """Get the RenderJobs instance, creating it if necessary."""
+        if self._render_jobs is None:
+            from ..core.render_jobs import RenderJobs
+            self._render_jobs = RenderJobs(
+                self.video_processor,
+                self.render_workers,
+                self.render_queue_size,
+                abandon_seconds=self.render_abandon_seconds,
+                heartbeat_dir=self.cache_dir / 'render_jobs'
+            )
+        return self._render_jobs
+
+    @property
+    def page_cache(self):
+        """Get the FragmentCache of rendered pages, or None if it is disabled."""
+        if self._page_cache is None and self.page_cache_bytes > 0:
+            from ..core.fragment_cache import FragmentCache
+            self._page_cache = FragmentCache(self.page_cache_bytes)
+        return self._page_cache
@@ -0,0 +1,80 @@
+import logging
+import os
+import shutil
+import subprocess
+from pathlib import Path
+from typing import Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# The first bytes of TrueType and OpenType fonts and font collections
+FONT_MAGIC = (b'\x00\x01\x00\x00', b'true', b'OTTO', b'ttcf')
+# Where the usual sans-serif fonts are installed when fontconfig is not available
+KNOWN_FONTS = (
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+    '/usr/share/fonts/TTF/DejaVuSans.ttf',
+    '/usr/share/fonts/dejavu-sans-fonts/DejaVuSans.ttf',
+    '/usr/share/fonts/dejavu/DejaVuSans.ttf',
+    '/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf',
+    '/System/Library/Fonts/Helvetica.ttc',
+    '/Library/Fonts/Arial.ttf',
+    'C:/Windows/Fonts/arial.ttf',
+)
+FC_MATCH_TIMEOUT_SECONDS = 5
+
+def is_font_file(path: Path) -> bool:
+    """Check whether `path` is a TrueType or OpenType font that ffmpeg's drawtext can use."""
+    try:
+        with open(path, 'rb') as f:
+            return f.read(4) in FONT_MAGIC
+    except OSError:
+        return False
+
+def _fontconfig_font() -> Optional[Path]:
+    """Ask fontconfig for the default sans-serif font."""
+    if shutil.which('fc-match') is None:
+        return None
+    try:
+        result = subprocess.run(
+            ['fc-match', '--format=%{file}', 'sans-serif'],
+            capture_output=True,
+            timeout=FC_MATCH_TIMEOUT_SECONDS,
+            check=True,
+        )
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.debug(f"fc-match failed: {e}")
+        return None
+    path = result.stdout.decode(errors='replace').strip()
+    return Path(path) if path else None
+
+def _candidates(cache_file: Optional[Path]) -> Iterator[Path]:
+    if cache_file is not None:
+        try:
+            yield Path(cache_file.read_text().strip())
+        except OSError:
+            pass
+    fontconfig_font = _fontconfig_font()
+    if fontconfig_font is not None:
+        yield fontconfig_font
+    for known in KNOWN_FONTS:
+        yield Path(known)
+
+def find_font(cache_file: Optional[Path] = None) -> Optional[Path]:
+    """Find a font for subtitle rendering, or None if there is none.
+
+    The font found before is remembered in `cache_file`, so only the first process start asks fontconfig.
+    """
+    for candidate in _candidates(cache_file):
+        if not is_font_file(candidate):
+            continue
+        if cache_file is not None:
+            try:
+                if not cache_file.exists() or cache_file.read_text().strip() != str(candidate):
+                    cache_file.parent.mkdir(parents=True, exist_ok=True)
+                    tmp_file = cache_file.with_name(f'{cache_file.name}.{os.getpid()}.tmp')
+                    tmp_file.write_text(str(candidate))
+                    os.replace(tmp_file, cache_file)
+            except OSError as e:
+                logger.debug(f"Failed to remember the font in {cache_file}: {e}")
+        return candidate
+    return None